@@ -1,9 +1,18 @@
 import os
+import json
 import uuid
 from dotenv import load_dotenv
 import logging
 import logging.config
-import re
+
+from karaokehunt.context import current_job
+from karaokehunt.logs import (
+    LOG_FORMAT,
+    PerUserLogFileHandler,
+    TextLogFormatter,
+    JsonLogFormatter,
+    start_log_queue,
+)
 
 ##########################################################################
 ###################            Init and Setup               ##############
@@ -14,58 +23,57 @@ load_dotenv()
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH")
 
+# Routes which never need a session (see load_username)
+SESSIONLESS_PATHS = ("/ready", "/metrics", "/favicon.ico")
+
 
 class UsernameRequestIdFilter(logging.Filter):
     # This is a logging filter that makes both request ID and username
-    # available for use in the logging formatter, if set (otherwise UNKNOWN)
+    # available for use in the logging formatter, if set.
+    # It runs in the logging thread as records are queued, so it only gathers details;
+    # message rewriting happens in the formatter, on the queue listener's thread.
     def filter(self, record):
-        req_id = "UNKNOWN"
-        username = "UNKNOWN"
-        record.identifier = f"HTTP"
+        # Used by PerUserLogFileHandler to pick the user's side file, None if there's no user
+        record.username = None
 
         if flask.has_request_context():
-            record.identifier += " / ReqID: "
-
-            if not hasattr(flask.g, "request_id"):
-                new_uuid = uuid.uuid4().hex[:10]
-                flask.g.request_id = new_uuid
-
-            record.identifier += flask.g.request_id
+            if "request_id" not in flask.g:
+                flask.g.request_id = uuid.uuid4().hex[:10]
+
+            record.username = session.get("username")
+            record.identifier = (
+                f"HTTP / ReqID: {flask.g.request_id} / User: {record.username or 'NoUserInSession'}"
+            )
+        elif current_job.get() is not None:
+            # Background jobs run outside any request, so identify them by job ID and the user they're for
+            job = current_job.get()
+            record.identifier = f"JOB / JobID: {job['id']} / User: {job['username']}"
+            record.username = job["username"]
+        else:
+            record.identifier = "HTTP"
 
-        if flask.has_app_context() and flask.has_request_context():
-            record.identifier += " / User: "
-
-            if "username" in session:
-                record.identifier += session["username"]
-            else:
-                record.identifier += "NoUserInSession"
-
-        record.replacedmessage = re.sub("\[.+\] ", "", record.getMessage())
-        record.replacedmessage = re.sub("127.0.0.1 ", "", record.replacedmessage)
-        record.replacedmessage = re.sub("- - ", "", record.replacedmessage)
         return True
 
 
 LOGGING_CONFIG = {
     "version": 1,
-    "disable_existing_loggers": True,
-    "filters": {
-        "add_request_and_username": {
-            "()": "__main__.UsernameRequestIdFilter",
-        },
-    },
+    # Leave gunicorn's loggers (set up before the app is preloaded) enabled, or its access and error logs go silent
+    "disable_existing_loggers": False,
     "formatters": {
         "standard": {
-            "format": "%(asctime)s [%(levelname)s] [%(identifier)s] %(name)s: %(replacedmessage)s"
+            "()": TextLogFormatter,
+            "fmt": "%(asctime)s [%(levelname)s] [%(identifier)s] %(name)s: %(replacedmessage)s",
+        },
+        "json": {
+            "()": JsonLogFormatter,
         },
     },
     "handlers": {
         "default": {
             "stream": "ext://sys.stdout",  # Default is stderr
             "level": "DEBUG",
-            "formatter": "standard",
+            "formatter": "json" if LOG_FORMAT == "json" else "standard",
             "class": "logging.StreamHandler",
-            "filters": ["add_request_and_username"],
         },
         "timed_rotate_file": {
             "filename": LOG_FILE_PATH,
@@ -78,20 +86,25 @@ LOGGING_CONFIG = {
             # This is used to configure rollover (7=weekly files if when = daily or midnight)
             "backupCount": 7,
         },
+        "per_user_files": {
+            "level": "DEBUG",
+            "formatter": "standard",
+            "()": PerUserLogFileHandler,
+        },
     },
     "loggers": {
         "": {  # root logger
-            "handlers": ["default", "timed_rotate_file"],
+            "handlers": ["default", "timed_rotate_file", "per_user_files"],
             "level": "DEBUG",
             "propagate": False,
         },
         "karaokehunt": {
-            "handlers": ["default", "timed_rotate_file"],
+            "handlers": ["default", "timed_rotate_file", "per_user_files"],
             "level": "DEBUG",
             "propagate": False,
         },
         "__main__": {  # if __name__ == '__main__'
-            "handlers": ["default", "timed_rotate_file"],
+            "handlers": ["default", "timed_rotate_file", "per_user_files"],
             "level": "DEBUG",
             "propagate": False,
         },
@@ -100,18 +113,37 @@ LOGGING_CONFIG = {
 
 logging.config.dictConfig(LOGGING_CONFIG)
 
+# The handlers configured above are written to from a background thread, with the filter
+# adding request and user details to each record before it is queued
+start_log_queue(
+    list(LOGGING_CONFIG["loggers"]),
+    [UsernameRequestIdFilter()],
+)
+
 import flask
 from flask import Flask
 
-app = Flask(__name__)
+from karaokehunt.sessions import init_session_store
+
+app = flask_app = Flask(__name__)
 app.config.from_prefixed_env()
+init_session_store(app)
 app.app_context().push()
 
 from karaokehunt.karaokehunt import *
+from karaokehunt.metrics import start_metrics_snapshot_thread
+
+# The star import above rebinds app to the current_app proxy the modules register routes on,
+# so point it back at the Flask app itself, which is what wsgi.py hands to gunicorn
+app = flask_app
 
 
 @app.before_request
 def load_username():
+    # Probes, scrapers and static files don't get a session, or each cookieless request would store a new one
+    if request.path in SESSIONLESS_PATHS or request.path.startswith("/assets/"):
+        return
+
     if "username" in session:
         flask.g.username = session.get("username")
     else:
@@ -123,14 +155,48 @@ def load_username():
         flask.g.username = username
 
 
+@app.before_request
+def start_request_trace():
+    if "request_id" not in flask.g:
+        flask.g.request_id = uuid.uuid4().hex[:10]
+
+    # The token is kept in the WSGI environ rather than g, as /debug and /admin dump g as JSON
+    if TRACING == "all":
+        request.environ["karaokehunt.trace_token"] = start_trace(
+            flask.g.request_id, "request", method=request.method, path=request.path
+        )
+
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    if "karaokehunt.trace_token" in request.environ:
+        finish_trace(request.environ.pop("karaokehunt.trace_token"), username=session.get("username"))
+
+
 @app.after_request
 def inject_identifying_headers(response):
     response.headers["X-Username"] = session.get("username", "UNKNOWN")
+    response.headers["X-Request-Id"] = flask.g.get("request_id", "")
+
+    # Report how fresh any provider data used by this request was (fetched / fresh / stale + age)
+    if "provider_data_freshness" in flask.g:
+        response.headers["X-Provider-Data-Freshness"] = json.dumps(
+            flask.g.provider_data_freshness, separators=(",", ":")
+        )
+
+    # Report how much googleapiclient build overhead the cached discovery docs and service clients saved
+    if "google_client_build_seconds_saved" in flask.g:
+        response.headers["X-Google-Client-Build-Saved-Ms"] = (
+            f"{flask.g.google_client_build_seconds_saved * 1000:.1f}"
+        )
     return response
 
 
 if __name__ == "__main__":
+    # Development server only, production runs under gunicorn via wsgi.py
     logger.info("App starting up")
+    warm_up_in_background()
+    start_metrics_snapshot_thread()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host="0.0.0.0", port=port)
     logger.info("App successfully started")
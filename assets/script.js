@@ -83,15 +83,69 @@ clearSessionButton.addEventListener("click", () => {
 const openSheetButton = document.getElementById("openSheetButton");
 const buildSheetButton = document.getElementById("buildSheetButton");
 
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+// Show live progress events for a generation job as they're streamed from the server, resolving once it's done.
+// The server closes the stream every so often and EventSource reconnects from the last event it saw.
+const watchJobProgress = (jobId) => new Promise((resolve) => {
+    const progressMessage = document.getElementById("progressMessage");
+    const events = new EventSource("/jobs/" + jobId + "/events");
+
+    events.addEventListener("progress", (event) => {
+        progressMessage.textContent = JSON.parse(event.data).message;
+    });
+    events.addEventListener("done", () => {
+        events.close();
+        resolve();
+    });
+    // EventSource gives up (rather than reconnecting) on error responses, so fall back to polling the status
+    events.addEventListener("error", () => {
+        if (events.readyState == EventSource.CLOSED) {
+            resolve();
+        }
+    });
+});
+
+// Sheet generation runs as a background job; wait for its progress stream to end, then fetch the result
+async function waitForJob(jobId) {
+    await watchJobProgress(jobId);
+
+    // Normally the job has already finished here, the status is only polled if the stream failed
+    while (true) {
+        const statusResponse = await fetch("/jobs/" + jobId);
+        if (!statusResponse.ok) {
+            throw new Error(await statusResponse.text());
+        }
+
+        const job = await statusResponse.json();
+        if (job.status != "queued" && job.status != "running") {
+            console.log("Provider data freshness: " + JSON.stringify(job.provider_data_freshness));
+            break;
+        }
+
+        await sleep(2000);
+    }
+
+    const resultResponse = await fetch("/jobs/" + jobId + "/result");
+    if (!resultResponse.ok) {
+        throw new Error(await resultResponse.text());
+    }
+    return await resultResponse.json();
+}
+
 async function buildSheetAction() {
     loading();
 
     try {
         let includeZeroScoreSongs = document.getElementById("includeZeroScoreSongs").checked;
-        // Call the /generate_sheet route
-        const response = await fetch("/generate_sheet?includeZeroScoreSongs=" + includeZeroScoreSongs);
+        let updateExistingSheet = document.getElementById("updateExistingSheet").checked;
+        // Call the /generate_sheet route, which queues a generation job
+        const response = await fetch("/generate_sheet?includeZeroScoreSongs=" + includeZeroScoreSongs + "&updateExistingSheet=" + updateExistingSheet);
         if (response.ok) {
-            karaokeSheetURL = await response.text();
+            const job = await response.json();
+            const result = await waitForJob(job.job_id);
+            karaokeSheetURL = result.open_sheet_url;
+            openSheetButton.href = karaokeSheetURL;
             openSheetButton.style.display = "inline-block";
 
             buildSheetButton.classList.remove('btn-primary');
@@ -0,0 +1,110 @@
+import random
+
+##########################################################################
+###########          Synthetic Catalog & Provider Data         ###########
+##########################################################################
+
+# Deterministic (seeded) stand-ins for the KaraokeNerds catalog and each provider's listening data,
+# so benchmarks and the mock provider server (loadtest/mock_providers.py) can run at any size offline.
+# A share of each user's listening history is drawn from the catalog, so scoring finds realistic matches.
+
+KARAOKE_BRANDS = [
+    "Sound Choice", "Zoom", "Sunfly", "Karaoke Version", "Party Tyme", "Stingray", "Legends",
+    "Chartbuster", "Pop Hits Monthly", "The Karaoke Channel", "SBI", "Music Maestro", "Pocket Songs",
+    "All Star", "Singsation", "Top Tunes", "DK Karaoke", "Priddis", "Sing King", "Karafun",
+    "Nu Tech", "Mr Entertainer", "Ameritz", "Hit Tracks", "Sound Sensation", "Sunfly Gold",
+    "Zoom Platinum", "Singer's Edge", "Musical Creations", "Pro Sing", "Bar Tunes", "Vocal Star",
+]
+
+WORDS = [
+    "love", "night", "heart", "fire", "dance", "dream", "baby", "blue", "summer", "rain", "gold", "wild",
+    "home", "road", "light", "time", "girl", "boy", "moon", "star", "river", "city", "angel", "ghost",
+    "sweet", "crazy", "lonely", "shadow", "thunder", "honey", "paradise", "midnight", "highway", "radio",
+    "forever", "tonight", "electric", "velvet", "diamond", "sugar", "broken", "running", "falling", "kiss",
+]
+FIRST_NAMES = [
+    "Alex", "Billie", "Carly", "Dolly", "Elton", "Freddie", "Gloria", "Harry", "Iggy", "Janis", "Kelly",
+    "Lionel", "Miley", "Nina", "Otis", "Patsy", "Queen", "Ricky", "Shania", "Tina", "Usher", "Whitney",
+]
+LAST_NAMES = [
+    "Adams", "Brooks", "Cash", "Dion", "Estefan", "Franklin", "Gaye", "Houston", "Idol", "Jackson",
+    "King", "Lauper", "Mars", "Nelson", "Osbourne", "Parton", "Quinn", "Rogers", "Swift", "Turner",
+]
+
+
+def generate_artist_name(rng):
+    if rng.random() < 0.5:
+        return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    return f"The {rng.choice(WORDS).title()} {rng.choice(WORDS).title()}s"
+
+
+def generate_title(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def generate_brand_count(rng):
+    # Most songs are only produced by one or two brands, a few hits by dozens, like the real catalog
+    return min(int(rng.paretovariate(1.3)), len(KARAOKE_BRANDS))
+
+
+def generate_catalog(song_count, seed=0):
+    # KaraokeNerds shaped songs, as the catalog file holds them
+    rng = random.Random(seed)
+    artists = [f"{generate_artist_name(rng)} {index}" for index in range(max(song_count // 8, 10))]
+
+    return [
+        {
+            "Artist": rng.choice(artists),
+            "Title": generate_title(rng),
+            "Brands": ", ".join(rng.sample(KARAOKE_BRANDS, generate_brand_count(rng))),
+        }
+        for _ in range(song_count)
+    ]
+
+
+def generate_listening_history(catalog, track_count, seed=0, hit_rate=0.5):
+    # [(artist, title, score)] for one user: hit_rate of the tracks are catalog songs, the rest are not.
+    # Scores fall off with rank, like play counts do.
+    rng = random.Random(seed)
+    history = []
+
+    for rank in range(track_count):
+        if catalog and rng.random() < hit_rate:
+            song = rng.choice(catalog)
+            artist, title = song["Artist"], song["Title"]
+        else:
+            artist, title = f"Unknown Artist {rng.randint(0, track_count)}", generate_title(rng)
+        history.append((artist, title, max(int(5000 / (rank + 1) ** 0.7), 1)))
+
+    return history
+
+
+def get_artist_scores(history):
+    # Lowercased artist -> highest score of any of their tracks
+    artist_scores = {}
+    for artist, _, score in history:
+        artist_scores[artist.lower()] = max(score, artist_scores.get(artist.lower(), 0))
+    return artist_scores
+
+
+def get_track_scores(history):
+    return {(artist.lower(), title.lower()): score for artist, title, score in history}
+
+
+def generate_provider_data(catalog, track_count, seed=0):
+    # Every provider's data in the shapes the provider fetchers return them,
+    # i.e. the provider arguments of calculate_songs_rows()
+    lastfm_history = generate_listening_history(catalog, track_count, seed + 1)
+    spotify_history = generate_listening_history(catalog, track_count, seed + 2)
+    applemusic_history = generate_listening_history(catalog, track_count, seed + 3)
+    youtube_history = generate_listening_history(catalog, track_count // 4, seed + 4)
+
+    return {
+        "lastfm_artist_playcounts": get_artist_scores(lastfm_history),
+        "lastfm_track_playcounts": get_track_scores(lastfm_history),
+        "spotify_artist_scores": {artist: min(score, 100) for artist, score in get_artist_scores(spotify_history).items()},
+        "spotify_track_scores": {track: min(score, 100) for track, score in get_track_scores(spotify_history).items()},
+        "applemusic_artists": sorted({artist for artist, _, _ in applemusic_history}),
+        "applemusic_tracks": [{"artist": artist, "title": title, "album": ""} for artist, title, _ in applemusic_history],
+        "youtube_liked_songs": [(artist, title) for artist, title, _ in youtube_history],
+    }
@@ -0,0 +1,223 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from hashlib import sha256
+
+##########################################################################
+###########                    Benchmarks                      ###########
+##########################################################################
+
+# Times the CPU heavy parts of sheet generation against synthetic data (see generators.py):
+#   catalog.load        load_karaoke_songs_index(), parsing the gzipped catalog and building the scoring index
+#   rows.calculate      calculate_songs_rows() with every provider's data
+#   csv.write           stream_csv(), plain and gzipped
+#   cache.store / load  store_cache_file() / load_cache_file() of a provider's track scores
+#
+# Usage, from the repository root:
+#   python benchmarks/run_benchmarks.py --output before.json
+#   python benchmarks/run_benchmarks.py --output after.json --baseline before.json
+#
+# With --baseline, each timing is compared against the baseline run and each output digest is checked
+# against the baseline's, so an optimisation which changes the generated sheet fails the run (exit code 1).
+# Digests only match between runs with the same sizes and seed.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.generators import generate_catalog, generate_provider_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark karaoke sheet generation on synthetic data")
+    parser.add_argument("--catalog-sizes", default="10000,100000", help="Comma separated song counts, up to 2000000")
+    parser.add_argument("--payload-sizes", default="1000,10000", help="Comma separated tracks per provider")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each benchmark, the median is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare timings and outputs against")
+    return parser.parse_args()
+
+
+def set_up_environment(temp_dir):
+    # The app reads its configuration from the environment at import time
+    os.environ["TEMP_OUTPUT_DIR"] = temp_dir
+    os.environ["LOG_FILE_PATH"] = f"{temp_dir}/benchmark.log"
+    os.environ["KARAOKE_SONGS_FILE"] = "karaokenerds_benchmark.json.gz"
+    os.environ["CACHE_BACKEND"] = "disk"
+    os.environ["TRACING"] = "off"
+    os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+
+
+def time_runs(run, repeat):
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        durations.append(time.perf_counter() - start)
+
+    timing = {
+        "median_seconds": statistics.median(durations),
+        "min_seconds": min(durations),
+        "max_seconds": max(durations),
+        "runs": repeat,
+    }
+    return timing, result
+
+
+def get_digest(data):
+    return sha256(json.dumps(data, sort_keys=True, default=list).encode("utf-8")).hexdigest()
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    from karaokehunt import karaokenerds
+    from karaokehunt.karaokehunt import calculate_songs_rows
+    from karaokehunt.export import stream_csv
+    from karaokehunt.cache import store_cache_file, load_cache_file, track_scores_to_records, records_to_track_scores
+
+    catalog_sizes = [int(size) for size in args.catalog_sizes.split(",")]
+    payload_sizes = [int(size) for size in args.payload_sizes.split(",")]
+    results = {}
+
+    def record(name, timing, digest=None, **details):
+        results[name] = {**timing, "digest": digest, **details}
+        print(f"{name}: {timing['median_seconds'] * 1000:.1f} ms", file=sys.stderr)
+
+    for catalog_size in catalog_sizes:
+        catalog = generate_catalog(catalog_size, args.seed)
+        catalog_file_path = f"{os.environ['TEMP_OUTPUT_DIR']}/{os.environ['KARAOKE_SONGS_FILE']}"
+        with gzip.open(catalog_file_path, "wt", encoding="utf-8") as f:
+            json.dump(catalog, f)
+
+        def load_catalog():
+            # Forces a re-parse, as the catalog is otherwise kept in memory until the file changes
+            karaokenerds.karaoke_songs_cache["version"] = None
+            return karaokenerds.load_karaoke_songs_index()
+
+        timing, karaoke_songs_index = time_runs(load_catalog, args.repeat)
+        record(f"catalog.load[songs={catalog_size}]", timing, get_digest(karaoke_songs_index))
+
+        for payload_size in payload_sizes:
+            provider_data = generate_provider_data(catalog, payload_size, args.seed)
+            case = f"songs={catalog_size},tracks={payload_size}"
+
+            for include_zero_score in ("false", "true"):
+                timing, (header_values, data_values) = time_runs(
+                    lambda: calculate_songs_rows(karaoke_songs_index, include_zero_score, **provider_data),
+                    args.repeat,
+                )
+                record(
+                    f"rows.calculate[{case},zero_score={include_zero_score}]",
+                    timing,
+                    get_digest([header_values, data_values]),
+                    rows=len(data_values),
+                )
+
+            for compress in (False, True):
+                timing, csv_data = time_runs(lambda: b"".join(stream_csv(header_values, data_values, compress)), args.repeat)
+                if compress:
+                    csv_data = gzip.decompress(csv_data)
+
+                # The CSV must parse back to exactly the rows it was written from
+                parsed_rows = list(csv.reader(csv_data.decode("utf-8").splitlines()))
+                expected_rows = [header_values] + [[str(value) for value in row] for row in data_values]
+                if parsed_rows != expected_rows:
+                    raise AssertionError(f"CSV output does not round trip for {case}")
+
+                record(f"csv.write[{case},gzip={compress}]", timing, get_digest(csv_data.decode("utf-8")), bytes=len(csv_data))
+
+            track_records = track_scores_to_records(provider_data["lastfm_track_playcounts"])
+            timing, _ = time_runs(lambda: store_cache_file("benchmark_tracks", track_records), args.repeat)
+            record(f"cache.store[{case}]", timing)
+
+            timing, loaded_records = time_runs(lambda: load_cache_file("benchmark_tracks"), args.repeat)
+            if records_to_track_scores(loaded_records) != provider_data["lastfm_track_playcounts"]:
+                raise AssertionError(f"Cached track scores do not round trip for {case}")
+            record(f"cache.load[{case}]", timing)
+
+    return results
+
+
+def compare_with_baseline(results, baseline_results, compare_outputs=True):
+    # Returns the names of benchmarks whose output differs from the baseline
+    mismatches = []
+
+    for name, result in results.items():
+        baseline = baseline_results.get(name)
+        if baseline is None:
+            continue
+
+        speedup = baseline["median_seconds"] / result["median_seconds"] if result["median_seconds"] else float("inf")
+        result["baseline_median_seconds"] = baseline["median_seconds"]
+        result["speedup"] = speedup
+
+        output_status = ""
+        if compare_outputs and result["digest"] is not None and baseline.get("digest") is not None:
+            result["matches_baseline"] = result["digest"] == baseline["digest"]
+            if not result["matches_baseline"]:
+                mismatches.append(name)
+                output_status = " OUTPUT DIFFERS"
+
+        print(f"{name}: {speedup:.2f}x vs baseline{output_status}", file=sys.stderr)
+
+    return mismatches
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="karaokehunt_benchmark_") as temp_dir:
+        set_up_environment(temp_dir)
+
+        # Importing the app registers its routes and configures logging, as in production
+        import app  # noqa: F401
+
+        results = run_benchmarks(args)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": get_git_revision(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results,
+    }
+
+    mismatches = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline_report = json.load(f)
+        compare_outputs = baseline_report.get("seed") == args.seed
+        if not compare_outputs:
+            print("Warning: baseline was run with a different seed, only timings are compared", file=sys.stderr)
+        report["baseline_git_revision"] = baseline_report.get("git_revision")
+        mismatches = compare_with_baseline(results, baseline_report["results"], compare_outputs)
+        report["mismatches"] = mismatches
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+    if mismatches:
+        print(f"{len(mismatches)} benchmark outputs differ from the baseline: {', '.join(mismatches)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
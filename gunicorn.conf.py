@@ -0,0 +1,48 @@
+import os
+import gc
+
+##########################################################################
+###########                 Gunicorn Settings                  ###########
+##########################################################################
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Import wsgi.py (and so warm up) in the master before forking, so workers share the loaded data copy-on-write
+preload_app = True
+
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+
+# Threaded workers, so long-lived progress event streams don't tie up a whole worker each
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Sheet generation runs in background jobs, so requests themselves should be quick
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+
+
+def when_ready(server):
+    from karaokehunt.metrics import save_metrics_snapshot
+
+    # The master takes no requests after warm-up, so its metrics are saved for /metrics once, now
+    save_metrics_snapshot()
+
+    # Moves everything loaded during warm-up out of the garbage collector's reach, so collections
+    # in the workers don't touch (and so copy) the pages shared with the master
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from karaokehunt.metrics import start_metrics_snapshot_thread
+
+    start_metrics_snapshot_thread()
+
+    # If warm-up failed in the master (e.g. the catalog download was unavailable), retry it in each worker
+    # rather than leaving /ready failing until the next restart
+    from karaokehunt.warmup import warmup_state, warm_up_in_background
+
+    if warmup_state["status"] != "ready":
+        warm_up_in_background()
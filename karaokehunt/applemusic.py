@@ -2,12 +2,19 @@ import os
 import jwt
 import requests
 import logging
+import threading
 from time import time
+from functools import lru_cache
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 from flask import redirect, request, session, url_for, current_app as app, g
 
+from .logs import redact_token
+from .progress import publish_progress
+from .metrics import record_provider_call, provider_pages_total
+from .tracing import span
+
 logger = logging.getLogger("karaokehunt")
 
 APPLE_MUSIC_TEAM_ID = os.environ.get("APPLE_MUSIC_TEAM_ID")
@@ -18,6 +25,17 @@ APPLE_MUSIC_REDIRECT_URI = os.environ.get("APPLE_MUSIC_REDIRECT_URI")
 
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 
+# Overridable to run against a stand-in server, e.g. loadtest/mock_providers.py
+APPLE_MUSIC_API_URL = os.getenv("APPLE_MUSIC_API_URL", "https://api.music.apple.com/v1")
+APPLE_ID_URL = os.getenv("APPLE_ID_URL", "https://appleid.apple.com")
+
+# Apple tokens are valid for one week, and are re-signed once they have less than a day left
+APPLE_TOKEN_LIFETIME = 604800
+APPLE_TOKEN_REFRESH_MARGIN = 86400
+
+apple_tokens_cache = {}
+apple_tokens_lock = threading.Lock()
+
 ##########################################################################
 ################             Apple Auth Flow                ##############
 ##########################################################################
@@ -31,13 +49,13 @@ with app.app_context():
         music_user_token = data.get("music_user_token")
 
         logger.info(
-            f"Setting applemusic_music_user_token in session to music_user_token: {music_user_token}"
+            f"Setting applemusic_music_user_token in session to music_user_token: {redact_token(music_user_token)}"
         )
 
         session["applemusic_music_user_token"] = music_user_token
 
         authorization_url = (
-            f"https://appleid.apple.com/auth/authorize?"
+            f"{APPLE_ID_URL}/auth/authorize?"
             f"response_type=code%20id_token&"
             f"client_id={APPLE_MUSIC_CLIENT_ID}&"
             f"redirect_uri={APPLE_MUSIC_REDIRECT_URI}&"
@@ -57,14 +75,12 @@ with app.app_context():
         code = request.form.get("code")
         id_token = request.form.get("id_token")
 
-        logger.info(f"In authorize_applemusic, received post data:")
-        for key, val in request.form.items():
-            logger.info("key: {0} val: {1}".format(key, val))
+        logger.info(f"In authorize_applemusic, received post data keys: {list(request.form.keys())}")
 
         if code and id_token:
             client_secret = generate_client_secret()
             session["applemusic_client_secret"] = client_secret
-            logger.info(f"Set client_secret to {client_secret}")
+            logger.info(f"Set client_secret to {redact_token(client_secret)}")
 
             token_request_data = {
                 "client_id": APPLE_MUSIC_CLIENT_ID,
@@ -74,15 +90,13 @@ with app.app_context():
                 "redirect_uri": APPLE_MUSIC_REDIRECT_URI,
             }
 
-            logger.info(
-                f"About to POST to /auth/token with token_request_data: {token_request_data}"
-            )
+            logger.info("About to POST to /auth/token with authorization code")
             token_response = requests.post(
-                "https://appleid.apple.com/auth/token", data=token_request_data
+                f"{APPLE_ID_URL}/auth/token", data=token_request_data
             )
             token_data = token_response.json()
 
-            logger.info(f"Apple auth token response: {token_data}")
+            logger.info(f"Apple auth token response keys: {list(token_data.keys())}")
 
             if "access_token" in token_data:
                 logger.info(
@@ -96,7 +110,7 @@ with app.app_context():
                     audience=APPLE_MUSIC_CLIENT_ID,
                     options={"verify_signature": False},
                 )
-                logger.info(f"decoded_id_token: {decoded_id_token}")
+                logger.info(f"decoded_id_token claims: {list(decoded_id_token.keys())}")
 
                 session["applemusic_user_decoded_id_token"] = decoded_id_token
                 username = decoded_id_token["email"]
@@ -119,63 +133,68 @@ with app.app_context():
             return redirect(url_for("home"))
 
 
-def generate_client_secret():
-    logger.info("Entering generate_client_secret")
+@lru_cache(maxsize=None)
+def load_apple_signing_key():
+    # The private key is read and parsed once per process, then reused for every token we sign
+    logger.info("Loading Apple Music signing key")
     with open(APPLE_MUSIC_CREDENTIALS_PATH, "r") as f:
         private_key_file_content = f.read()
-        private_key = serialization.load_pem_private_key(
+        return serialization.load_pem_private_key(
             private_key_file_content.encode(), password=None, backend=default_backend()
         )
 
-    current_time = int(time())
-    one_week = 604800
-    expiry_time = current_time + one_week
-
-    payload = {
-        "iss": APPLE_MUSIC_TEAM_ID,
-        "aud": "https://appleid.apple.com",
-        "exp": expiry_time,
-        "iat": current_time,
-        "sub": APPLE_MUSIC_CLIENT_ID,
-        "nonce": os.urandom(8).hex(),
-    }
-    headers = {"alg": "ES256", "kid": APPLE_MUSIC_KEY_ID}
 
-    logger.info(f"payload: {payload}, headers: {headers}")
+def get_cached_apple_token(token_name, build_payload):
+    # Signed tokens are reused until APPLE_TOKEN_REFRESH_MARGIN before they expire
+    with apple_tokens_lock:
+        cached_token = apple_tokens_cache.get(token_name)
+        if cached_token and cached_token["exp"] - time() > APPLE_TOKEN_REFRESH_MARGIN:
+            return cached_token["token"]
 
-    client_secret = jwt.encode(
-        payload,
-        private_key,
-        algorithm="ES256",
-        headers=headers,
-    )
+        current_time = int(time())
+        payload = build_payload(current_time, current_time + APPLE_TOKEN_LIFETIME)
+        headers = {"alg": "ES256", "kid": APPLE_MUSIC_KEY_ID}
 
-    logger.info(f"Returning JWT encoded client_secret: {client_secret}")
-    return client_secret
+        logger.info(f"Signing new Apple {token_name}, expiring at {payload['exp']}")
 
+        token = jwt.encode(
+            payload,
+            load_apple_signing_key(),
+            algorithm="ES256",
+            headers=headers,
+        )
+        apple_tokens_cache[token_name] = {"token": token, "exp": payload["exp"]}
+        return token
 
-def generate_developer_token():
-    logger.info("Entering generate_developer_token")
 
-    with open(APPLE_MUSIC_CREDENTIALS_PATH, "r") as f:
-        private_key = f.read()
+def generate_client_secret():
+    logger.info("Entering generate_client_secret")
 
-    headers = {"alg": "ES256", "kid": APPLE_MUSIC_KEY_ID}
+    client_secret = get_cached_apple_token(
+        "client_secret",
+        lambda current_time, expiry_time: {
+            "iss": APPLE_MUSIC_TEAM_ID,
+            "aud": "https://appleid.apple.com",
+            "exp": expiry_time,
+            "iat": current_time,
+            "sub": APPLE_MUSIC_CLIENT_ID,
+            "nonce": os.urandom(8).hex(),
+        },
+    )
 
-    current_time = int(time())
-    one_week = 604800
-    expiry_time = current_time + one_week
+    logger.info(f"Returning JWT encoded client_secret: {redact_token(client_secret)}")
+    return client_secret
 
-    payload = {
-        "iss": APPLE_MUSIC_TEAM_ID,
-        "exp": expiry_time,
-        "iat": current_time,
-    }
 
-    developer_token = jwt.encode(
-        payload, private_key, algorithm="ES256", headers=headers
+def generate_developer_token():
+    return get_cached_apple_token(
+        "developer_token",
+        lambda current_time, expiry_time: {
+            "iss": APPLE_MUSIC_TEAM_ID,
+            "exp": expiry_time,
+            "iat": current_time,
+        },
     )
-    return developer_token
 
 
 def get_request_headers(developer_token, user_token):
@@ -190,13 +209,13 @@ def get_request_headers(developer_token, user_token):
         "Content-Type": "application/json",
         "Music-User-Token": user_token,
     }
-    logger.info(f"Exiting get_request_headers, returning headers: {headers}")
+    logger.debug("Exiting get_request_headers")
     return headers
 
 
 def get_applemusic_library_artists(developer_token, user_token):
     logger.info(
-        f"Entering get_applemusic_library_artists, developer_token: {developer_token} user_token: {user_token}"
+        f"Entering get_applemusic_library_artists, user_token: {redact_token(user_token)}"
     )
     if developer_token is None or user_token is None:
         logger.info("Error: missing user token")
@@ -204,16 +223,20 @@ def get_applemusic_library_artists(developer_token, user_token):
 
     headers = get_request_headers(developer_token, user_token)
 
-    url = "https://api.music.apple.com/v1/me/library/artists"
-    logger.info(f"Making request to {url} with headers: {headers}")
+    url = f"{APPLE_MUSIC_API_URL}/me/library/artists"
+    logger.info(f"Making request to {url}")
 
-    response = requests.get(url, headers=headers)
+    with span("applemusic.library_artists", category="http"):
+        response = requests.get(url, headers=headers)
     logger.info(f"response: {response}")
+    record_provider_call("applemusic", response.ok)
 
     data = response.json()
 
     if "data" in data:
+        provider_pages_total.inc(provider="applemusic")
         artists = [item["attributes"]["name"] for item in data["data"]]
+        publish_progress("applemusic", f"Fetched {len(artists)} Apple Music library artists")
         logger.info("Exiting get_applemusic_library_artists")
         return artists
     else:
@@ -222,20 +245,23 @@ def get_applemusic_library_artists(developer_token, user_token):
 
 
 def get_applemusic_library_songs(developer_token, user_token):
-    logger.info(f"Entering get_applemusic_library_songs, user_token: {user_token}")
+    logger.info(f"Entering get_applemusic_library_songs, user_token: {redact_token(user_token)}")
     if developer_token is None or user_token is None:
         logger.info("Error: missing user token")
         return
 
     headers = get_request_headers(developer_token, user_token)
 
-    url = "https://api.music.apple.com/v1/me/library/songs"
-    logger.info(f"Making request to {url} with headers: {headers}")
+    url = f"{APPLE_MUSIC_API_URL}/me/library/songs"
+    logger.info(f"Making request to {url}")
 
-    response = requests.get(url, headers=headers)
+    with span("applemusic.library_songs", category="http"):
+        response = requests.get(url, headers=headers)
+    record_provider_call("applemusic", response.ok)
     data = response.json()
 
     if "data" in data:
+        provider_pages_total.inc(provider="applemusic")
         songs = [
             {
                 "title": item["attributes"]["name"],
@@ -244,6 +270,7 @@ def get_applemusic_library_songs(developer_token, user_token):
             }
             for item in data["data"]
         ]
+        publish_progress("applemusic", f"Fetched {len(songs)} Apple Music library songs")
         logger.info("Exiting get_applemusic_library_songs")
         return songs
     else:
@@ -0,0 +1,243 @@
+import os
+import gzip
+import json
+import fcntl
+import logging
+import tempfile
+import threading
+from time import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import has_request_context, g
+
+from .context import current_job
+from .cachebackend import get_cache_backend
+from .metrics import cache_requests_total
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+PROVIDER_CACHE_TTL = int(os.getenv("PROVIDER_CACHE_TTL_HOURS", 24)) * 3600
+PROVIDER_CACHE_REFRESH_WORKERS = int(os.getenv("PROVIDER_CACHE_REFRESH_WORKERS", 2))
+
+# Refreshes run on a pool per kind of work, so slow ones (identifying songs in YouTube videos with yt-dlp
+# can take many minutes) don't hold up the quick provider API refreshes behind them
+CACHE_REFRESH_POOL_WORKERS = {
+    "default": PROVIDER_CACHE_REFRESH_WORKERS,
+    "youtube_identification": int(os.getenv("YOUTUBE_IDENTIFICATION_REFRESH_WORKERS", 1)),
+}
+
+##########################################################################
+###########            Compact Provider Data Cache             ###########
+##########################################################################
+
+# Provider data is cached as gzipped JSON holding only the reduced score maps
+# (artist -> score, (artist, title) -> score) used for the sheet calculation,
+# rather than the full API payloads. Where it's stored (and locked) is up to the configured
+# cache backend, see cachebackend.py.
+
+# One lock per cache name, so concurrent requests in this process wait on a single in-flight fetch
+cache_fetch_locks = {}
+cache_fetch_locks_lock = threading.Lock()
+
+# Stale caches are refreshed by small background pools, at most one refresh per cache name at a time
+cache_refresh_executors = {}
+cache_refreshes_in_flight = set()
+cache_refresh_lock = threading.Lock()
+
+
+@contextmanager
+def atomic_open(file_path, mode="w", **kwargs):
+    # Write to a temp file in the same directory then rename it into place,
+    # so readers only ever see the previous file or the complete new one
+    directory, filename = os.path.split(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{filename}.", suffix=".tmp")
+
+    try:
+        with open(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def get_thread_lock(lock_name):
+    with cache_fetch_locks_lock:
+        return cache_fetch_locks.setdefault(lock_name, threading.Lock())
+
+
+@contextmanager
+def exclusive_lock(lock_name):
+    # Serialises work on lock_name across threads (in-process lock) and across every process
+    # sharing the cache backend, which may be other containers for the sqlite and redis backends
+    with get_thread_lock(lock_name):
+        with get_cache_backend().lock(lock_name):
+            yield
+
+
+@contextmanager
+def local_exclusive_lock(lock_name):
+    # As exclusive_lock, but only across processes on this machine (flock), for work on local files
+    with get_thread_lock(lock_name):
+        with open(f"{TEMP_OUTPUT_DIR}/{lock_name}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_cache_file_modified_time(cache_name):
+    return get_cache_backend().get_modified_time(cache_name)
+
+
+def get_cache_file_age(cache_name):
+    # Seconds since the cache was last written, or None if there is no cached data
+    modified_time = get_cache_file_modified_time(cache_name)
+    return time() - modified_time if modified_time is not None else None
+
+
+def load_cache_file(cache_name):
+    value = get_cache_backend().get(cache_name)
+    if value is None:
+        return None
+
+    return json.loads(gzip.decompress(value))
+
+
+def store_cache_file(cache_name, data, ttl_seconds=None):
+    value = gzip.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), compresslevel=6)
+    get_cache_backend().set(cache_name, value, ttl_seconds=ttl_seconds)
+
+
+def record_cache_freshness(cache_name, status, age_seconds, cache_kind=None):
+    # Kept on the request or background job, so its response can report how fresh each provider's data was.
+    # cache_kind is the cache name without the user part, as cache names are too many to use as metric labels.
+    logger.debug(f"Cache {cache_name} is {status}, age: {age_seconds}s")
+    cache_requests_total.inc(cache=cache_kind or "other", result=status)
+    freshness = {"status": status, "age_seconds": int(age_seconds)}
+
+    if has_request_context():
+        if "provider_data_freshness" not in g:
+            g.provider_data_freshness = {}
+        g.provider_data_freshness[cache_name] = freshness
+    elif current_job.get() is not None:
+        current_job.get().setdefault("provider_data_freshness", {})[cache_name] = freshness
+
+
+def get_cache_refresh_executor(refresh_pool):
+    # Created on first use rather than at import, so no threads exist before a forking server forks
+    with cache_refresh_lock:
+        if refresh_pool not in cache_refresh_executors:
+            cache_refresh_executors[refresh_pool] = ThreadPoolExecutor(
+                max_workers=CACHE_REFRESH_POOL_WORKERS[refresh_pool],
+                thread_name_prefix=f"cache-refresh-{refresh_pool}",
+            )
+        return cache_refresh_executors[refresh_pool]
+
+
+def is_token_expired(token_expires_at):
+    # Refreshes reuse the token captured by the request that found the stale cache, which may run out before
+    # the refresh gets a turn; None means the token's expiry isn't known
+    return token_expires_at is not None and token_expires_at <= time()
+
+
+def refresh_cache_file(cache_name, fetch, encode, token_expires_at):
+    try:
+        if is_token_expired(token_expires_at):
+            logger.info(f"Skipping background refresh of {cache_name}, its token expired while it was queued")
+            return
+
+        with exclusive_lock(cache_name):
+            # Another thread or process may have refreshed this cache while we waited for the lock
+            age = get_cache_file_age(cache_name)
+            if age is not None and age < PROVIDER_CACHE_TTL:
+                return
+
+            logger.info(f"Refreshing stale cache file for {cache_name} in the background")
+            fetched_data = fetch()
+
+            if fetched_data is None:
+                logger.warning(f"Background refresh of {cache_name} returned no data, keeping stale cache")
+                return
+
+            store_cache_file(cache_name, encode(fetched_data) if encode else fetched_data)
+            logger.info(f"Background refresh of {cache_name} complete")
+    except Exception:
+        logger.exception(f"Background refresh of {cache_name} failed, keeping stale cache")
+    finally:
+        with cache_refresh_lock:
+            cache_refreshes_in_flight.discard(cache_name)
+
+
+def schedule_cache_refresh(cache_name, fetch, encode, refresh_pool, token_expires_at):
+    if is_token_expired(token_expires_at):
+        logger.info(f"Not refreshing {cache_name} in the background, its token has expired")
+        return
+
+    with cache_refresh_lock:
+        if cache_name in cache_refreshes_in_flight:
+            return
+        cache_refreshes_in_flight.add(cache_name)
+
+    get_cache_refresh_executor(refresh_pool).submit(
+        refresh_cache_file, cache_name, fetch, encode, token_expires_at
+    )
+
+
+def load_or_fetch_cache_file(
+    cache_name,
+    fetch,
+    encode=None,
+    decode=None,
+    cache_kind=None,
+    refresh_pool="default",
+    token_expires_at=None,
+):
+    # Returns cached data if present, otherwise calls fetch() and caches its result.
+    # Concurrent callers for the same cache_name (other threads or processes) wait for
+    # the first caller's fetch to finish and then load its result, rather than fetching again.
+    # Cached data older than PROVIDER_CACHE_TTL is still returned straight away (stale-while-revalidate),
+    # with a refresh scheduled in the background; if that refresh fails the stale copy is kept.
+    # encode / decode convert between the in-memory data and its JSON-serialisable cached form.
+    # refresh_pool picks the background pool (see CACHE_REFRESH_POOL_WORKERS), and token_expires_at is
+    # when the token fetch() uses runs out (unix time), after which there's no point refreshing with it.
+    age = get_cache_file_age(cache_name)
+    data = load_cache_file(cache_name) if age is not None else None
+
+    if data is None:
+        with exclusive_lock(cache_name):
+            age = get_cache_file_age(cache_name)
+            data = load_cache_file(cache_name) if age is not None else None
+
+            if data is None:
+                logger.info(f"No cache file found for {cache_name}, fetching data")
+                fetched_data = fetch()
+                if fetched_data is None:
+                    return None
+
+                data = encode(fetched_data) if encode else fetched_data
+                store_cache_file(cache_name, data)
+                record_cache_freshness(cache_name, "fetched", 0, cache_kind)
+                return fetched_data
+
+    if age < PROVIDER_CACHE_TTL:
+        logger.info(f"Found cache file for {cache_name}, loading this instead of fetching again")
+        record_cache_freshness(cache_name, "fresh", age, cache_kind)
+    else:
+        logger.info(f"Found stale cache file for {cache_name}, serving it and refreshing in the background")
+        record_cache_freshness(cache_name, "stale", age, cache_kind)
+        schedule_cache_refresh(cache_name, fetch, encode, refresh_pool, token_expires_at)
+
+    return decode(data) if decode else data
+
+
+def track_scores_to_records(track_scores):
+    # JSON objects can't have tuple keys, so track scores are stored as [artist, title, score] rows
+    return [[artist, title, score] for (artist, title), score in track_scores.items()]
+
+
+def records_to_track_scores(records):
+    return {(artist, title): score for artist, title, score in records}
@@ -0,0 +1,385 @@
+import os
+import uuid
+import fcntl
+import socket
+import sqlite3
+import logging
+import tempfile
+import threading
+from time import time, sleep
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+
+# disk (default, per container), sqlite (a database file on a volume shared between containers)
+# or redis (anything speaking the Redis protocol). CACHE_URL is the sqlite file path or redis:// URL.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "disk")
+CACHE_URL = os.getenv("CACHE_URL")
+
+# Shared locks are leases, renewed by their holder for as long as it's working, which expire this long after
+# the holder stops renewing them (e.g. it crashed), so a dead holder can't block a cache forever
+CACHE_LOCK_TIMEOUT_SECONDS = int(os.getenv("CACHE_LOCK_TIMEOUT_SECONDS", 60))
+CACHE_LOCK_RENEW_SECONDS = CACHE_LOCK_TIMEOUT_SECONDS / 3
+CACHE_LOCK_POLL_SECONDS = 0.1
+
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "karaokehunt:")
+REDIS_SOCKET_TIMEOUT_SECONDS = 30
+
+##########################################################################
+###########                 Cache Backends                     ###########
+##########################################################################
+
+# Every backend stores opaque bytes by cache name, and provides:
+#   get(name) -> bytes or None
+#   set(name, value, ttl_seconds=None)
+#   get_modified_time(name) -> unix timestamp of the last set(), or None
+#   delete(name)
+#   delete_expired(prefix, ttl_seconds), deleting entries whose name starts with prefix set over ttl_seconds ago,
+#     which must have been set with that ttl_seconds (Redis expires those itself)
+#   lock(name) -> context manager holding a lock on name, across every process using the same backend
+# Encoding (JSON, gzip) is left to the callers in cache.py.
+
+cache_backend = None
+cache_backend_lock = threading.Lock()
+
+
+@contextmanager
+def renewing_lock_lease(renew_lock, name, token):
+    # Extends a shared lock's lease from a background thread until the body finishes, however long that takes.
+    # renew_lock(name, token) returns False if the lock is no longer held with token.
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(CACHE_LOCK_RENEW_SECONDS):
+            try:
+                if not renew_lock(name, token):
+                    logger.warning(f"Cache lock {name} expired before it could be renewed")
+                    return
+            except Exception:
+                logger.exception(f"Failed to renew cache lock {name}, retrying")
+
+    renewal_thread = threading.Thread(target=renew, name=f"cache-lock-renewal-{name}", daemon=True)
+    renewal_thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        renewal_thread.join()
+
+
+class LocalDiskCacheBackend:
+    # Files in TEMP_OUTPUT_DIR, locked with flock, so shared by every process in one container only
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_file_path(self, name):
+        return f"{self.directory}/{name}.json.gz"
+
+    def get(self, name):
+        try:
+            with open(self.get_file_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, name, value, ttl_seconds=None):
+        # Written to a temp file then renamed into place, so readers never see a partial write.
+        # Expiry is left to delete_expired(), by modification time.
+        file_path = self.get_file_path(name)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(value)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def get_modified_time(self, name):
+        try:
+            return os.path.getmtime(self.get_file_path(name))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.unlink(self.get_file_path(name))
+        except FileNotFoundError:
+            pass
+
+    def delete_expired(self, prefix, ttl_seconds):
+        cutoff = time() - ttl_seconds
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith(prefix) and filename.endswith(".json.gz")):
+                continue
+
+            file_path = f"{self.directory}/{filename}"
+            try:
+                if os.path.getmtime(file_path) < cutoff:
+                    os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def lock(self, name):
+        with open(f"{self.directory}/{name}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SQLiteCacheBackend:
+    # A single SQLite database, e.g. on a volume mounted into several containers.
+    # Locks are rows with an owner token and expiry, so they work wherever the database file does.
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.connections = threading.local()
+        self.get_connection().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (name TEXT PRIMARY KEY, value BLOB NOT NULL, updated_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS cache_locks (name TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS cache_entries_updated_at ON cache_entries (updated_at);
+            """
+        )
+
+    def get_connection(self):
+        # sqlite3 connections can't be shared between threads, or survive a fork
+        if getattr(self.connections, "pid", None) != os.getpid():
+            self.connections.connection = sqlite3.connect(self.database_path, timeout=30, isolation_level=None)
+            self.connections.pid = os.getpid()
+        return self.connections.connection
+
+    def get(self, name):
+        row = self.get_connection().execute("SELECT value FROM cache_entries WHERE name = ?", (name,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, name, value, ttl_seconds=None):
+        # Expiry is left to delete_expired(), by updated_at
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (name, value, updated_at) VALUES (?, ?, ?)",
+            (name, value, time()),
+        )
+
+    def get_modified_time(self, name):
+        row = self.get_connection().execute(
+            "SELECT updated_at FROM cache_entries WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, name):
+        self.get_connection().execute("DELETE FROM cache_entries WHERE name = ?", (name,))
+
+    def delete_expired(self, prefix, ttl_seconds):
+        # substr rather than LIKE, as cache names may contain LIKE's wildcards
+        self.get_connection().execute(
+            "DELETE FROM cache_entries WHERE updated_at < ? AND substr(name, 1, ?) = ?",
+            (time() - ttl_seconds, len(prefix), prefix),
+        )
+
+    def try_lock(self, name, token):
+        # Takes the lock if nobody holds it or the holder's lock has expired
+        now = time()
+        cursor = self.get_connection().execute(
+            """
+            INSERT INTO cache_locks (name, token, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at
+            WHERE cache_locks.expires_at < ?
+            """,
+            (name, token, now + CACHE_LOCK_TIMEOUT_SECONDS, now),
+        )
+        return cursor.rowcount == 1
+
+    def renew_lock(self, name, token):
+        cursor = self.get_connection().execute(
+            "UPDATE cache_locks SET expires_at = ? WHERE name = ? AND token = ?",
+            (time() + CACHE_LOCK_TIMEOUT_SECONDS, name, token),
+        )
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def lock(self, name):
+        token = uuid.uuid4().hex
+        while not self.try_lock(name, token):
+            sleep(CACHE_LOCK_POLL_SECONDS)
+
+        try:
+            with renewing_lock_lease(self.renew_lock, name, token):
+                yield
+        finally:
+            self.get_connection().execute("DELETE FROM cache_locks WHERE name = ? AND token = ?", (name, token))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    # Just enough of the Redis protocol (RESP) for the cache: send a command, read its reply
+
+    def __init__(self, host, port, password=None, db=0):
+        self.sock = socket.create_connection((host, port), timeout=REDIS_SOCKET_TIMEOUT_SECONDS)
+        self.reader = self.sock.makefile("rb")
+
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def execute(self, *args):
+        command = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+        self.sock.sendall(b"".join(command))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+
+        reply_type, value = line[:1], line[1:-2]
+
+        if reply_type == b"+":
+            return value.decode("utf-8")
+        if reply_type == b"-":
+            raise RedisError(value.decode("utf-8"))
+        if reply_type == b":":
+            return int(value)
+        if reply_type == b"$":
+            length = int(value)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if reply_type == b"*":
+            length = int(value)
+            if length == -1:
+                return None
+            return [self.read_reply() for _ in range(length)]
+
+        raise RedisError(f"Unexpected reply from redis: {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# Lock renewal and release only touch the lock if it's still held with our token, checked and changed
+# atomically in a script, as it may have expired and been taken by someone else
+REDIS_RENEW_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+REDIS_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisCacheBackend:
+    # Each entry is a hash holding the value and when it was set, so ages can be read without the value
+
+    def __init__(self, url):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname or "localhost"
+        self.port = parsed_url.port or 6379
+        self.password = unquote(parsed_url.password) if parsed_url.password else None
+        self.db = int(parsed_url.path.lstrip("/") or 0)
+        self.connections = threading.local()
+
+    def execute(self, *args):
+        # One connection per thread (re-opened after a fork), retried once if the server dropped it
+        for attempt in range(2):
+            if getattr(self.connections, "pid", None) != os.getpid():
+                self.connections.connection = RedisConnection(self.host, self.port, self.password, self.db)
+                self.connections.pid = os.getpid()
+
+            try:
+                return self.connections.connection.execute(*args)
+            except (ConnectionError, OSError):
+                self.connections.connection.close()
+                self.connections.pid = None
+                if attempt == 1:
+                    raise
+
+    def get_key(self, name):
+        return f"{REDIS_KEY_PREFIX}cache:{name}"
+
+    def get(self, name):
+        return self.execute("HGET", self.get_key(name), "value")
+
+    def set(self, name, value, ttl_seconds=None):
+        self.execute("HSET", self.get_key(name), "value", value, "updated_at", repr(time()))
+        # Redis expires the entry itself, so delete_expired() has nothing to do
+        if ttl_seconds is not None:
+            self.execute("PEXPIRE", self.get_key(name), int(ttl_seconds * 1000))
+
+    def get_modified_time(self, name):
+        updated_at = self.execute("HGET", self.get_key(name), "updated_at")
+        return float(updated_at) if updated_at is not None else None
+
+    def delete(self, name):
+        self.execute("DEL", self.get_key(name))
+
+    def delete_expired(self, prefix, ttl_seconds):
+        pass
+
+    def get_lock_key(self, name):
+        return f"{REDIS_KEY_PREFIX}lock:{name}"
+
+    def renew_lock(self, name, token):
+        return self.execute(
+            "EVAL", REDIS_RENEW_LOCK_SCRIPT, 1, self.get_lock_key(name), token, CACHE_LOCK_TIMEOUT_SECONDS * 1000
+        ) == 1
+
+    @contextmanager
+    def lock(self, name):
+        lock_key = self.get_lock_key(name)
+        token = uuid.uuid4().hex
+        while self.execute("SET", lock_key, token, "NX", "PX", CACHE_LOCK_TIMEOUT_SECONDS * 1000) is None:
+            sleep(CACHE_LOCK_POLL_SECONDS)
+
+        try:
+            with renewing_lock_lease(self.renew_lock, name, token):
+                yield
+        finally:
+            self.execute("EVAL", REDIS_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+def create_cache_backend(backend_name, url):
+    if backend_name == "disk":
+        return LocalDiskCacheBackend(url or TEMP_OUTPUT_DIR)
+    if backend_name == "sqlite":
+        return SQLiteCacheBackend(url or f"{TEMP_OUTPUT_DIR}/cache.sqlite3")
+    if backend_name == "redis":
+        return RedisCacheBackend(url or "redis://localhost:6379/0")
+
+    raise ValueError(f"Unknown CACHE_BACKEND: {backend_name}, expected disk, sqlite or redis")
+
+
+def get_cache_backend():
+    # Created on first use, so a misconfigured backend fails on the first cache access with a clear error
+    global cache_backend
+
+    with cache_backend_lock:
+        if cache_backend is None:
+            cache_backend = create_cache_backend(CACHE_BACKEND, CACHE_URL)
+            logger.info(f"Using {CACHE_BACKEND} cache backend")
+        return cache_backend
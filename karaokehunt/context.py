@@ -0,0 +1,10 @@
+import contextvars
+
+##########################################################################
+###########               Background Job Context               ###########
+##########################################################################
+
+# Set while a background job runs, to a dict with at least the job "id" and "username",
+# so code outside a request (logging, caches) can still tell which user and job it is working for.
+# This module only uses the standard library, so the logging config in app.py can import it before Flask.
+current_job = contextvars.ContextVar("current_job", default=None)
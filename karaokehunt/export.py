@@ -0,0 +1,261 @@
+import io
+import os
+import csv
+import gzip
+import zlib
+import logging
+import threading
+from time import time
+from contextlib import nullcontext
+from collections import OrderedDict
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from flask import Response, jsonify, request, session, current_app as app
+
+from .cache import atomic_open
+from .results import load_sheet_result, get_latest_sheet_result_key
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+CSV_OUTPUT_FILENAME_PREFIX = os.getenv("CSV_OUTPUT_FILENAME_PREFIX")
+
+# When enabled, the first export of each result is also saved as a gzipped CSV, keyed by result key,
+# and later exports of the same result are served straight from that file
+CSV_KEEP_ON_DISK = os.getenv("CSV_KEEP_ON_DISK", "false") == "true"
+CSV_RETENTION_SECONDS = int(os.getenv("CSV_RETENTION_HOURS", 24)) * 3600
+CSV_ROWS_PER_CHUNK = 1000
+CSV_GZIP_LEVEL = 6
+CSV_FILE_READ_SIZE = 65536
+
+RANKINGS_DEFAULT_LIMIT = 100
+RANKINGS_MAX_LIMIT = 1000
+RANKINGS_SORT_ORDER_CACHE_SIZE = 16
+
+##########################################################################
+###########                Streaming CSV Export                ###########
+##########################################################################
+
+
+def get_csv_disk_copy_path(result_key):
+    return f"{TEMP_OUTPUT_DIR}/{CSV_OUTPUT_FILENAME_PREFIX}{result_key}.csv.gz"
+
+
+def prune_old_csv_disk_copies():
+    cutoff = time() - CSV_RETENTION_SECONDS
+    prefix = os.path.basename(CSV_OUTPUT_FILENAME_PREFIX or "")
+
+    for filename in os.listdir(TEMP_OUTPUT_DIR):
+        if not (filename.startswith(prefix) and filename.endswith(".csv.gz")):
+            continue
+
+        file_path = f"{TEMP_OUTPUT_DIR}/{filename}"
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_csv_chunks(header_values, data_values):
+    # Formats rows into CSV text CSV_ROWS_PER_CHUNK rows at a time, so only one chunk is held in memory
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header_values)
+
+    for row_number, row in enumerate(data_values, start=1):
+        writer.writerow(row)
+
+        if row_number % CSV_ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def stream_csv(header_values, data_values, compress, disk_copy_path=None):
+    # Yields the CSV as bytes, gzip encoded if compress is set. If disk_copy_path is given,
+    # a gzipped copy is written alongside and only renamed into place once the whole CSV has been written.
+    compressor = None
+    if compress or disk_copy_path:
+        compressor = zlib.compressobj(CSV_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    with atomic_open(disk_copy_path, "wb") if disk_copy_path else nullcontext() as disk_file:
+        for text_chunk in iter_csv_chunks(header_values, data_values):
+            data = text_chunk.encode("utf-8")
+            compressed_data = compressor.compress(data) if compressor else b""
+
+            if disk_file and compressed_data:
+                disk_file.write(compressed_data)
+
+            if compress:
+                if compressed_data:
+                    yield compressed_data
+            elif data:
+                yield data
+
+        if compressor:
+            compressed_data = compressor.flush()
+            if disk_file:
+                disk_file.write(compressed_data)
+            if compress:
+                yield compressed_data
+
+
+def stream_gzip_file_decompressed(file_path):
+    with gzip.open(file_path, "rb") as f:
+        while True:
+            data = f.read(CSV_FILE_READ_SIZE)
+            if not data:
+                return
+            yield data
+
+
+##########################################################################
+###########            Rankings API & Bulk Exports             ###########
+##########################################################################
+
+# Row orders for non-default sorts, keyed by (result key, sort column index, descending),
+# so every page after the first is just a slice
+rankings_sort_orders = OrderedDict()
+rankings_sort_orders_lock = threading.Lock()
+
+
+def get_rankings_sort_order(result_key, data_values, column_index, descending):
+    cache_key = (result_key, column_index, descending)
+
+    with rankings_sort_orders_lock:
+        if cache_key in rankings_sort_orders:
+            rankings_sort_orders.move_to_end(cache_key)
+            return rankings_sort_orders[cache_key]
+
+    # sorted() is stable, so rows with equal values stay in ranked order
+    sort_order = sorted(
+        range(len(data_values)),
+        key=lambda row_index: data_values[row_index][column_index],
+        reverse=descending,
+    )
+
+    with rankings_sort_orders_lock:
+        rankings_sort_orders[cache_key] = sort_order
+        while len(rankings_sort_orders) > RANKINGS_SORT_ORDER_CACHE_SIZE:
+            rankings_sort_orders.popitem(last=False)
+
+    return sort_order
+
+
+def get_requested_rankings_result():
+    # Returns (result key, header values, data values) for the current user's latest result.
+    # Like /jobs/<id>, another user's result (by username or key) is simply not found.
+    username = session.get("username")
+    result_key = get_latest_sheet_result_key(username) if username else None
+    if request.args.get("username", username) != username or request.args.get("key", result_key) != result_key:
+        return None, None, None
+
+    sheet_result = load_sheet_result(result_key) if result_key else None
+
+    if sheet_result is None:
+        return None, None, None
+
+    return result_key, sheet_result[0], sheet_result[1]
+
+
+def get_requested_column_indices(header_values):
+    # columns is a comma separated list of header names, defaulting to every column
+    if not request.args.get("columns"):
+        return list(range(len(header_values)))
+
+    column_names = request.args["columns"].split(",")
+    unknown_columns = [name for name in column_names if name not in header_values]
+    if unknown_columns:
+        raise ValueError(f"Unknown columns: {', '.join(unknown_columns)}")
+
+    return [header_values.index(name) for name in column_names]
+
+
+def build_arrow_table(header_values, data_values, column_indices):
+    return pyarrow.table(
+        {
+            header_values[column_index]: [row[column_index] for row in data_values]
+            for column_index in column_indices
+        }
+    )
+
+
+with app.app_context():
+
+    @app.route("/api/rankings", methods=["GET"])
+    def get_rankings():
+        result_key, header_values, data_values = get_requested_rankings_result()
+        if result_key is None:
+            return "No karaoke sheet found for this user, please generate one first", 404
+
+        try:
+            column_indices = get_requested_column_indices(header_values)
+            offset = max(int(request.args.get("offset", 0)), 0)
+            limit = min(max(int(request.args.get("limit", RANKINGS_DEFAULT_LIMIT)), 0), RANKINGS_MAX_LIMIT)
+        except ValueError as e:
+            return str(e), 400
+
+        # sort is a header name, prefixed with "-" for descending; without it rows stay in ranked order
+        sort = request.args.get("sort")
+        if sort:
+            descending = sort.startswith("-")
+            sort_column = sort[1:] if descending else sort
+            if sort_column not in header_values:
+                return f"Unknown sort column: {sort_column}", 400
+
+            sort_order = get_rankings_sort_order(
+                result_key, data_values, header_values.index(sort_column), descending
+            )
+            page_rows = [data_values[row_index] for row_index in sort_order[offset : offset + limit]]
+        else:
+            page_rows = data_values[offset : offset + limit]
+
+        return jsonify(
+            {
+                "result_key": result_key,
+                "total": len(data_values),
+                "offset": offset,
+                "limit": limit,
+                "sort": sort,
+                "columns": [header_values[column_index] for column_index in column_indices],
+                "rows": [[row[column_index] for column_index in column_indices] for row in page_rows],
+            }
+        )
+
+    @app.route("/api/rankings/export", methods=["GET"])
+    def export_rankings():
+        export_format = request.args.get("format", "parquet")
+        if export_format not in ("arrow", "parquet"):
+            return "Unsupported export format, use arrow or parquet", 400
+
+        result_key, header_values, data_values = get_requested_rankings_result()
+        if result_key is None:
+            return "No karaoke sheet found for this user, please generate one first", 404
+
+        try:
+            column_indices = get_requested_column_indices(header_values)
+        except ValueError as e:
+            return str(e), 400
+
+        table = build_arrow_table(header_values, data_values, column_indices)
+        buffer = io.BytesIO()
+
+        if export_format == "arrow":
+            with pyarrow.ipc.new_stream(buffer, table.schema) as writer:
+                writer.write_table(table)
+            mimetype = "application/vnd.apache.arrow.stream"
+        else:
+            pyarrow.parquet.write_table(table, buffer)
+            mimetype = "application/vnd.apache.parquet"
+
+        response = Response(buffer.getvalue(), mimetype=mimetype)
+        response.headers["Content-Disposition"] = (
+            f'attachment; filename="karaokehunt_rankings_{result_key}.{export_format}"'
+        )
+        response.set_etag(f"{result_key}-{export_format}-{request.args.get('columns', '')}")
+        return response.make_conditional(request)
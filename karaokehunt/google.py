@@ -1,15 +1,36 @@
 import os
+import json
+import hashlib
 from datetime import datetime
 import logging
+import threading
+import contextvars
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from flask import redirect, request, session, url_for, current_app as app, g
 
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
 
+from .cache import load_cache_file, store_cache_file
+from .googleapi import get_google_service
+from .progress import publish_progress
+from .metrics import record_provider_call
+from .tracing import span
+
 logger = logging.getLogger("karaokehunt")
 
+# Row uploads are split into chunks bounded by rows and approximate payload size, well under the
+# Sheets API request size limit, and uploaded concurrently within the per-user write quota
+GOOGLE_SHEETS_CHUNK_ROWS = int(os.getenv("GOOGLE_SHEETS_CHUNK_ROWS", 5000))
+GOOGLE_SHEETS_CHUNK_BYTES = int(os.getenv("GOOGLE_SHEETS_CHUNK_BYTES", 2000000))
+GOOGLE_SHEETS_UPLOAD_WORKERS = int(os.getenv("GOOGLE_SHEETS_UPLOAD_WORKERS", 4))
+GOOGLE_SHEETS_REQUESTS_PER_SECOND = float(os.getenv("GOOGLE_SHEETS_REQUESTS_PER_SECOND", 1))
+GOOGLE_SHEETS_CHUNK_RETRIES = int(os.getenv("GOOGLE_SHEETS_CHUNK_RETRIES", 3))
+GOOGLE_SHEETS_DIFF_MERGE_GAP = 5
+
 ##########################################################################
 ################           Google Auth Flow                 ##############
 ##########################################################################
@@ -58,31 +79,13 @@ with app.app_context():
 
 
 ##########################################################################
-###########          Google Sheet Find & Create                ###########
+###########               Google Sheet Create                  ###########
 ##########################################################################
 
 
-def find_google_sheet_id(sheet_title, creds):
-    logger.info(f"Finding google sheet with title: {sheet_title}")
-    service = build("drive", "v3", credentials=creds)
-    escaped_sheet_title = sheet_title.replace("'", "\\'")  # Escape single quotes
-    query = "mimeType='application/vnd.google-apps.spreadsheet' and trashed=false and name='{0}'".format(
-        escaped_sheet_title
-    )
-    results = (
-        service.files().list(q=query, fields="nextPageToken, files(id, name)").execute()
-    )
-    items = results.get("files", [])
-
-    if items:
-        return items[0]["id"]
-    else:
-        return None
-
-
 def create_google_sheet(title, creds):
     logger.info(f"Creating google sheet with title: {title}")
-    service = build("sheets", "v4", credentials=creds)
+    service = get_google_service("sheets", "v4", creds)
     spreadsheet = {"properties": {"title": title}}
     spreadsheet = (
         service.spreadsheets()
@@ -97,36 +100,151 @@ def create_google_sheet(title, creds):
 ##########################################################################
 
 
+class RateLimiter:
+    # Spaces out calls across threads so at most requests_per_second are started each second
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_request_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            wait_seconds = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+
+
+def get_column_letter(column_number):
+    # 1 -> A, 26 -> Z, 27 -> AA
+    letters = ""
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def split_rows_into_chunks(data_values, max_rows, max_bytes):
+    # Yields (first row index, rows) chunks bounded by both row count and approximate JSON payload size
+    chunk = []
+    chunk_start = 0
+    chunk_bytes = 0
+
+    for index, row in enumerate(data_values):
+        row_bytes = sum(len(str(value)) for value in row) + 4 * len(row)
+
+        if chunk and (len(chunk) >= max_rows or chunk_bytes + row_bytes > max_bytes):
+            yield chunk_start, chunk
+            chunk = []
+            chunk_start = index
+            chunk_bytes = 0
+
+        chunk.append(row)
+        chunk_bytes += row_bytes
+
+    if chunk:
+        yield chunk_start, chunk
+
+
+def is_retryable_sheets_error(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in (429, 500, 502, 503, 504)
+    return isinstance(error, (OSError, TimeoutError))
+
+
+def execute_with_retries(rate_limiter, description, make_request):
+    # make_request builds a fresh googleapiclient request each attempt, on the calling thread's service
+    for attempt in range(GOOGLE_SHEETS_CHUNK_RETRIES + 1):
+        rate_limiter.wait()
+        try:
+            with span("google_sheets.request", category="http", description=description, attempt=attempt):
+                response = make_request().execute()
+            record_provider_call("google_sheets", True)
+            return response
+        except Exception as e:
+            record_provider_call("google_sheets", False)
+            if attempt == GOOGLE_SHEETS_CHUNK_RETRIES or not is_retryable_sheets_error(e):
+                raise
+
+            backoff_seconds = 2**attempt
+            logger.warning(
+                f"{description} failed ({e}), retrying in {backoff_seconds}s"
+            )
+            sleep(backoff_seconds)
+
+
+def upload_rows_chunk(get_service, rate_limiter, spreadsheet_id, sheet_range, rows):
+    execute_with_retries(
+        rate_limiter,
+        f"Writing rows {sheet_range} to google sheet",
+        lambda: get_service().spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id,
+            range=sheet_range,
+            valueInputOption="RAW",
+            body={"values": rows},
+        ),
+    )
+
+
 def write_rows_to_google_sheet(
-    spreadsheet_id, google_creds, header_values, data_values
+    spreadsheet_id, google_creds, header_values, data_values, get_service=None
 ):
     logger.info(f"Writing karaoke songs to google sheet with ID: {spreadsheet_id}")
-    service = build("sheets", "v4", credentials=google_creds)
 
-    sheet_metadata = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+    # get_service returns a sheets service for the calling thread; a fake service can be passed in for testing
+    if get_service is None:
+        get_service = lambda: get_google_service("sheets", "v4", google_creds)
+
+    service = get_service()
+
+    sheet_metadata = (
+        service.spreadsheets()
+        .get(spreadsheetId=spreadsheet_id, fields="sheets.properties")
+        .execute()
+    )
 
     sheets = sheet_metadata.get("sheets", "")
     sheet_id = sheets[0].get("properties", {}).get("sheetId", 0)
 
+    column_count = len(header_values)
+    last_column = get_column_letter(column_count)
+
     headerRowValues = []
     for cell in header_values:
         headerRowValues.append(
             {
+                "userEnteredValue": {"stringValue": cell},
                 "userEnteredFormat": {
                     "wrapStrategy": "WRAP",
                     "textFormat": {"fontSize": 8, "bold": True},
-                }
+                },
             }
         )
 
-    setHeaderFormatting = {
+    # Size the grid up front so concurrently uploaded chunks can land in any order
+    setGridSize = {
+        "updateSheetProperties": {
+            "properties": {
+                "sheetId": sheet_id,
+                "gridProperties": {
+                    "rowCount": len(data_values) + 1,
+                    "columnCount": max(column_count, 26),
+                },
+            },
+            "fields": "gridProperties(rowCount,columnCount)",
+        }
+    }
+
+    setHeaderValuesAndFormatting = {
         "updateCells": {
             "range": {
                 "sheetId": sheet_id,
                 "startRowIndex": 0,
                 "endRowIndex": 1,
                 "startColumnIndex": 0,
-                "endColumnIndex": 20,
+                "endColumnIndex": column_count,
             },
             "rows": [{"values": headerRowValues}],
             "fields": "*",
@@ -134,39 +252,66 @@ def write_rows_to_google_sheet(
     }
 
     service.spreadsheets().batchUpdate(
-        spreadsheetId=spreadsheet_id, body={"requests": [setHeaderFormatting]}
+        spreadsheetId=spreadsheet_id,
+        body={"requests": [setGridSize, setHeaderValuesAndFormatting]},
     ).execute()
 
-    header_body = {"values": [header_values]}
+    rate_limiter = RateLimiter(GOOGLE_SHEETS_REQUESTS_PER_SECOND)
+    chunks = list(
+        split_rows_into_chunks(data_values, GOOGLE_SHEETS_CHUNK_ROWS, GOOGLE_SHEETS_CHUNK_BYTES)
+    )
 
-    service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range="A1:Z1",
-        valueInputOption="RAW",
-        body=header_body,
-    ).execute()
+    logger.info(
+        f"Uploading {len(data_values)} rows to google sheet in {len(chunks)} chunks with {GOOGLE_SHEETS_UPLOAD_WORKERS} workers"
+    )
 
-    data_body = {"values": data_values}
-    service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f"A2:Z{len(data_values) + 1}",
-        valueInputOption="RAW",
-        body=data_body,
-    ).execute()
+    with ThreadPoolExecutor(max_workers=GOOGLE_SHEETS_UPLOAD_WORKERS) as executor:
+        futures = {}
+        for chunk_start, rows in chunks:
+            # Data starts on row 2, below the header
+            sheet_range = f"A{chunk_start + 2}:{last_column}{chunk_start + len(rows) + 1}"
+            # Each chunk runs in a copy of this context, so its logs and trace spans stay with this job
+            future = executor.submit(
+                contextvars.copy_context().run,
+                upload_rows_chunk,
+                get_service,
+                rate_limiter,
+                spreadsheet_id,
+                sheet_range,
+                rows,
+            )
+            futures[future] = sheet_range
+
+        failed_ranges = []
+        for completed_chunks, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to write rows {futures[future]} to google sheet: {e}")
+                failed_ranges.append(futures[future])
+
+            publish_progress(
+                "upload",
+                f"Uploaded {completed_chunks} of {len(chunks)} chunks to Google Sheets",
+                chunks=completed_chunks,
+                total=len(chunks),
+            )
+
+    if failed_ranges:
+        raise RuntimeError(f"Failed to write rows {', '.join(failed_ranges)} to google sheet")
+
+    return sheet_id
 
 
 def create_and_write_google_sheet(google_token, username, header_values, data_values):
-    logger.info("Creating (or finding existing) google sheet and writing rows to it")
+    logger.info("Creating google sheet and writing rows to it")
     google_creds = Credentials(token=google_token["access_token"])
 
     now = datetime.now()
     date_time = now.strftime("%Y-%m-%d %H:%M:%S")
     
     sheet_title = f"{username}'s KaraokeHunt Sheet {date_time}"
-    spreadsheet_id = find_google_sheet_id(sheet_title, google_creds)
-
-    if spreadsheet_id is None:
-        spreadsheet_id = create_google_sheet(sheet_title, google_creds)
+    spreadsheet_id = create_google_sheet(sheet_title, google_creds)
 
     write_rows_to_google_sheet(spreadsheet_id, google_creds, header_values, data_values)
 
@@ -175,3 +320,182 @@ def create_and_write_google_sheet(google_token, username, header_values, data_va
     )
     sheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
     return sheet_url
+
+
+##########################################################################
+###########         Incremental Update of Existing Sheet       ###########
+##########################################################################
+
+# In this mode each user keeps a single sheet. We store a fingerprint of every row last written to it,
+# and on regeneration only send the row ranges whose contents changed. Edits made to the sheet by hand
+# aren't detected, and a changed header (e.g. a provider added or removed) rewrites the whole sheet.
+
+
+def fingerprint_row(row):
+    return hashlib.blake2b(
+        json.dumps(row, separators=(",", ":")).encode("utf-8"), digest_size=8
+    ).hexdigest()
+
+
+def get_changed_row_ranges(old_fingerprints, new_fingerprints):
+    # Returns (start index, end index exclusive) ranges of rows which differ, merging ranges separated
+    # by only a few unchanged rows so we send fewer, slightly larger ranges
+    ranges = []
+
+    for index, fingerprint in enumerate(new_fingerprints):
+        if index < len(old_fingerprints) and old_fingerprints[index] == fingerprint:
+            continue
+
+        if ranges and index - ranges[-1][1] <= GOOGLE_SHEETS_DIFF_MERGE_GAP:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+
+    return ranges
+
+
+def write_changed_rows_to_google_sheet(
+    spreadsheet_id, sheet_id, google_creds, header_values, data_values, state
+):
+    service = get_google_service("sheets", "v4", google_creds)
+    rate_limiter = RateLimiter(GOOGLE_SHEETS_REQUESTS_PER_SECOND)
+    last_column = get_column_letter(len(header_values))
+
+    new_fingerprints = [fingerprint_row(row) for row in data_values]
+    old_row_count = len(state["row_fingerprints"])
+    changed_ranges = get_changed_row_ranges(state["row_fingerprints"], new_fingerprints)
+
+    logger.info(
+        f"Updating existing google sheet {spreadsheet_id}: {len(changed_ranges)} changed ranges, "
+        f"{sum(end - start for start, end in changed_ranges)} of {len(data_values)} rows changed"
+    )
+
+    if len(data_values) > old_row_count:
+        execute_with_retries(
+            rate_limiter,
+            "Resizing google sheet",
+            lambda: service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={
+                    "requests": [
+                        {
+                            "updateSheetProperties": {
+                                "properties": {
+                                    "sheetId": sheet_id,
+                                    "gridProperties": {"rowCount": len(data_values) + 1},
+                                },
+                                "fields": "gridProperties.rowCount",
+                            }
+                        }
+                    ]
+                },
+            ),
+        )
+
+    # Changed ranges are grouped into values.batchUpdate calls of at most GOOGLE_SHEETS_CHUNK_ROWS rows each
+    batches = []
+    batch = []
+    batch_rows = 0
+    for start, end in changed_ranges:
+        if batch and batch_rows + (end - start) > GOOGLE_SHEETS_CHUNK_ROWS:
+            batches.append(batch)
+            batch = []
+            batch_rows = 0
+
+        batch.append(
+            {
+                "range": f"A{start + 2}:{last_column}{end + 1}",
+                "values": data_values[start:end],
+            }
+        )
+        batch_rows += end - start
+
+    if batch:
+        batches.append(batch)
+
+    for batch_number, batch in enumerate(batches, start=1):
+        publish_progress(
+            "upload",
+            f"Writing changed rows to Google Sheets, batch {batch_number} of {len(batches)}",
+            batches=batch_number,
+            total=len(batches),
+        )
+        execute_with_retries(
+            rate_limiter,
+            f"Writing {len(batch)} changed ranges to google sheet",
+            lambda: service.spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"valueInputOption": "RAW", "data": batch},
+            ),
+        )
+
+    # Clear any rows left over from a previous, longer ranking
+    if len(data_values) < old_row_count:
+        execute_with_retries(
+            rate_limiter,
+            "Clearing leftover google sheet rows",
+            lambda: service.spreadsheets().values().clear(
+                spreadsheetId=spreadsheet_id,
+                range=f"A{len(data_values) + 2}:{last_column}{old_row_count + 1}",
+                body={},
+            ),
+        )
+
+    return new_fingerprints
+
+
+def update_existing_google_sheet(google_token, username, header_values, data_values):
+    logger.info("Updating existing google sheet with changed rows, or creating one if needed")
+    google_creds = Credentials(token=google_token["access_token"])
+    state_cache_name = f"google_sheet_state_{username}"
+    state = load_cache_file(state_cache_name)
+
+    spreadsheet_id = state["spreadsheet_id"] if state is not None else None
+    sheet_id = state["sheet_id"] if state is not None else None
+    row_fingerprints = None
+
+    if spreadsheet_id is not None and state["header"] == header_values:
+        try:
+            row_fingerprints = write_changed_rows_to_google_sheet(
+                spreadsheet_id, sheet_id, google_creds, header_values, data_values, state
+            )
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logger.info(f"Existing google sheet {spreadsheet_id} no longer exists, creating a new one")
+            spreadsheet_id = None
+
+    if row_fingerprints is None:
+        # First run, deleted sheet or changed columns, so (re)write the whole sheet
+        if spreadsheet_id is not None:
+            logger.info("Sheet columns have changed since the last write, rewriting the whole sheet")
+            try:
+                get_google_service("sheets", "v4", google_creds).spreadsheets().values().clear(
+                    spreadsheetId=spreadsheet_id, range="A:ZZ", body={}
+                ).execute()
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                spreadsheet_id = None
+
+        if spreadsheet_id is None:
+            spreadsheet_id = create_google_sheet(f"{username}'s KaraokeHunt Sheet", google_creds)
+
+        sheet_id = write_rows_to_google_sheet(
+            spreadsheet_id, google_creds, header_values, data_values
+        )
+        row_fingerprints = [fingerprint_row(row) for row in data_values]
+
+    store_cache_file(
+        state_cache_name,
+        {
+            "spreadsheet_id": spreadsheet_id,
+            "sheet_id": sheet_id,
+            "header": header_values,
+            "row_fingerprints": row_fingerprints,
+        },
+    )
+
+    sheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
+    logger.info(f"Google Sheet updated for user {username}: {sheet_url}")
+    return sheet_url
@@ -0,0 +1,111 @@
+import os
+import json
+import logging
+import threading
+from time import perf_counter
+from functools import lru_cache
+from collections import OrderedDict
+
+from flask import has_request_context, g
+
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+logger = logging.getLogger("karaokehunt")
+
+# Service objects (and their HTTP transports) kept per thread, most recently used first out
+GOOGLE_SERVICES_PER_THREAD = 16
+
+# Overrides the base URL of every Google API, to run against a stand-in server, e.g. loadtest/mock_providers.py
+GOOGLE_API_ENDPOINT = os.getenv("GOOGLE_API_ENDPOINT")
+
+# Every Google API the app calls, so the discovery documents can be preloaded at startup
+GOOGLE_APIS = [("drive", "v3"), ("sheets", "v4"), ("youtube", "v3")]
+
+##########################################################################
+###########            Google API Service Clients              ###########
+##########################################################################
+
+# googleapiclient service objects and httplib2 transports are not thread safe,
+# so each thread gets its own pool of services keyed by API and access token
+google_services = threading.local()
+
+google_client_stats = {"builds": 0, "reuses": 0, "build_seconds": 0.0, "build_seconds_saved": 0.0}
+google_client_stats_lock = threading.Lock()
+google_build_seconds = {}
+google_discovery_load_seconds = {}
+
+
+@lru_cache(maxsize=None)
+def load_discovery_document(service_name, version):
+    # Uses the discovery documents bundled with googleapiclient, parsed once per process
+    load_start = perf_counter()
+    document = discovery_cache.get_static_doc(service_name, version)
+    if document is None:
+        raise ValueError(f"No static discovery document found for {service_name} {version}")
+
+    document = json.loads(document)
+    google_discovery_load_seconds[f"{service_name} {version}"] = perf_counter() - load_start
+
+    logger.info(f"Loaded discovery document for google {service_name} {version}")
+    return document
+
+
+def preload_discovery_documents():
+    for service_name, version in GOOGLE_APIS:
+        load_discovery_document(service_name, version)
+
+
+def record_google_client_build_saved(api, seconds_saved, reused):
+    with google_client_stats_lock:
+        if reused:
+            google_client_stats["reuses"] += 1
+        google_client_stats["build_seconds_saved"] += seconds_saved
+
+    if has_request_context():
+        g.google_client_build_seconds_saved = g.get("google_client_build_seconds_saved", 0.0) + seconds_saved
+
+    logger.debug(
+        f"{'Reused' if reused else 'Built'} google {api} client, saved ~{seconds_saved * 1000:.1f}ms of build overhead"
+    )
+
+
+def get_google_service(service_name, version, credentials):
+    api = f"{service_name} {version}"
+    service_key = (service_name, version, credentials.token)
+
+    if not hasattr(google_services, "pool"):
+        google_services.pool = OrderedDict()
+    pool = google_services.pool
+
+    # Saved overhead compares against build(), which fetches and parses the discovery document every time
+    if service_key in pool:
+        pool.move_to_end(service_key)
+        record_google_client_build_saved(
+            api,
+            google_build_seconds.get(api, 0.0) + google_discovery_load_seconds.get(api, 0.0),
+            reused=True,
+        )
+        return pool[service_key]
+
+    discovery_preloaded = api in google_discovery_load_seconds
+    discovery_document = load_discovery_document(service_name, version)
+
+    build_start = perf_counter()
+    client_options = {"api_endpoint": GOOGLE_API_ENDPOINT} if GOOGLE_API_ENDPOINT else None
+    service = build_from_document(discovery_document, credentials=credentials, client_options=client_options)
+    build_seconds = perf_counter() - build_start
+
+    with google_client_stats_lock:
+        google_client_stats["builds"] += 1
+        google_client_stats["build_seconds"] += build_seconds
+        google_build_seconds[api] = build_seconds
+
+    if discovery_preloaded:
+        record_google_client_build_saved(api, google_discovery_load_seconds[api], reused=False)
+
+    pool[service_key] = service
+    while len(pool) > GOOGLE_SERVICES_PER_THREAD:
+        pool.popitem(last=False)
+
+    return service
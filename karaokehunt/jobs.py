@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import uuid
+import socket
+import hashlib
+import logging
+import threading
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify, session, has_request_context, g, current_app as app
+
+from .cache import atomic_open
+from .context import current_job
+from .metrics import jobs_total
+from .tracing import TRACING, start_trace, finish_trace
+from .profiling import profile_job
+from .memory import memory_profile_job
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+JOBS_DIR = f"{TEMP_OUTPUT_DIR}/jobs"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_HOURS", 168)) * 3600
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+##########################################################################
+###########                Background Job Queue                ###########
+##########################################################################
+
+# Jobs run on a local worker pool. Their state (never their params, which hold user tokens) is persisted
+# as a small JSON file per job, so any worker process can serve status and results for any job.
+
+job_executor = None
+job_executor_lock = threading.Lock()
+
+# (username, params fingerprint) -> job id for jobs queued or running in this process,
+# so a double-click or second tab joins the existing job instead of starting another
+active_jobs = {}
+
+
+def get_job_executor():
+    # Created on first use rather than at import, so no threads exist before a forking server forks
+    global job_executor
+
+    with job_executor_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        return job_executor
+
+
+def get_job_file_path(job_id):
+    return f"{JOBS_DIR}/{job_id}.json"
+
+
+def save_job_state(job_state):
+    job_state["updated_at"] = time()
+    with atomic_open(get_job_file_path(job_state["id"]), "w", encoding="utf-8") as f:
+        json.dump(job_state, f)
+
+
+def is_job_local(job_state):
+    # Whether the job is (or was) run by this process
+    return job_state.get("hostname") == socket.gethostname() and job_state.get("pid") == os.getpid()
+
+
+def is_job_process_alive(job_state):
+    if job_state.get("hostname") != socket.gethostname():
+        return True
+
+    try:
+        os.kill(job_state["pid"], 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def load_job_state(job_id):
+    if not JOB_ID_PATTERN.match(job_id or ""):
+        return None
+
+    try:
+        with open(get_job_file_path(job_id), "r", encoding="utf-8") as f:
+            job_state = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    # A job left queued or running by a process which has since exited will never finish
+    if job_state["status"] in ("queued", "running") and not is_job_process_alive(job_state):
+        job_state["status"] = "interrupted"
+        job_state["error"] = "The server restarted before this job finished, please try again"
+
+    return job_state
+
+
+def prune_old_jobs():
+    cutoff = time() - JOB_RETENTION_SECONDS
+    for filename in os.listdir(JOBS_DIR):
+        file_path = f"{JOBS_DIR}/{filename}"
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_job(job_state, run, params, active_key):
+    token = current_job.set(job_state)
+    trace_token = None
+    if TRACING != "off":
+        trace_token = start_trace(
+            job_state["id"],
+            job_state["type"],
+            username=job_state["username"],
+            request_id=job_state.get("request_id"),
+        )
+
+    try:
+        job_state["status"] = "running"
+        job_state["started_at"] = time()
+        save_job_state(job_state)
+        logger.info(f"Job {job_state['id']} ({job_state['type']}) started")
+
+        with profile_job(job_state), memory_profile_job(job_state):
+            job_state["result"] = run(params)
+        job_state["status"] = "finished"
+        logger.info(f"Job {job_state['id']} finished")
+    except Exception as e:
+        logger.exception(f"Job {job_state['id']} failed")
+        job_state["status"] = "failed"
+        job_state["error"] = str(e)
+    finally:
+        job_state["finished_at"] = time()
+        save_job_state(job_state)
+        jobs_total.inc(type=job_state["type"], status=job_state["status"])
+
+        with job_executor_lock:
+            active_jobs.pop(active_key, None)
+        if trace_token is not None:
+            finish_trace(trace_token, status=job_state["status"])
+        current_job.reset(token)
+
+
+def enqueue_job(username, job_type, run, params):
+    # run(params) is called on a worker thread and its (JSON-serialisable) return value stored as the job result
+    params_fingerprint = hashlib.sha256(
+        json.dumps([job_type, params], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    active_key = (username, params_fingerprint)
+
+    with job_executor_lock:
+        if active_key in active_jobs:
+            logger.info(f"Identical job {active_jobs[active_key]} already in progress, returning it")
+            return active_jobs[active_key]
+
+        job_state = {
+            "id": uuid.uuid4().hex,
+            "type": job_type,
+            "username": username,
+            "status": "queued",
+            "created_at": time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+            "pid": os.getpid(),
+            "hostname": socket.gethostname(),
+            # The request which started the job, so its logs and trace can be found from the job
+            "request_id": g.get("request_id") if has_request_context() else None,
+        }
+        active_jobs[active_key] = job_state["id"]
+
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    prune_old_jobs()
+    save_job_state(job_state)
+
+    get_job_executor().submit(run_job, job_state, run, params, active_key)
+    logger.info(f"Enqueued {job_type} job {job_state['id']}")
+    return job_state["id"]
+
+
+with app.app_context():
+
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    def get_job_status(job_id):
+        job_state = load_job_state(job_id)
+        if job_state is None or job_state["username"] != session.get("username"):
+            return "Job not found", 404
+
+        return jsonify(
+            {
+                key: job_state.get(key)
+                for key in [
+                    "id",
+                    "type",
+                    "status",
+                    "created_at",
+                    "started_at",
+                    "finished_at",
+                    "error",
+                    "progress",
+                    "provider_data_freshness",
+                ]
+            }
+        )
+
+    @app.route("/jobs/<job_id>/result", methods=["GET"])
+    def get_job_result(job_id):
+        job_state = load_job_state(job_id)
+        if job_state is None or job_state["username"] != session.get("username"):
+            return "Job not found", 404
+
+        if job_state["status"] in ("failed", "interrupted"):
+            return job_state["error"], 500
+
+        if job_state["status"] != "finished":
+            return jsonify({"id": job_id, "status": job_state["status"]}), 202
+
+        # Generation jobs can't touch the session themselves, so remember the output link once it's collected
+        if job_state["result"] and "open_sheet_url" in job_state["result"]:
+            session["open_sheet_url"] = job_state["result"]["open_sheet_url"]
+
+        return jsonify(job_state["result"])
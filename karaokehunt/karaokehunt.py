@@ -5,7 +5,14 @@ import string
 import logging
 from coolname import generate_slug
 
+from time import perf_counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from werkzeug.http import is_resource_modified
+
 from flask import (
+    Response,
+    send_file,
     redirect,
     request,
     session,
@@ -26,6 +33,15 @@ from karaokehunt.utils import *
 from karaokehunt.google import *
 from karaokehunt.applemusic import *
 from karaokehunt.karaokenerds import *
+from karaokehunt.cache import get_cache_file_modified_time
+from karaokehunt.export import *
+from karaokehunt.results import *
+from karaokehunt.jobs import *
+from karaokehunt.progress import *
+from karaokehunt.warmup import *
+from karaokehunt.metrics import time_stage, stage_duration_seconds
+from karaokehunt.tracing import TRACING, span, start_trace, finish_trace
+from karaokehunt.memory import memory_stage, record_deep_sizes
 
 # autopep8: on
 
@@ -56,10 +72,8 @@ def home():
         open_sheet_url = session["open_sheet_url"]
         open_sheet_class = "visible"
 
-    applemusic_developer_token = session.get("applemusic_developer_token")
-    if not applemusic_developer_token:
-        applemusic_developer_token = generate_developer_token()
-        session["applemusic_developer_token"] = applemusic_developer_token
+    # Signed once per process and reused until shortly before expiry, so no need to keep it in the session
+    applemusic_developer_token = generate_developer_token()
 
     spotify_authenticated = (
         "spotify_authenticated" if session.get("spotify_authenticated") else ""
@@ -102,7 +116,7 @@ def home():
 
 
 def calculate_songs_rows(
-    all_karaoke_songs,
+    karaoke_songs_index,
     include_zero_score,
     lastfm_artist_playcounts,
     lastfm_track_playcounts,
@@ -159,42 +173,23 @@ def calculate_songs_rows(
     # Sort by the last column, which will either be the combined score or a single provider track score
     sort_column = len(header_values) - 1
 
-    # Combine track data
+    # Last.fm and Spotify data is already reduced to score maps by the provider fetchers:
+    # lowercased artist -> score, and (lowercased artist, lowercased title) -> score
     lastfm_artist_playcounts_simple = {}
     lastfm_track_playcounts_simple = {}
     if lastfm_artist_playcounts is not None:
-        lastfm_artist_playcounts_simple = {
-            artist["name"].lower(): artist["playcount"]
-            for artist in lastfm_artist_playcounts
-        }
+        lastfm_artist_playcounts_simple = lastfm_artist_playcounts
 
     if lastfm_track_playcounts is not None:
-        lastfm_track_playcounts_simple = {
-            (track["artist"]["name"].lower(), track["name"].lower()): int(
-                track["playcount"]
-            )
-            for track in lastfm_track_playcounts
-        }
+        lastfm_track_playcounts_simple = lastfm_track_playcounts
 
     spotify_artist_scores_simple = {}
     spotify_track_scores_simple = {}
     if spotify_artist_scores is not None:
-        spotify_artist_scores_simple = {
-            artist["name"].lower(): artist["popularity"]
-            for artist in spotify_artist_scores
-        }
+        spotify_artist_scores_simple = spotify_artist_scores
 
     if spotify_track_scores is not None:
-        for track in spotify_track_scores:
-            try:
-                spotify_track_scores_simple[
-                    (
-                        track["album"]["artists"][0]["name"].lower(),
-                        track["name"].lower(),
-                    )
-                ] = track["popularity"]
-            except:
-                print(f'Failed to add track {track["name"]} as it had no album artists')
+        spotify_track_scores_simple = spotify_track_scores
 
     applemusic_artist_scores_simple = {}
     applemusic_track_scores_simple = {}
@@ -225,12 +220,8 @@ def calculate_songs_rows(
 
     data_values = []
 
-    for song in all_karaoke_songs:
-        brands_list = song["Brands"].split(",")
-        artist_lower = song["Artist"].lower()
-        title_lower = song["Title"].lower()
-
-        popularity = len(brands_list)
+    # See build_karaoke_songs_index() for what each catalog entry holds
+    for artist, title, brands, artist_lower, title_lower, popularity in karaoke_songs_index:
 
         lastfm_artist_playcount_simple = 0
         lastfm_track_playcount_simple = 0
@@ -269,7 +260,7 @@ def calculate_songs_rows(
             youtube_track_scores_simple.get((artist_lower, title_lower), 0)
         )
 
-        song_values = [song["Artist"], song["Title"], song["Brands"], popularity]
+        song_values = [artist, title, brands, popularity]
 
         combined_artist_score = 0
         combined_track_score = 0
@@ -340,15 +331,71 @@ with app.app_context():
 
     @app.route("/fetch_csv")
     def fetch_csv():
-        username = request.args.get("username")
-        return send_from_directory(
-            TEMP_OUTPUT_DIR, f"{CSV_OUTPUT_FILENAME_PREFIX}{username}.csv"
+        # The username parameter only names the download, other users' sheets are not found
+        username = session.get("username")
+        if request.args.get("username", username) != username:
+            return "No karaoke sheet found for this user, please generate one first", 404
+
+        result_key = get_latest_sheet_result_key(username)
+        result_modified_time = (
+            get_cache_file_modified_time(f"sheet_result_{result_key}") if result_key else None
         )
 
+        if result_modified_time is None:
+            return "No karaoke sheet found for this user, please generate one first", 404
+
+        # A result's rows never change, so its key makes a strong ETag (one per content encoding)
+        # and the time it was calculated a stable Last-Modified, letting browsers and proxies revalidate cheaply
+        compress = "gzip" in request.accept_encodings
+        etag = f"{result_key}-gzip" if compress else result_key
+        last_modified = datetime.fromtimestamp(result_modified_time, tz=timezone.utc)
+
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            download_name = f"{os.path.basename(CSV_OUTPUT_FILENAME_PREFIX or '')}{username}.csv"
+            disk_copy_path = get_csv_disk_copy_path(result_key)
+
+            if CSV_KEEP_ON_DISK and os.path.exists(disk_copy_path):
+                if compress:
+                    response = send_file(
+                        disk_copy_path, mimetype="text/csv", download_name=download_name, etag=False
+                    )
+                    response.headers["Content-Encoding"] = "gzip"
+                else:
+                    response = Response(stream_gzip_file_decompressed(disk_copy_path), mimetype="text/csv")
+            else:
+                if CSV_KEEP_ON_DISK:
+                    prune_old_csv_disk_copies()
+
+                # The result may have expired and been swept since its modified time was read
+                sheet_result = load_sheet_result(result_key)
+                if sheet_result is None:
+                    return "No karaoke sheet found for this user, please generate one first", 404
+
+                header_values, data_values = sheet_result
+                response = Response(
+                    stream_csv(
+                        header_values,
+                        data_values,
+                        compress,
+                        disk_copy_path if CSV_KEEP_ON_DISK else None,
+                    ),
+                    mimetype="text/csv",
+                )
+                if compress:
+                    response.headers["Content-Encoding"] = "gzip"
+
+            response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        response.vary.add("Accept-Encoding")
+        return response
+
     @app.route("/generate_sheet")
     def generate_sheet():
-        include_zero_score = request.args.get("includeZeroScoreSongs")
-
         if (
             not session.get("spotify_authenticated")
             and not session.get("lastfm_authenticated")
@@ -357,94 +404,191 @@ with app.app_context():
         ):
             return "At least one music data source is required", 401
 
-        all_karaoke_songs = load_karaoke_songs()
-
-        lastfm_artist_playcounts = None
-        lastfm_track_playcounts = None
-        spotify_artist_scores = None
-        spotify_track_scores = None
-        applemusic_artists = None
-        applemusic_tracks = None
-        youtube_liked_songs = None
+        # Everything the generation needs from the session is captured here, as the job runs outside this request
+        params = {
+            "username": g.username,
+            "include_zero_score": request.args.get("includeZeroScoreSongs"),
+            "update_existing_sheet": request.args.get("updateExistingSheet"),
+            "lastfm_username": None,
+            "spotify_access_token": None,
+            "spotify_token_expires_at": None,
+            "applemusic_music_user_token": None,
+            "youtube_username": None,
+            "youtube_token": None,
+            "google_token": None,
+        }
 
         if session.get("lastfm_authenticated"):
-            print("Last.fm auth found, loading lastfm data")
-            lastfm_artist_playcounts = get_top_artists_lastfm(
-                session.get("lastfm_username")
-            )
-            lastfm_track_playcounts = get_top_tracks_lastfm(
-                session.get("lastfm_username")
-            )
+            params["lastfm_username"] = session.get("lastfm_username")
 
         if session.get("spotify_authenticated"):
-            print("Spotify auth found, loading spotify data")
-            spotify_auth_token = session.get("spotify_auth_token")
-            spotify_auth_token = spotify_auth_token["access_token"]
+            params["spotify_access_token"] = session.get("spotify_auth_token")["access_token"]
+            params["spotify_token_expires_at"] = session.get("spotify_auth_token").get("expires_at")
+
+        if session.get("applemusic_authenticated"):
+            params["applemusic_music_user_token"] = session.get("applemusic_music_user_token")
+
+        if session.get("youtube_authenticated"):
+            params["youtube_username"] = session.get("youtube_username")
+            params["youtube_token"] = session.get("youtube_token")
+
+        if session.get("google_authenticated"):
+            params["google_token"] = session.get("google_token")
+
+        job_id = enqueue_job(g.username, "generate_sheet", run_generate_sheet_job, params)
+        return {"job_id": job_id, "status_url": f"/jobs/{job_id}"}, 202
 
+
+@contextmanager
+def generation_stage(stage):
+    # Each stage is both timed for /metrics and traced as a span, and snapshotted if the job is memory profiled
+    # (outside the timing, so taking the snapshot doesn't count towards the stage)
+    with memory_stage(stage), time_stage(stage), span(stage, category="stage"):
+        yield
+
+
+def run_generate_sheet_job(params):
+    username = params["username"]
+    include_zero_score = params["include_zero_score"]
+
+    generation_start = perf_counter()
+
+    publish_progress("catalog", "Loading karaoke song catalog")
+    with generation_stage("catalog"):
+        karaoke_songs_index = load_karaoke_songs_index()
+    publish_progress(
+        "catalog",
+        f"Loaded {len(karaoke_songs_index)} karaoke songs",
+        songs=len(karaoke_songs_index),
+    )
+
+    lastfm_artist_playcounts = None
+    lastfm_track_playcounts = None
+    spotify_artist_scores = None
+    spotify_track_scores = None
+    applemusic_artists = None
+    applemusic_tracks = None
+    youtube_liked_songs = None
+
+    if params["lastfm_username"]:
+        print("Last.fm auth found, loading lastfm data")
+        with generation_stage("lastfm"):
+            lastfm_artist_playcounts = get_top_artists_lastfm(params["lastfm_username"])
+            lastfm_track_playcounts = get_top_tracks_lastfm(params["lastfm_username"])
+
+    if params["spotify_access_token"]:
+        print("Spotify auth found, loading spotify data")
+        with generation_stage("spotify"):
             spotify_artist_scores = get_top_artists_spotify(
-                session.get("username"), spotify_auth_token
+                username, params["spotify_access_token"], params["spotify_token_expires_at"]
             )
             spotify_track_scores = get_top_tracks_spotify(
-                session.get("username"), spotify_auth_token
+                username, params["spotify_access_token"], params["spotify_token_expires_at"]
             )
 
-        if session.get("applemusic_authenticated"):
-            print("Apple Music auth found, loading applemusic data")
-            applemusic_music_user_token = session.get("applemusic_music_user_token")
-            applemusic_developer_token = session.get("applemusic_developer_token")
+    if params["applemusic_music_user_token"]:
+        print("Apple Music auth found, loading applemusic data")
+        applemusic_music_user_token = params["applemusic_music_user_token"]
+        applemusic_developer_token = generate_developer_token()
 
-            print(
-                f"Fetching Apple Music data with token: {applemusic_music_user_token}"
-            )
+        print(f"Fetching Apple Music data with token: {redact_token(applemusic_music_user_token)}")
+        with generation_stage("applemusic"):
             applemusic_artists = get_applemusic_library_artists(
                 applemusic_developer_token, applemusic_music_user_token
             )
             applemusic_tracks = get_applemusic_library_songs(
                 applemusic_developer_token, applemusic_music_user_token
             )
-            print(
-                f"Apple Music artist counts: {applemusic_artists} and track counts: {applemusic_tracks}"
-            )
+        print(
+            f"Apple Music artist counts: {len(applemusic_artists)} and track counts: {len(applemusic_tracks)}"
+        )
 
-        if session.get("youtube_authenticated"):
-            print("Youtube Music auth found, loading youtube data")
-            youtube_oauth_token = session.get("youtube_token")
+    if params["youtube_token"]:
+        print("Youtube Music auth found, loading youtube data")
+        with generation_stage("youtube"):
             youtube_liked_videos = get_liked_videos(
-                session["youtube_username"], youtube_oauth_token
+                params["youtube_username"], params["youtube_token"]
             )
+        with generation_stage("youtube_identification"):
             youtube_liked_songs = identify_songs_from_youtube_videos(
-                session["youtube_username"], youtube_liked_videos
+                params["youtube_username"], youtube_liked_videos
             )
 
-        header_values, data_values = calculate_songs_rows(
-            all_karaoke_songs,
-            include_zero_score,
-            lastfm_artist_playcounts,
-            lastfm_track_playcounts,
-            spotify_artist_scores,
-            spotify_track_scores,
-            applemusic_artists,
-            applemusic_tracks,
-            youtube_liked_songs,
-        )
+    # Sheet rows only depend on the catalog, provider data and zero score flag,
+    # so a repeat request with unchanged inputs reuses the previously calculated rows
+    result_key = get_sheet_result_key(
+        get_karaoke_songs_version(),
+        include_zero_score,
+        {
+            "lastfm_artist_playcounts": lastfm_artist_playcounts,
+            "lastfm_track_playcounts": lastfm_track_playcounts,
+            "spotify_artist_scores": spotify_artist_scores,
+            "spotify_track_scores": spotify_track_scores,
+            "applemusic_artists": applemusic_artists,
+            "applemusic_tracks": applemusic_tracks,
+            "youtube_liked_songs": youtube_liked_songs,
+        },
+    )
+    publish_progress("scoring", "Calculating karaoke song scores")
+    with generation_stage("scoring"):
+        sheet_result = load_sheet_result(result_key)
+        if sheet_result is not None:
+            header_values, data_values = sheet_result
+        else:
+            header_values, data_values = calculate_songs_rows(
+                karaoke_songs_index,
+                include_zero_score,
+                lastfm_artist_playcounts,
+                lastfm_track_playcounts,
+                spotify_artist_scores,
+                spotify_track_scores,
+                applemusic_artists,
+                applemusic_tracks,
+                youtube_liked_songs,
+            )
+            store_sheet_result(result_key, header_values, data_values)
 
-        print(
-            "Karaoke song rows calculated successfully, proceeding to write to CSV or Google Sheet"
-        )
+        set_latest_sheet_result_key(username, result_key)
+    publish_progress("scoring", f"Ranked {len(data_values)} karaoke songs", rows=len(data_values))
 
-        if session.get("google_authenticated"):
-            session["open_sheet_url"] = create_and_write_google_sheet(
-                session.get("google_token"), g.username, header_values, data_values
-            )
-            return session["open_sheet_url"]
-        else:
-            print("No google auth found, writing output to CSV file instead")
-            csv_file = f"{TEMP_OUTPUT_DIR}/{CSV_OUTPUT_FILENAME_PREFIX}{g.username}.csv"
+    print(
+        "Karaoke song rows calculated successfully, proceeding to write to CSV or Google Sheet"
+    )
 
-            with open(csv_file, "w") as file:
-                writer = csv.writer(file)
-                writer.writerow(header_values)
-                writer.writerows(data_values)
+    publish_progress("upload", "Writing karaoke sheet")
+
+    if params["google_token"]:
+        with generation_stage("upload"):
+            if params["update_existing_sheet"] == "true":
+                open_sheet_url = update_existing_google_sheet(
+                    params["google_token"], username, header_values, data_values
+                )
+            else:
+                open_sheet_url = create_and_write_google_sheet(
+                    params["google_token"], username, header_values, data_values
+                )
+    else:
+        # The CSV is streamed from the cached result when it's fetched, so there's nothing to write here
+        print("No google auth found, sheet will be downloaded as CSV instead")
+        open_sheet_url = f"/fetch_csv?username={username}"
+
+    stage_duration_seconds.observe(perf_counter() - generation_start, stage="total")
+    record_deep_sizes(
+        karaoke_songs_index=karaoke_songs_index,
+        lastfm_artist_playcounts=lastfm_artist_playcounts,
+        lastfm_track_playcounts=lastfm_track_playcounts,
+        spotify_artist_scores=spotify_artist_scores,
+        spotify_track_scores=spotify_track_scores,
+        applemusic_artists=applemusic_artists,
+        applemusic_tracks=applemusic_tracks,
+        youtube_liked_songs=youtube_liked_songs,
+        header_values=header_values,
+        data_values=data_values,
+    )
+    publish_progress("done", "Your karaoke sheet is ready", open_sheet_url=open_sheet_url)
 
-            session["open_sheet_url"] = f"/fetch_csv?username={g.username}"
-            return session["open_sheet_url"]
+    return {
+        "open_sheet_url": open_sheet_url,
+        "result_key": result_key,
+        "row_count": len(data_values),
+    }
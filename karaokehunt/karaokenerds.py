@@ -1,17 +1,31 @@
 import gzip
 import json
+import hashlib
 import os
+import shutil
 import logging
+import threading
 from pathlib import Path
 import urllib.request
 from datetime import timedelta, datetime
 
+from .cache import atomic_open, local_exclusive_lock
+from .metrics import record_catalog_loaded
+from .tracing import span
+
 logger = logging.getLogger("karaokehunt")
 
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 KARAOKE_SONGS_FILE = os.getenv("KARAOKE_SONGS_FILE")
 KARAOKE_SONGS_URL = os.getenv("KARAOKE_SONGS_URL")
 
+karaoke_songs_cache = {"version": None, "index": None}
+karaoke_songs_lock = threading.Lock()
+
+# (file identity, version) of the last catalog file hashed by get_karaoke_songs_version()
+karaoke_songs_file_hash = {"last": None}
+KARAOKE_SONGS_HASH_READ_SIZE = 1024 * 1024
+
 ##########################################################################
 ###########            Load Karaoke Nerds Data                 ###########
 ##########################################################################
@@ -25,7 +39,9 @@ def is_file_older_than(file, delta):
     return False
 
 
-def load_karaoke_songs():
+def load_karaoke_songs_index():
+    # Downloads the karaoke song DB if it's missing or stale, and returns its scoring index
+    # (see build_karaoke_songs_index()), which is kept in memory until the file changes
     file_path = Path(f"{TEMP_OUTPUT_DIR}/{KARAOKE_SONGS_FILE}")
     needs_fetch = False
 
@@ -38,10 +54,62 @@ def load_karaoke_songs():
             needs_fetch = True
 
     if needs_fetch:
-        logger.info(f"Downloading latest karaoke song DB from firebase storage")
-        urllib.request.urlretrieve(KARAOKE_SONGS_URL, file_path)
+        with local_exclusive_lock("karaoke_songs_download"):
+            # Another request may have downloaded the DB while we waited for the lock
+            if not file_path.is_file() or is_file_older_than(file_path, timedelta(days=3)):
+                logger.info(f"Downloading latest karaoke song DB from firebase storage")
+                with span("catalog.download", category="http"), atomic_open(file_path, "wb") as f:
+                    with urllib.request.urlopen(KARAOKE_SONGS_URL) as response:
+                        shutil.copyfileobj(response, f)
+
+    version = get_karaoke_songs_version(file_path)
+
+    # Only the index is kept, the parsed songs are dropped once it's built as nothing else needs them
+    with karaoke_songs_lock:
+        if karaoke_songs_cache["version"] != version:
+            with span("catalog.parse", version=version), gzip.open(file_path, "rt", encoding="utf-8") as f:
+                logger.info(f"Successfully opened karaoke song DB, version: {version}")
+                all_karaoke_songs = json.load(f)
+                karaoke_songs_cache["index"] = build_karaoke_songs_index(all_karaoke_songs)
+                karaoke_songs_cache["version"] = version
+                record_catalog_loaded(version, len(all_karaoke_songs), os.path.getmtime(file_path))
+
+        return karaoke_songs_cache["index"]
+
+
+def build_karaoke_songs_index(all_karaoke_songs):
+    # Everything the scoring loop needs per song, worked out once per catalog version rather than per sheet:
+    # (artist, title, brands, lowercased artist, lowercased title, karaoke popularity)
+    return [
+        (
+            song["Artist"],
+            song["Title"],
+            song["Brands"],
+            song["Artist"].lower(),
+            song["Title"].lower(),
+            len(song["Brands"].split(",")),
+        )
+        for song in all_karaoke_songs
+    ]
+
+
+def get_karaoke_songs_version(file_path=None):
+    # Identifies the karaoke song DB by a hash of its contents, so every node which downloaded the same DB
+    # agrees on the version (and so on result cache keys). The hash is only recalculated when the file changes.
+    if file_path is None:
+        file_path = Path(f"{TEMP_OUTPUT_DIR}/{KARAOKE_SONGS_FILE}")
+
+    stat = os.stat(file_path)
+    file_key = (str(file_path), stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    last_hashed = karaoke_songs_file_hash["last"]
+    if last_hashed is not None and last_hashed[0] == file_key:
+        return last_hashed[1]
+
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(KARAOKE_SONGS_HASH_READ_SIZE), b""):
+            hasher.update(chunk)
 
-    with gzip.open(file_path, "rt", encoding="utf-8") as f:
-        logger.info(f"Successfully opened karaoke song DB")
-        data = json.load(f)
-        return data
+    version = hasher.hexdigest()[:16]
+    karaoke_songs_file_hash["last"] = (file_key, version)
+    return version
@@ -1,14 +1,23 @@
-import json
 import os
-import sys
 import requests
 import logging
 
 from flask import request, redirect, session, url_for, current_app as app, g
 
+from .cache import (
+    load_or_fetch_cache_file,
+    track_scores_to_records,
+    records_to_track_scores,
+)
+from .progress import publish_progress
+from .metrics import record_provider_call, provider_pages_total
+from .tracing import span
+
 logger = logging.getLogger("karaokehunt")
 
 LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
+# Overridable to run against a stand-in server, e.g. loadtest/mock_providers.py
+LASTFM_API_URL = os.getenv("LASTFM_API_URL", "https://ws.audioscrobbler.com/2.0/")
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 
 ##########################################################################
@@ -36,22 +45,17 @@ with app.app_context():
 
 
 def get_top_artists_lastfm(username):
-    cache_file = f"{TEMP_OUTPUT_DIR}/top_artists_lastfm_{username}.json"
+    return load_or_fetch_cache_file(
+        f"top_artists_lastfm_{username}",
+        lambda: fetch_top_artists_lastfm(username),
+        cache_kind="top_artists_lastfm",
+    )
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found top artists cache file for user {username}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            all_top_artists = json.load(f)
-            return all_top_artists
 
-    logger.info(
-        f"No top artists cache file found for user {username}, fetching from last.fm"
-    )
+def fetch_top_artists_lastfm(username):
+    logger.info(f"Fetching top artists for user {username} from last.fm")
 
-    url = "https://ws.audioscrobbler.com/2.0/"
+    url = LASTFM_API_URL
     params = {
         "method": "user.getTopArtists",
         "user": username,
@@ -60,42 +64,45 @@ def get_top_artists_lastfm(username):
         "limit": 1000,
     }
 
-    response = requests.get(url, params=params)
+    with span("lastfm.get_top_artists", category="http"):
+        response = requests.get(url, params=params)
+    record_provider_call("lastfm", response.status_code == 200)
     if response.status_code == 200:
+        provider_pages_total.inc(provider="lastfm")
         data = response.json()
-        all_top_artists = data["topartists"]["artist"]
-
-        # Cache fetched data to a file
-        with open(cache_file, "w", encoding="utf-8") as f:
-            json.dump(all_top_artists, f)
-
-        return all_top_artists
+        artist_playcounts = {
+            artist["name"].lower(): int(artist["playcount"])
+            for artist in data["topartists"]["artist"]
+        }
+        publish_progress(
+            "lastfm",
+            f"Fetched {len(artist_playcounts)} Last.fm top artists",
+            artists=len(artist_playcounts),
+        )
+        return artist_playcounts
     else:
         logger.error(
             f"Error {response.status_code}: Failed to fetch top artists for user {username}"
         )
-        sys.exit(1)
+        return None
 
 
 def get_top_tracks_lastfm(username):
-    cache_file = f"{TEMP_OUTPUT_DIR}/top_tracks_lastfm_{username}.json"
+    return load_or_fetch_cache_file(
+        f"top_tracks_lastfm_{username}",
+        lambda: fetch_top_tracks_lastfm(username),
+        encode=track_scores_to_records,
+        decode=records_to_track_scores,
+        cache_kind="top_tracks_lastfm",
+    )
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found top tracks cache file for user {username}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            all_top_tracks = json.load(f)
-            return all_top_tracks
 
-    logger.info(
-        f"No top tracks cache file found for user {username}, beginning last.fm fetch loop"
-    )
+def fetch_top_tracks_lastfm(username):
+    logger.info(f"Beginning last.fm top tracks fetch loop for user {username}")
 
-    # Fetch data from last.fm API and cache it to the file
-    url = "https://ws.audioscrobbler.com/2.0/"
-    all_top_tracks = []
+    # Fetch data from last.fm API, reducing each page to (artist, title) -> playcount
+    url = LASTFM_API_URL
+    track_playcounts = {}
     limit = 1000
     max_tracks = 10000
     fetched_tracks = 0
@@ -114,13 +121,27 @@ def get_top_tracks_lastfm(username):
         logger.info(
             f"Inside top tracks fetch loop, page: {page}, fetched_tracks: {fetched_tracks}, max_tracks: {max_tracks}"
         )
-        response = requests.get(url, params=params)
+        with span("lastfm.get_top_tracks", category="http", page=page):
+            response = requests.get(url, params=params)
+        record_provider_call("lastfm", response.status_code == 200)
         if response.status_code == 200:
+            provider_pages_total.inc(provider="lastfm")
             data = response.json()
-            tracks = data["toptracks"]["track"]
+            tracks = data["toptracks"]["track"][: max_tracks - fetched_tracks]
             num_new_tracks = len(tracks)
             fetched_tracks += num_new_tracks
-            all_top_tracks.extend(tracks)
+
+            for track in tracks:
+                track_playcounts[
+                    (track["artist"]["name"].lower(), track["name"].lower())
+                ] = int(track["playcount"])
+
+            publish_progress(
+                "lastfm",
+                f"Fetched Last.fm top tracks page {page}, {fetched_tracks} tracks so far",
+                page=page,
+                tracks=fetched_tracks,
+            )
 
             if num_new_tracks < 1000:
                 logger.info(
@@ -135,8 +156,4 @@ def get_top_tracks_lastfm(username):
             )
             break
 
-    # Cache fetched data to a file
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(all_top_tracks, f)
-
-    return all_top_tracks[:max_tracks]
+    return track_playcounts
@@ -0,0 +1,319 @@
+import os
+import re
+import glob
+import json
+import queue
+import copy
+import atexit
+import logging
+import logging.handlers
+from time import time
+from itertools import islice
+from collections import OrderedDict
+from urllib.parse import quote
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+USER_LOGS_DIR = os.getenv("USER_LOGS_DIR", f"{TEMP_OUTPUT_DIR}/user_logs")
+
+# Each user's side file is rolled over to a single ".1" backup at this size, so reading it stays cheap
+USER_LOG_MAX_BYTES = int(os.getenv("USER_LOG_MAX_BYTES", 1048576))
+USER_LOG_RETENTION_SECONDS = 7 * 86400
+USER_LOG_PRUNE_INTERVAL_SECONDS = 3600
+USER_LOG_OPEN_FILES = 32
+
+LOG_READ_BLOCK_SIZE = 65536
+
+# text (default) or json, for the stdout log. Log files stay as text, as /logs, /debug and /admin show them.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# TimedRotatingFileHandler's backup suffix for when="midnight"
+ROTATED_LOG_SUFFIX_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Strips werkzeug's request log prefix noise from messages
+MESSAGE_REWRITE_PATTERNS = [re.compile(r"\[.+\] "), re.compile(r"127\.0\.0\.1 "), re.compile(r"- - ")]
+
+##########################################################################
+###########               Queued Logging Pipeline              ###########
+##########################################################################
+
+# Loggers only put records on a queue, which a background listener thread formats and writes out
+# to the real handlers, so log I/O doesn't add latency to requests. The filter that adds request and user
+# details has to run on the logging thread (it needs the request context), so it sits on the queue handler.
+
+log_queue_handler = None
+log_queue_listener = None
+
+
+class ExceptionKeepingQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the traceback into the message and drops exc_info, so the listener's
+    # formatters couldn't tell them apart. The message is still resolved here (its args may change later),
+    # but the traceback is only rendered into exc_text, which the listener's formatters append or emit
+    # separately. The queue is in-process, so exc_info can stay on the record rather than being pickled.
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+        return record
+
+
+def start_log_queue(logger_names, filters):
+    # Moves the handlers dictConfig attached to logger_names behind a single queue handler
+    global log_queue_handler, log_queue_listener
+
+    handlers = []
+    for logger_name in logger_names:
+        for handler in logging.getLogger(logger_name).handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+
+    log_queue_handler = ExceptionKeepingQueueHandler(queue.SimpleQueue())
+    log_queue_handler.setFormatter(logging.Formatter())
+    for log_filter in filters:
+        log_queue_handler.addFilter(log_filter)
+
+    for logger_name in logger_names:
+        logging.getLogger(logger_name).handlers = [log_queue_handler]
+
+    log_queue_listener = logging.handlers.QueueListener(
+        log_queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    log_queue_listener.start()
+
+    atexit.register(stop_log_queue)
+    os.register_at_fork(after_in_child=restart_log_queue_listener)
+
+
+def stop_log_queue():
+    # Flushes any queued records before exit
+    if log_queue_listener is not None and log_queue_listener._thread is not None:
+        log_queue_listener.stop()
+
+
+def restart_log_queue_listener():
+    # The listener thread doesn't survive a fork (e.g. gunicorn workers forking from the preloaded master),
+    # so each child starts its own, on a fresh queue in case the parent was mid-put when it forked
+    global log_queue_listener
+
+    if log_queue_listener is None:
+        return
+
+    log_queue_handler.queue = queue.SimpleQueue()
+    log_queue_listener = logging.handlers.QueueListener(
+        log_queue_handler.queue, *log_queue_listener.handlers, respect_handler_level=True
+    )
+    log_queue_listener.start()
+
+
+def rewrite_message(message):
+    for pattern in MESSAGE_REWRITE_PATTERNS:
+        message = pattern.sub("", message)
+    return message
+
+
+class TextLogFormatter(logging.Formatter):
+    # Makes %(replacedmessage)s available, rewritten on the listener thread rather than per log call
+
+    def format(self, record):
+        record.replacedmessage = rewrite_message(record.getMessage())
+        return super().format(record)
+
+
+class JsonLogFormatter(logging.Formatter):
+    # One JSON object per line, for log aggregators
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "identifier": getattr(record, "identifier", None),
+            "username": getattr(record, "username", None),
+            "message": rewrite_message(record.getMessage()),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+def redact_token(token):
+    # Enough of a token to tell tokens apart in the logs, without logging a usable credential
+    if not token:
+        return token
+    token = str(token)
+    return f"{token[:6]}...({len(token)} chars)"
+
+##########################################################################
+###########                 Per-User Log Files                 ###########
+##########################################################################
+
+# Alongside the main log file, every line logged for a known user is also appended to a side file for
+# that user, so /logs and /debug can show a user's recent lines without scanning the whole log.
+# This module only uses the standard library, so the logging config in app.py can reference it before Flask.
+# Every gunicorn worker has its own handler appending to the same files, so like WatchedFileHandler, a file
+# which another worker has rolled over (or pruned) is reopened rather than written to under its old name.
+
+
+def get_user_log_file_path(username):
+    # Usernames come from providers, so they're quoted to make a safe (and still unique) filename
+    return f"{USER_LOGS_DIR}/{quote(username, safe='')[:200]}.log"
+
+
+def prune_old_user_log_files():
+    cutoff = time() - USER_LOG_RETENTION_SECONDS
+    for filename in os.listdir(USER_LOGS_DIR):
+        file_path = f"{USER_LOGS_DIR}/{filename}"
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+class PerUserLogFileHandler(logging.Handler):
+    # Relies on UsernameRequestIdFilter having set record.username (None when there's no user)
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        os.makedirs(USER_LOGS_DIR, exist_ok=True)
+        prune_old_user_log_files()
+        self.last_pruned_at = time()
+
+        # Most recently used user files are kept open, so busy users don't cost an open() per line
+        self.open_files = OrderedDict()
+
+    def is_user_log_file_current(self, username, user_log_file):
+        # False if the file at the user's path is no longer the one we have open
+        try:
+            path_stat = os.stat(get_user_log_file_path(username))
+        except FileNotFoundError:
+            return False
+
+        open_stat = os.fstat(user_log_file.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) == (open_stat.st_dev, open_stat.st_ino)
+
+    def get_user_log_file(self, username):
+        if username in self.open_files:
+            user_log_file = self.open_files[username]
+            if self.is_user_log_file_current(username, user_log_file):
+                self.open_files.move_to_end(username)
+                return user_log_file
+            self.open_files.pop(username).close()
+
+        user_log_file = open(get_user_log_file_path(username), "a", encoding="utf8")
+        self.open_files[username] = user_log_file
+
+        while len(self.open_files) > USER_LOG_OPEN_FILES:
+            self.open_files.popitem(last=False)[1].close()
+
+        return user_log_file
+
+    def roll_over_user_log_file(self, username):
+        user_log_file = self.open_files.pop(username)
+        # Another worker may have just rolled it over, in which case there's nothing left to do
+        if self.is_user_log_file_current(username, user_log_file):
+            file_path = get_user_log_file_path(username)
+            os.replace(file_path, f"{file_path}.1")
+        user_log_file.close()
+
+    def emit(self, record):
+        username = getattr(record, "username", None)
+        if not username:
+            return
+
+        try:
+            if time() - self.last_pruned_at > USER_LOG_PRUNE_INTERVAL_SECONDS:
+                self.last_pruned_at = time()
+                prune_old_user_log_files()
+
+            user_log_file = self.get_user_log_file(username)
+            user_log_file.write(self.format(record) + "\n")
+            user_log_file.flush()
+
+            if user_log_file.tell() > USER_LOG_MAX_BYTES:
+                self.roll_over_user_log_file(username)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            for user_log_file in self.open_files.values():
+                user_log_file.close()
+            self.open_files.clear()
+        finally:
+            self.release()
+        super().close()
+
+
+def get_user_log_lines(username, limit):
+    # Last limit lines logged for username, newest first. Each side file is bounded by USER_LOG_MAX_BYTES,
+    # and only as much of it as needed is read, so this costs the same however large the main log has grown.
+    file_path = get_user_log_file_path(username)
+    return read_last_lines([file_path, f"{file_path}.1"], limit)
+
+
+##########################################################################
+###########               Reverse Log Reading                  ###########
+##########################################################################
+
+
+def get_rotated_log_file_paths(log_file_path):
+    # The current log file followed by its TimedRotatingFileHandler backups, newest first
+    backups = [
+        path
+        for path in glob.glob(f"{glob.escape(log_file_path)}.*")
+        if ROTATED_LOG_SUFFIX_PATTERN.match(path[len(log_file_path) + 1 :])
+    ]
+    return [log_file_path] + sorted(backups, reverse=True)
+
+
+def iter_file_lines_reversed(file_path):
+    # Yields the lines of file_path last to first, reading fixed-size blocks backwards from the end,
+    # so memory is bounded by the block size (plus the longest line) and each byte is read once
+    try:
+        f = open(file_path, "rb")
+    except FileNotFoundError:
+        return
+
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        partial_line = b""
+        at_end = True
+
+        while position > 0:
+            read_size = min(LOG_READ_BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+
+            lines = (f.read(read_size) + partial_line).split(b"\n")
+            # The first piece may be the end of a line which started in an earlier block
+            partial_line = lines.pop(0)
+
+            # Don't yield an empty line for the newline at the very end of the file
+            if at_end and lines and lines[-1] == b"":
+                lines.pop()
+            at_end = False
+
+            for line in reversed(lines):
+                yield line.decode("utf8", errors="replace") + "\n"
+
+        if partial_line:
+            yield partial_line.decode("utf8", errors="replace") + "\n"
+
+
+def iter_lines_reversed(file_paths):
+    # Yields the lines of each file last to first, walking the files in the order given
+    for file_path in file_paths:
+        yield from iter_file_lines_reversed(file_path)
+
+
+def read_last_lines(file_paths, limit):
+    return list(islice(iter_lines_reversed(file_paths), max(limit, 0)))
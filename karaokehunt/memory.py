@@ -0,0 +1,236 @@
+import os
+import re
+import sys
+import json
+import logging
+import resource
+import threading
+import tracemalloc
+import contextvars
+from time import time
+from contextlib import contextmanager
+
+from .profiling import claim_armed_profiling, is_profiling_armed
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+MEMORY_PROFILES_DIR = f"{TEMP_OUTPUT_DIR}/memory_profiles"
+MEMORY_PROFILE_RETENTION_SECONDS = int(os.getenv("PROFILE_RETENTION_HOURS", 168)) * 3600
+
+# Frames kept per allocation, more makes tracing slower but lets allocation sites be told apart
+TRACEMALLOC_FRAMES = 5
+MEMORY_TOP_ALLOCATION_SITES = 25
+
+# Memory profiles are named by job id, their snapshots by job id and stage
+MEMORY_PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+MEMORY_STAGE_PATTERN = re.compile(r"^[a-z_]+$")
+
+##########################################################################
+###########                 Memory Profiling                   ###########
+##########################################################################
+
+# Armed from /admin like CPU profiling (see profiling.py). The armed job runs with tracemalloc on, and at the
+# end of each generation stage a snapshot is saved along with the traced memory, the stage's peak and the
+# process peak RSS. Once the job finishes the deep sizes of the catalog, provider data and rows are recorded,
+# and any two saved snapshots (of the same or different jobs) can be diffed by allocation site.
+# tracemalloc traces the whole process, so allocations by other requests or jobs running at the same time
+# show up too: profile on a quiet worker where possible.
+
+current_memory_profile = contextvars.ContextVar("current_memory_profile", default=None)
+
+# tracemalloc is process-wide, so only one job per process is memory profiled at a time
+memory_profiler_lock = threading.Lock()
+
+# Allocations made by tracemalloc and the import system aren't the app's
+TRACEMALLOC_IGNORED_FILES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def get_memory_profile_file_path(job_id):
+    if not MEMORY_PROFILE_ID_PATTERN.match(job_id or ""):
+        raise ValueError(f"Invalid memory profile id: {job_id}")
+    return f"{MEMORY_PROFILES_DIR}/{job_id}.json"
+
+
+def get_memory_snapshot_file_path(job_id, stage):
+    if not MEMORY_STAGE_PATTERN.match(stage or ""):
+        raise ValueError(f"Invalid memory profile stage: {stage}")
+    return f"{get_memory_profile_file_path(job_id)[: -len('.json')]}.{stage}.tracemalloc"
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_deep_size(obj):
+    # sys.getsizeof of obj and everything reachable through containers, counting shared objects once
+    seen = set()
+    size = 0
+    pending = [obj]
+
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+
+    return size
+
+
+def prune_old_memory_profiles():
+    cutoff = time() - MEMORY_PROFILE_RETENTION_SECONDS
+    for filename in os.listdir(MEMORY_PROFILES_DIR):
+        file_path = f"{MEMORY_PROFILES_DIR}/{filename}"
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_top_allocation_sites(statistics, limit=MEMORY_TOP_ALLOCATION_SITES):
+    return [
+        {"site": str(statistic.traceback), "size": statistic.size, "count": statistic.count}
+        for statistic in statistics[:limit]
+    ]
+
+
+@contextmanager
+def memory_profile_job(job_state):
+    # Runs the body with tracemalloc on if memory profiling was armed for this job's user.
+    # If another job is already being memory profiled, the arm is left for the user's next job.
+    if not memory_profiler_lock.acquire(blocking=False):
+        if is_profiling_armed(job_state, "memory"):
+            logger.warning(f"Another job is already being memory profiled, running job {job_state['id']} unprofiled")
+        yield
+        return
+
+    if not claim_armed_profiling(job_state, "memory"):
+        memory_profiler_lock.release()
+        yield
+        return
+
+    logger.info(f"Memory profiling job {job_state['id']}")
+    os.makedirs(MEMORY_PROFILES_DIR, exist_ok=True)
+    prune_old_memory_profiles()
+
+    # If tracemalloc was already on (e.g. PYTHONTRACEMALLOC), leave it on afterwards
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    memory_profile = {
+        "job_id": job_state["id"],
+        "username": job_state["username"],
+        "started_at": time(),
+        "stages": [],
+        "deep_sizes": {},
+    }
+    token = current_memory_profile.set(memory_profile)
+    try:
+        yield
+    finally:
+        current_memory_profile.reset(token)
+        if started_tracemalloc:
+            tracemalloc.stop()
+        memory_profiler_lock.release()
+
+        try:
+            with open(get_memory_profile_file_path(job_state["id"]), "w", encoding="utf-8") as f:
+                json.dump(memory_profile, f)
+            job_state["memory_profiled"] = True
+        except Exception:
+            logger.exception(f"Failed to save memory profile of job {job_state['id']}")
+
+
+@contextmanager
+def memory_stage(stage):
+    # Snapshots memory at the end of stage, doing nothing unless the current job is being memory profiled
+    memory_profile = current_memory_profile.get()
+    if memory_profile is None:
+        yield
+        return
+
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_IGNORED_FILES)
+        snapshot.dump(get_memory_snapshot_file_path(memory_profile["job_id"], stage))
+
+        memory_profile["stages"].append(
+            {
+                "stage": stage,
+                "traced_bytes": current_size,
+                "stage_peak_traced_bytes": peak_size,
+                "peak_rss_bytes": get_peak_rss_bytes(),
+                "top_allocation_sites": get_top_allocation_sites(snapshot.statistics("lineno")),
+            }
+        )
+
+
+def record_deep_sizes(**objects):
+    # Deep sizes of the job's main data structures, by name, when the current job is being memory profiled
+    memory_profile = current_memory_profile.get()
+    if memory_profile is None:
+        return
+
+    for name, obj in objects.items():
+        if obj is not None:
+            memory_profile["deep_sizes"][name] = get_deep_size(obj)
+
+
+def load_memory_profile(job_id):
+    try:
+        with open(get_memory_profile_file_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_memory_profiles():
+    # Newest first, as (job id, modification time)
+    try:
+        filenames = [filename for filename in os.listdir(MEMORY_PROFILES_DIR) if filename.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for filename in filenames:
+        try:
+            profiles.append((filename[: -len(".json")], os.path.getmtime(f"{MEMORY_PROFILES_DIR}/{filename}")))
+        except FileNotFoundError:
+            continue
+
+    return sorted(profiles, key=lambda profile: profile[1], reverse=True)
+
+
+def diff_memory_snapshots(before_job_id, before_stage, after_job_id, after_stage, limit=MEMORY_TOP_ALLOCATION_SITES):
+    # Allocation sites which grew the most from the before snapshot to the after snapshot
+    before = tracemalloc.Snapshot.load(get_memory_snapshot_file_path(before_job_id, before_stage))
+    after = tracemalloc.Snapshot.load(get_memory_snapshot_file_path(after_job_id, after_stage))
+
+    return [
+        {
+            "site": str(statistic.traceback),
+            "size": statistic.size,
+            "size_diff": statistic.size_diff,
+            "count": statistic.count,
+            "count_diff": statistic.count_diff,
+        }
+        for statistic in after.compare_to(before, "lineno")[:limit]
+    ]
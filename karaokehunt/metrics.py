@@ -0,0 +1,347 @@
+import os
+import json
+import logging
+import resource
+import tempfile
+import threading
+from time import time, sleep, perf_counter
+from contextlib import contextmanager
+
+from flask import Response, current_app as app
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+METRICS_DIR = f"{TEMP_OUTPUT_DIR}/metrics"
+METRICS_SNAPSHOT_INTERVAL_SECONDS = 5
+
+STAGE_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+##########################################################################
+###########                  Metrics Registry                  ###########
+##########################################################################
+
+# Counters, gauges and histograms rendered in the Prometheus text format on /metrics.
+# Each process periodically saves its values to a small JSON file in METRICS_DIR, and /metrics merges
+# the files of every live process, so under gunicorn any worker can answer a scrape for the whole container.
+
+metrics_registry = []
+metrics_snapshot_state = {"saved_at": 0}
+metrics_snapshot_lock = threading.Lock()
+
+
+def format_labels(labelnames, labelvalues, extra=""):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def get_labelvalues(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+        maybe_save_metrics_snapshot()
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def collect(self):
+        with self.lock:
+            return [[list(labelvalues), value] for labelvalues, value in self.values.items()]
+
+    @staticmethod
+    def merge_value(a, b):
+        return a + b
+
+    def render(self, samples):
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}" for labelvalues, value in samples]
+
+
+class Gauge(Counter):
+    # Merged across processes by taking the highest value, so per-process gauges should have a pid label
+    type = "gauge"
+
+    def set(self, value, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            self.values[labelvalues] = value
+        maybe_save_metrics_snapshot()
+
+    def clear(self):
+        self.reset()
+
+    @staticmethod
+    def merge_value(a, b):
+        return max(a, b)
+
+
+class Histogram(Counter):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            if labelvalues not in self.values:
+                self.values[labelvalues] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            histogram_value = self.values[labelvalues]
+
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram_value["buckets"][index] += 1
+            histogram_value["sum"] += value
+            histogram_value["count"] += 1
+        maybe_save_metrics_snapshot()
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def collect(self):
+        with self.lock:
+            return [
+                [list(labelvalues), {**value, "buckets": list(value["buckets"])}]
+                for labelvalues, value in self.values.items()
+            ]
+
+    @staticmethod
+    def merge_value(a, b):
+        return {
+            "buckets": [x + y for x, y in zip(a["buckets"], b["buckets"])],
+            "sum": a["sum"] + b["sum"],
+            "count": a["count"] + b["count"],
+        }
+
+    def render(self, samples):
+        lines = []
+        for labelvalues, value in samples:
+            # Each observation is counted in every bucket it fits under, so the stored bucket counts
+            # are already cumulative, as Prometheus expects
+            for upper_bound, bucket_count in zip(self.buckets, value["buckets"]):
+                bucket_labels = format_labels(self.labelnames, labelvalues, f'le="{upper_bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+
+            labels = format_labels(self.labelnames, labelvalues)
+            infinity_labels = format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{infinity_labels} {value['count']}")
+            lines.append(f"{self.name}_sum{labels} {value['sum']}")
+            lines.append(f"{self.name}_count{labels} {value['count']}")
+        return lines
+
+
+##########################################################################
+###########                 Application Metrics                ###########
+##########################################################################
+
+stage_duration_seconds = Histogram(
+    "karaokehunt_stage_duration_seconds",
+    "Time spent in each stage of sheet generation",
+    ["stage"],
+)
+jobs_total = Counter("karaokehunt_jobs_total", "Background jobs finished, by type and final status", ["type", "status"])
+provider_calls_total = Counter(
+    "karaokehunt_provider_calls_total",
+    "HTTP calls made to music data providers and Google, by outcome",
+    ["provider", "outcome"],
+)
+provider_pages_total = Counter(
+    "karaokehunt_provider_pages_total",
+    "Pages of items successfully fetched from music data providers",
+    ["provider"],
+)
+youtube_identifications_total = Counter(
+    "karaokehunt_youtube_identifications_total",
+    "YouTube videos run through yt-dlp to identify songs, by outcome",
+    ["outcome"],
+)
+cache_requests_total = Counter(
+    "karaokehunt_cache_requests_total",
+    "Provider data cache lookups, by cache and result (fetched is a miss, fresh and stale are hits)",
+    ["cache", "result"],
+)
+catalog_songs = Gauge("karaokehunt_catalog_songs", "Songs in the loaded karaoke catalog")
+catalog_version_timestamp_seconds = Gauge(
+    "karaokehunt_catalog_version_timestamp_seconds", "Modification time of the loaded karaoke catalog file"
+)
+catalog_info = Gauge("karaokehunt_catalog_info", "Version of the loaded karaoke catalog", ["version"])
+process_resident_memory_bytes = Gauge(
+    "karaokehunt_process_resident_memory_bytes", "Resident memory of each app process", ["pid"]
+)
+process_peak_resident_memory_bytes = Gauge(
+    "karaokehunt_process_peak_resident_memory_bytes", "Peak resident memory of each app process", ["pid"]
+)
+
+
+def time_stage(stage):
+    return stage_duration_seconds.time(stage=stage)
+
+
+def record_provider_call(provider, ok):
+    provider_calls_total.inc(provider=provider, outcome="ok" if ok else "error")
+
+
+def record_catalog_loaded(version, song_count, modified_time):
+    catalog_songs.set(song_count)
+    catalog_version_timestamp_seconds.set(int(modified_time))
+    catalog_info.clear()
+    catalog_info.set(1, version=version)
+
+
+def update_process_memory_metrics():
+    pid = str(os.getpid())
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        process_resident_memory_bytes.set(resident_pages * resource.getpagesize(), pid=pid)
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # ru_maxrss is in kilobytes on Linux
+    process_peak_resident_memory_bytes.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, pid=pid)
+
+
+##########################################################################
+###########            Cross-Process Snapshots & Route         ###########
+##########################################################################
+
+
+def collect_metrics():
+    return {metric.name: metric.collect() for metric in metrics_registry}
+
+
+def save_metrics_snapshot():
+    # Written to a temp file then renamed, so another process never reads a partial snapshot
+    with metrics_snapshot_lock:
+        metrics_snapshot_state["saved_at"] = time()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        snapshot = json.dumps(collect_metrics())
+
+        fd, temp_path = tempfile.mkstemp(dir=METRICS_DIR, prefix=".", suffix=".tmp")
+        with open(fd, "w") as f:
+            f.write(snapshot)
+        os.replace(temp_path, f"{METRICS_DIR}/{os.getpid()}.json")
+
+
+def maybe_save_metrics_snapshot():
+    if time() - metrics_snapshot_state["saved_at"] < METRICS_SNAPSHOT_INTERVAL_SECONDS:
+        return
+
+    # Claimed before saving so concurrent updates don't all save at once; a failed save is retried next interval
+    metrics_snapshot_state["saved_at"] = time()
+    try:
+        update_process_memory_metrics()
+        save_metrics_snapshot()
+    except Exception:
+        logger.exception("Failed to save metrics snapshot")
+
+
+def start_metrics_snapshot_thread():
+    # Saves this process's snapshot every interval even when nothing is being recorded, so the last updates
+    # before a worker goes idle (and its memory gauges) still reach /metrics. Started in each gunicorn worker
+    # after the fork, as threads don't survive it.
+    def save_periodically():
+        while True:
+            sleep(METRICS_SNAPSHOT_INTERVAL_SECONDS)
+            maybe_save_metrics_snapshot()
+
+    threading.Thread(target=save_periodically, name="metrics-snapshots", daemon=True).start()
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def load_metrics_snapshots():
+    snapshots = []
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+
+        file_path = f"{METRICS_DIR}/{filename}"
+        pid = int(filename[: -len(".json")])
+
+        # Snapshots of exited processes are dropped, their counters reset as far as Prometheus is concerned
+        if not is_process_alive(pid):
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+            continue
+
+        try:
+            with open(file_path) as f:
+                snapshots.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    return snapshots
+
+
+def render_metrics():
+    update_process_memory_metrics()
+    save_metrics_snapshot()
+    snapshots = load_metrics_snapshots()
+
+    lines = []
+    for metric in metrics_registry:
+        merged = {}
+        for snapshot in snapshots:
+            for labelvalues, value in snapshot.get(metric.name, []):
+                key = tuple(labelvalues)
+                merged[key] = metric.merge_value(merged[key], value) if key in merged else value
+
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render(sorted(merged.items())))
+
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics_after_fork():
+    # Forked workers inherit the master's counts from warm-up, which the master's own snapshot already reports
+    for metric in metrics_registry:
+        if metric.type != "gauge":
+            metric.reset()
+    metrics_snapshot_state["saved_at"] = 0
+
+
+os.register_at_fork(after_in_child=reset_metrics_after_fork)
+
+
+with app.app_context():
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
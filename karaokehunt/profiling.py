@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import pstats
+import logging
+import cProfile
+import threading
+from time import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+PROFILES_DIR = f"{TEMP_OUTPUT_DIR}/profiles"
+PROFILE_ARMED_DIR = f"{PROFILES_DIR}/armed"
+
+# cpu profiles are handled here, memory profiles in memory.py
+PROFILE_KINDS = ("cpu", "memory")
+
+# An armed profile is dropped if the user doesn't generate a sheet within this long
+PROFILE_ARMED_SECONDS = 3600
+PROFILE_RETENTION_SECONDS = int(os.getenv("PROFILE_RETENTION_HOURS", 168)) * 3600
+
+# Sort options for the top functions table, as indexes into its rows
+PROFILE_SORT_COLUMNS = {"calls": 0, "tottime": 2, "cumulative": 3}
+
+# Profiles are named by job id
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+##########################################################################
+###########               On-Demand CPU Profiling              ###########
+##########################################################################
+
+# An admin arms profiling for a username from /admin, and that user's next generate_sheet job runs under
+# cProfile (or tracemalloc, see memory.py). The arm is a small file, so whichever worker process picks up the job sees it.
+# cProfile only sees the job's own thread: time spent on helper threads (Google chunk uploads) shows up
+# as the job thread waiting on them, which is usually what you want to know anyway.
+
+# Only one profiler can be active in a process at a time, so overlapping armed jobs run unprofiled
+profiler_lock = threading.Lock()
+
+
+def get_profile_armed_file_path(username, kind):
+    return f"{PROFILE_ARMED_DIR}/{kind}_{quote(username, safe='')[:200]}"
+
+
+def get_profile_file_path(job_id):
+    if not PROFILE_ID_PATTERN.match(job_id or ""):
+        raise ValueError(f"Invalid profile id: {job_id}")
+    return f"{PROFILES_DIR}/{job_id}.prof"
+
+
+def arm_profiling(username, kind="cpu"):
+    if kind not in PROFILE_KINDS:
+        raise ValueError(f"Unknown profile kind: {kind}, expected cpu or memory")
+
+    os.makedirs(PROFILE_ARMED_DIR, exist_ok=True)
+    with open(get_profile_armed_file_path(username, kind), "w", encoding="utf-8") as f:
+        json.dump({"username": username, "kind": kind, "expires_at": time() + PROFILE_ARMED_SECONDS}, f)
+    logger.info(f"Armed {kind} profiling for the next generate_sheet job of {username}")
+
+
+def list_armed_profiling():
+    try:
+        filenames = os.listdir(PROFILE_ARMED_DIR)
+    except FileNotFoundError:
+        return []
+
+    armed = []
+    for filename in filenames:
+        try:
+            with open(f"{PROFILE_ARMED_DIR}/{filename}", "r", encoding="utf-8") as f:
+                armed_state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        if armed_state["expires_at"] > time():
+            armed.append(f"{armed_state['username']} ({armed_state['kind']})")
+    return sorted(armed)
+
+
+def is_profiling_armed(job_state, kind):
+    return job_state["type"] == "generate_sheet" and os.path.exists(
+        get_profile_armed_file_path(job_state["username"] or "", kind)
+    )
+
+
+def claim_armed_profiling(job_state, kind):
+    # The arm file is renamed to a name unique to this job first, so only one job can claim it.
+    # Callers only claim once they're sure to profile the job, so an arm is never used up by an unprofiled job.
+    if job_state["type"] != "generate_sheet" or not os.path.isdir(PROFILE_ARMED_DIR):
+        return False
+
+    armed_file_path = get_profile_armed_file_path(job_state["username"] or "", kind)
+    claimed_file_path = f"{armed_file_path}.{job_state['id']}"
+
+    try:
+        os.rename(armed_file_path, claimed_file_path)
+    except FileNotFoundError:
+        return False
+
+    try:
+        with open(claimed_file_path, "r", encoding="utf-8") as f:
+            armed_state = json.load(f)
+    except ValueError:
+        return False
+    finally:
+        os.unlink(claimed_file_path)
+
+    return armed_state["expires_at"] > time()
+
+
+def prune_old_profiles():
+    cutoff = time() - PROFILE_RETENTION_SECONDS
+    for filename in os.listdir(PROFILES_DIR):
+        file_path = f"{PROFILES_DIR}/{filename}"
+        try:
+            if os.path.isfile(file_path) and os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def profile_job(job_state):
+    # Runs the body under cProfile if profiling was armed for this job's user, saving the stats by job id.
+    # If another job is already being profiled, the arm is left for the user's next job.
+    if not profiler_lock.acquire(blocking=False):
+        if is_profiling_armed(job_state, "cpu"):
+            logger.warning(f"Another job is already being profiled, running job {job_state['id']} unprofiled")
+        yield
+        return
+
+    if not claim_armed_profiling(job_state, "cpu"):
+        profiler_lock.release()
+        yield
+        return
+
+    logger.info(f"Profiling job {job_state['id']}")
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            # Saved even if the job failed, a slow failure is as interesting as a slow success
+            profiler.disable()
+            save_profile(profiler, job_state)
+    finally:
+        profiler_lock.release()
+
+
+def save_profile(profiler, job_state):
+    try:
+        prune_old_profiles()
+        profiler.dump_stats(get_profile_file_path(job_state["id"]))
+        job_state["profiled"] = True
+    except Exception:
+        logger.exception(f"Failed to save profile of job {job_state['id']}")
+
+
+def list_profiles():
+    # Newest first, as (job id, modification time, size in bytes)
+    try:
+        filenames = [filename for filename in os.listdir(PROFILES_DIR) if filename.endswith(".prof")]
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for filename in filenames:
+        try:
+            stat = os.stat(f"{PROFILES_DIR}/{filename}")
+        except FileNotFoundError:
+            continue
+        profiles.append((filename[: -len(".prof")], stat.st_mtime, stat.st_size))
+
+    return sorted(profiles, key=lambda profile: profile[1], reverse=True)
+
+
+def get_top_functions(job_id, sort="cumulative", limit=40):
+    # Rows of (calls, primitive calls, own seconds, cumulative seconds, "file:line(function)"), biggest first
+    stats = pstats.Stats(get_profile_file_path(job_id))
+    sort_column = PROFILE_SORT_COLUMNS.get(sort, PROFILE_SORT_COLUMNS["cumulative"])
+
+    rows = [
+        (calls, primitive_calls, own_time, cumulative_time, pstats.func_std_string(function))
+        for function, (primitive_calls, calls, own_time, cumulative_time, _) in stats.stats.items()
+    ]
+    rows.sort(key=lambda row: row[sort_column], reverse=True)
+
+    return stats.total_tt, rows[:limit]
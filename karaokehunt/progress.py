@@ -0,0 +1,231 @@
+import os
+import json
+import queue
+import logging
+import threading
+from time import time, sleep
+from collections import deque
+
+from flask import Response, request, session, current_app as app
+
+from .context import current_job
+from .jobs import load_job_state, save_job_state, is_job_local
+
+logger = logging.getLogger("karaokehunt")
+
+PROGRESS_HISTORY_SIZE = int(os.getenv("PROGRESS_HISTORY_SIZE", 200))
+PROGRESS_KEEPALIVE_SECONDS = 15
+PROGRESS_SAVE_INTERVAL_SECONDS = 2
+PROGRESS_CHANNEL_IDLE_SECONDS = 3600
+PROGRESS_POLL_SECONDS = 1
+
+# Streams are closed after this long and resumed by the browser's EventSource from the last event id it saw,
+# so a watcher only holds a gunicorn thread for a while at a time, and reconnects after PROGRESS_RETRY_MS
+PROGRESS_STREAM_MAX_SECONDS = int(os.getenv("PROGRESS_STREAM_MAX_SECONDS", 60))
+PROGRESS_RETRY_MS = 1000
+
+##########################################################################
+###########             Generation Progress Events             ###########
+##########################################################################
+
+# Pipeline stages publish progress events for the job they're running in. Each event goes to a channel
+# for the job, which keeps a short history so late subscribers can catch up, and to a channel for the user
+# if anyone is watching it. Channels are streamed to the browser as Server-Sent Events.
+# Channels only exist in the process running the job, so a job stream requested from another gunicorn worker
+# (or container) follows the latest event saved with the job state instead.
+
+progress_channels = {}
+progress_lock = threading.Lock()
+
+
+def get_progress_channel(channel_name):
+    # Callers must hold progress_lock
+    if channel_name not in progress_channels:
+        prune_idle_progress_channels()
+        progress_channels[channel_name] = {
+            "history": deque(maxlen=PROGRESS_HISTORY_SIZE),
+            "subscribers": set(),
+            "next_event_id": 1,
+            "last_event_at": time(),
+        }
+    return progress_channels[channel_name]
+
+
+def prune_idle_progress_channels():
+    # Callers must hold progress_lock. Drops job channels nobody is watching which have gone quiet.
+    cutoff = time() - PROGRESS_CHANNEL_IDLE_SECONDS
+    for channel_name in list(progress_channels):
+        channel = progress_channels[channel_name]
+        if not channel["subscribers"] and channel["last_event_at"] < cutoff:
+            del progress_channels[channel_name]
+
+
+def publish_progress(stage, message, **details):
+    job = current_job.get()
+    if job is None:
+        return
+
+    event = {"job_id": job["id"], "stage": stage, "message": message, "time": time(), **details}
+
+    with progress_lock:
+        # Job channels keep their history for late subscribers, user channels only exist while someone is watching
+        channels = [get_progress_channel(f"job:{job['id']}")]
+        if f"user:{job['username']}" in progress_channels:
+            channels.append(progress_channels[f"user:{job['username']}"])
+
+        for channel in channels:
+            channel_event = {**event, "event_id": channel["next_event_id"]}
+            channel["next_event_id"] += 1
+            channel["last_event_at"] = event["time"]
+            channel["history"].append(channel_event)
+
+            for subscriber in channel["subscribers"]:
+                subscriber.put(channel_event)
+
+    # The latest event is also saved with the job (at most every couple of seconds),
+    # so status polling from any worker process can show it too
+    job["progress"] = event
+    if time() - job.get("progress_saved_at", 0) > PROGRESS_SAVE_INTERVAL_SECONDS:
+        job["progress_saved_at"] = time()
+        save_job_state(job)
+
+
+def subscribe_progress(channel_name, last_event_id=None):
+    subscriber = queue.Queue()
+
+    with progress_lock:
+        channel = get_progress_channel(channel_name)
+        # A resumed stream only replays the history it hasn't already seen
+        for event in channel["history"]:
+            if last_event_id is None or event["event_id"] > last_event_id:
+                subscriber.put(event)
+        channel["subscribers"].add(subscriber)
+
+    return subscriber
+
+
+def unsubscribe_progress(channel_name, subscriber):
+    with progress_lock:
+        channel = progress_channels.get(channel_name)
+        if channel is None:
+            return
+
+        channel["subscribers"].discard(subscriber)
+        if not channel["subscribers"] and channel_name.startswith("user:"):
+            del progress_channels[channel_name]
+
+
+def format_sse_event(event):
+    return f"id: {event['event_id']}\nevent: progress\ndata: {json.dumps(event)}\n\n"
+
+
+def format_sse_done_event(job_id, status):
+    # The browser closes its EventSource on this, rather than reconnecting
+    return f"event: done\ndata: {json.dumps({'job_id': job_id, 'status': status})}\n\n"
+
+
+def get_last_event_id():
+    # Sent by EventSource when it reconnects, ids are per channel so anything else is ignored
+    try:
+        return int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        return None
+
+
+def stream_progress_events(channel_name, job_id=None, last_event_id=None):
+    subscriber = subscribe_progress(channel_name, last_event_id)
+    closes_at = time() + PROGRESS_STREAM_MAX_SECONDS
+
+    try:
+        yield f"retry: {PROGRESS_RETRY_MS}\n\n"
+
+        while time() < closes_at:
+            try:
+                event = subscriber.get(timeout=min(PROGRESS_KEEPALIVE_SECONDS, max(closes_at - time(), 0)))
+                yield format_sse_event(event)
+
+                if job_id is not None and event["stage"] == "done":
+                    yield format_sse_done_event(job_id, "finished")
+                    return
+            except queue.Empty:
+                # Job streams end once the job has finished (or failed), other streams just stay alive
+                if job_id is not None:
+                    job_state = load_job_state(job_id)
+                    if job_state is None or job_state["status"] not in ("queued", "running"):
+                        yield format_sse_done_event(job_id, job_state["status"] if job_state else "missing")
+                        return
+
+                yield ": keepalive\n\n"
+    finally:
+        unsubscribe_progress(channel_name, subscriber)
+
+
+def poll_job_progress_events(job_id, last_event_id=None):
+    # Events published between polls are missed, but the stream still tracks the job's latest progress
+    # and ends with it, like stream_progress_events(). Ids carry on from a resumed stream's last one.
+    last_progress_time = None
+    next_event_id = (last_event_id or 0) + 1
+    last_sent_at = time()
+    closes_at = time() + PROGRESS_STREAM_MAX_SECONDS
+
+    yield f"retry: {PROGRESS_RETRY_MS}\n\n"
+
+    while time() < closes_at:
+        job_state = load_job_state(job_id)
+        if job_state is None:
+            yield format_sse_done_event(job_id, "missing")
+            return
+
+        progress = job_state.get("progress")
+        if progress and progress["time"] != last_progress_time:
+            last_progress_time = progress["time"]
+            yield format_sse_event({**progress, "event_id": next_event_id})
+            next_event_id += 1
+            last_sent_at = time()
+
+        if job_state["status"] not in ("queued", "running"):
+            yield format_sse_done_event(job_id, job_state["status"])
+            return
+
+        if time() - last_sent_at > PROGRESS_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent_at = time()
+
+        sleep(PROGRESS_POLL_SECONDS)
+
+
+def progress_event_stream_response(events):
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Stop reverse proxies (e.g. nginx) from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+with app.app_context():
+
+    @app.route("/jobs/<job_id>/events", methods=["GET"])
+    def stream_job_progress(job_id):
+        job_state = load_job_state(job_id)
+        if job_state is None or job_state["username"] != session.get("username"):
+            return "Job not found", 404
+
+        # A stream resumed after the job finished just tells the browser it's done
+        if job_state["status"] not in ("queued", "running"):
+            return progress_event_stream_response([format_sse_done_event(job_id, job_state["status"])])
+
+        if not is_job_local(job_state):
+            return progress_event_stream_response(poll_job_progress_events(job_id, get_last_event_id()))
+
+        return progress_event_stream_response(
+            stream_progress_events(f"job:{job_id}", job_id, get_last_event_id())
+        )
+
+    @app.route("/progress/events", methods=["GET"])
+    def stream_user_progress():
+        if "username" not in session:
+            return "no user session", 401
+
+        return progress_event_stream_response(
+            stream_progress_events(f"user:{session['username']}", last_event_id=get_last_event_id())
+        )
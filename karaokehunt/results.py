@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+
+from .cache import load_cache_file, store_cache_file
+from .cachebackend import get_cache_backend
+
+logger = logging.getLogger("karaokehunt")
+
+# Bump this whenever calculate_songs_rows() output changes, so previously cached results are not reused
+SHEET_RESULT_FORMAT_VERSION = 1
+SHEET_RESULT_MEMORY_CACHE_SIZE = 8
+
+# How long a calculated sheet is kept for /fetch_csv and the exports, and how often each process sweeps older ones
+SHEET_RESULT_TTL = int(os.getenv("SHEET_RESULT_TTL_HOURS", 24 * 7)) * 3600
+SHEET_RESULT_PRUNE_INTERVAL_SECONDS = int(os.getenv("SHEET_RESULT_PRUNE_INTERVAL_SECONDS", 600))
+
+##########################################################################
+###########              Memoized Sheet Results                ###########
+##########################################################################
+
+# Most recently used results are also kept in memory, keyed by result key
+sheet_results_memory_cache = OrderedDict()
+sheet_results_memory_cache_lock = threading.Lock()
+
+# Every generation with new provider data stores a result, so ones older than SHEET_RESULT_TTL are swept periodically
+sheet_result_prune_state = {"last_pruned_at": 0}
+sheet_result_prune_lock = threading.Lock()
+
+
+def fingerprint_provider_data(data):
+    if data is None:
+        return "none"
+
+    # Score maps are sorted so the fingerprint doesn't depend on the order the provider returned items in
+    if isinstance(data, dict):
+        data = sorted(data.items())
+
+    serialised = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+
+def get_sheet_result_key(catalog_version, include_zero_score, provider_data):
+    # provider_data is a dict of provider data name -> data (or None if that provider isn't used)
+    hasher = hashlib.sha256()
+    hasher.update(f"{SHEET_RESULT_FORMAT_VERSION}|{catalog_version}|{include_zero_score}".encode("utf-8"))
+
+    for name in sorted(provider_data):
+        hasher.update(f"|{name}={fingerprint_provider_data(provider_data[name])}".encode("utf-8"))
+
+    return hasher.hexdigest()[:32]
+
+
+def load_sheet_result(result_key):
+    with sheet_results_memory_cache_lock:
+        if result_key in sheet_results_memory_cache:
+            sheet_results_memory_cache.move_to_end(result_key)
+            logger.info(f"Found sheet result {result_key} in memory cache")
+            return sheet_results_memory_cache[result_key]
+
+    result = load_cache_file(f"sheet_result_{result_key}")
+    if result is None:
+        return None
+
+    logger.info(f"Found sheet result {result_key} in cache file")
+    result = (result["header"], result["rows"])
+    remember_sheet_result(result_key, result)
+    return result
+
+
+def store_sheet_result(result_key, header_values, data_values):
+    prune_expired_sheet_results()
+    store_cache_file(
+        f"sheet_result_{result_key}",
+        {"header": header_values, "rows": data_values},
+        ttl_seconds=SHEET_RESULT_TTL,
+    )
+    remember_sheet_result(result_key, (header_values, data_values))
+
+
+def prune_expired_sheet_results():
+    with sheet_result_prune_lock:
+        if time() - sheet_result_prune_state["last_pruned_at"] < SHEET_RESULT_PRUNE_INTERVAL_SECONDS:
+            return
+        sheet_result_prune_state["last_pruned_at"] = time()
+
+    try:
+        # The latest result pointers are written no earlier than the results they point to, so expire with them
+        get_cache_backend().delete_expired("sheet_result_", SHEET_RESULT_TTL)
+        get_cache_backend().delete_expired("latest_sheet_result_", SHEET_RESULT_TTL)
+    except Exception:
+        logger.exception("Failed to prune expired sheet results")
+
+
+def remember_sheet_result(result_key, result):
+    with sheet_results_memory_cache_lock:
+        sheet_results_memory_cache[result_key] = result
+        sheet_results_memory_cache.move_to_end(result_key)
+
+        while len(sheet_results_memory_cache) > SHEET_RESULT_MEMORY_CACHE_SIZE:
+            sheet_results_memory_cache.popitem(last=False)
+
+
+def get_latest_sheet_result_key(username):
+    latest = load_cache_file(f"latest_sheet_result_{username}")
+    return latest["key"] if latest else None
+
+
+def set_latest_sheet_result_key(username, result_key):
+    if get_latest_sheet_result_key(username) != result_key:
+        store_cache_file(f"latest_sheet_result_{username}", {"key": result_key}, ttl_seconds=SHEET_RESULT_TTL)
@@ -0,0 +1,152 @@
+import os
+import logging
+import secrets
+import threading
+from time import time
+
+from flask.sessions import SessionInterface, SecureCookieSession
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+
+from .cachebackend import get_cache_backend
+
+logger = logging.getLogger("karaokehunt")
+
+# server (default) keeps session data in the cache backend with only an opaque id in the cookie,
+# cookie keeps Flask's default signed cookie sessions
+SESSION_STORE = os.getenv("SESSION_STORE", "server")
+
+# How often each process sweeps expired sessions out of the cache backend
+SESSION_PRUNE_INTERVAL_SECONDS = int(os.getenv("SESSION_PRUNE_INTERVAL_SECONDS", 600))
+
+##########################################################################
+###########               Server-Side Sessions                 ###########
+##########################################################################
+
+# The session holds provider OAuth tokens, the Apple client secret and id token, which made the signed cookie
+# large enough to noticeably slow down every request (including assets). Instead the cookie just carries a
+# signed random session id, and the session itself is stored in the cache backend (see cachebackend.py),
+# so it is shared by every worker and container using that backend.
+
+session_serializer = TaggedJSONSerializer()
+
+# Expired sessions are otherwise only deleted if their cookie comes back, so they're swept periodically
+session_prune_state = {"last_pruned_at": 0}
+session_prune_lock = threading.Lock()
+
+
+def prune_expired_sessions(ttl_seconds):
+    with session_prune_lock:
+        if time() - session_prune_state["last_pruned_at"] < SESSION_PRUNE_INTERVAL_SECONDS:
+            return
+        session_prune_state["last_pruned_at"] = time()
+
+    try:
+        get_cache_backend().delete_expired("session_", ttl_seconds)
+    except Exception:
+        logger.exception("Failed to prune expired sessions")
+
+
+class ServerSideSession(SecureCookieSession):
+    def __init__(self, initial=None, session_id=None):
+        super().__init__(initial)
+        self.session_id = session_id
+
+
+class CacheBackendSessionInterface(SessionInterface):
+    salt = "karaokehunt-session"
+
+    def get_signer(self, app):
+        if not app.secret_key:
+            return None
+        return Signer(app.secret_key, salt=self.salt)
+
+    def get_cache_name(self, session_id):
+        return f"session_{session_id}"
+
+    def open_session(self, app, request):
+        signer = self.get_signer(app)
+        if signer is None:
+            return None
+
+        cookie_value = request.cookies.get(self.get_cookie_name(app))
+        if not cookie_value:
+            return ServerSideSession()
+
+        try:
+            session_id = signer.unsign(cookie_value).decode("utf-8")
+        except BadSignature:
+            return ServerSideSession()
+
+        stored = get_cache_backend().get(self.get_cache_name(session_id))
+        if stored is None:
+            return ServerSideSession()
+
+        stored = session_serializer.loads(stored.decode("utf-8"))
+        if stored["expires_at"] < time():
+            get_cache_backend().delete(self.get_cache_name(session_id))
+            return ServerSideSession()
+
+        return ServerSideSession(stored["data"], session_id)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # A session emptied by this request is deleted along with its cookie, an empty session is never stored
+        if not session:
+            if session.modified:
+                if session.session_id:
+                    get_cache_backend().delete(self.get_cache_name(session.session_id))
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly
+                )
+                response.vary.add("Cookie")
+            return
+
+        # Unchanged sessions aren't written back, so most requests only cost one backend read
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl_seconds = app.permanent_session_lifetime.total_seconds()
+        if session.session_id is None:
+            session.session_id = secrets.token_urlsafe(32)
+            prune_expired_sessions(ttl_seconds)
+
+        stored = {
+            "expires_at": time() + ttl_seconds,
+            "data": dict(session),
+        }
+        get_cache_backend().set(
+            self.get_cache_name(session.session_id),
+            session_serializer.dumps(stored).encode("utf-8"),
+            ttl_seconds=ttl_seconds,
+        )
+
+        response.set_cookie(
+            name,
+            self.get_signer(app).sign(session.session_id).decode("utf-8"),
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
+        response.vary.add("Cookie")
+
+
+def init_session_store(app):
+    if SESSION_STORE == "server":
+        app.session_interface = CacheBackendSessionInterface()
+    elif SESSION_STORE != "cookie":
+        raise ValueError(f"Unknown SESSION_STORE: {SESSION_STORE}, expected server or cookie")
+
+    logger.info(f"Using {SESSION_STORE} session store")
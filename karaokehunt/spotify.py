@@ -1,9 +1,16 @@
 import os
 import requests
-import json
 import spotipy
 import logging
 from .utils import log_error_with_flash
+from .progress import publish_progress
+from .metrics import record_provider_call, provider_pages_total
+from .tracing import span
+from .cache import (
+    load_or_fetch_cache_file,
+    track_scores_to_records,
+    records_to_track_scores,
+)
 
 from flask import request, redirect, session, url_for, current_app as app, g
 
@@ -20,13 +27,17 @@ SPOTIFY_SCOPES = "user-top-read user-library-read"
 
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 
+# Overridable to run against a stand-in server, e.g. loadtest/mock_providers.py
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
 ##########################################################################
 ################           Spotify Auth Flow                ##############
 ##########################################################################
 
 
 def get_spotify_user_id(access_token):
-    url = "https://api.spotify.com/v1/me"
+    url = f"{SPOTIFY_API_URL}/me"
     headers = {"Authorization": f"Bearer {access_token}"}
 
     response = requests.get(url, headers=headers)
@@ -41,33 +52,32 @@ def get_spotify_user_id(access_token):
     return user_id
 
 
+def get_spotify_auth_manager():
+    cache_handler = spotipy.cache_handler.FlaskSessionCacheHandler(session)
+    auth_manager = SpotifyOAuth(
+        client_id=os.environ.get("SPOTIFY_CLIENT_ID"),
+        client_secret=os.environ.get("SPOTIFY_CLIENT_SECRET"),
+        redirect_uri=os.environ.get("SPOTIFY_REDIRECT_URI"),
+        scope=SPOTIFY_SCOPES,
+        cache_handler=cache_handler,
+        show_dialog=True,
+    )
+    auth_manager.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+    auth_manager.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+    return auth_manager
+
+
 with app.app_context():
 
     @app.route("/authenticate/spotify")
     def authenticate_spotify():
-        cache_handler = spotipy.cache_handler.FlaskSessionCacheHandler(session)
-        auth_manager = spotipy.SpotifyOAuth(
-            client_id=os.environ.get("SPOTIFY_CLIENT_ID"),
-            client_secret=os.environ.get("SPOTIFY_CLIENT_SECRET"),
-            redirect_uri=os.environ.get("SPOTIFY_REDIRECT_URI"),
-            scope=SPOTIFY_SCOPES,
-            cache_handler=cache_handler,
-            show_dialog=True,
-        )
+        auth_manager = get_spotify_auth_manager()
         auth_url = auth_manager.get_authorize_url()
         return redirect(auth_url)
 
     @app.route("/callback/spotify")
     def spotify_callback():
-        cache_handler = spotipy.cache_handler.FlaskSessionCacheHandler(session)
-        auth_manager = SpotifyOAuth(
-            client_id=os.environ.get("SPOTIFY_CLIENT_ID"),
-            client_secret=os.environ.get("SPOTIFY_CLIENT_SECRET"),
-            redirect_uri=os.environ.get("SPOTIFY_REDIRECT_URI"),
-            scope=SPOTIFY_SCOPES,
-            cache_handler=cache_handler,
-            show_dialog=True,
-        )
+        auth_manager = get_spotify_auth_manager()
         code = request.args.get("code")
         token_info = auth_manager.get_access_token(code)
         if token_info:
@@ -100,31 +110,45 @@ with app.app_context():
 ##########################################################################
 
 
-def get_top_artists_spotify(spotify_user_id, access_token):
-    cache_file = f"{TEMP_OUTPUT_DIR}/top_artists_spotify_{spotify_user_id}.json"
+def add_spotify_track_scores(track_scores, tracks):
+    for track in tracks:
+        try:
+            track_scores[
+                (
+                    track["album"]["artists"][0]["name"].lower(),
+                    track["name"].lower(),
+                )
+            ] = track["popularity"]
+        except (KeyError, IndexError, TypeError):
+            logger.warning(f"Failed to add spotify track as it had no album artists: {track}")
+
+
+def get_top_artists_spotify(spotify_user_id, access_token, token_expires_at=None):
+    return load_or_fetch_cache_file(
+        f"top_artists_spotify_{spotify_user_id}",
+        lambda: fetch_top_artists_spotify(spotify_user_id, access_token),
+        cache_kind="top_artists_spotify",
+        token_expires_at=token_expires_at,
+    )
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found top artists cache file for user ID {spotify_user_id}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            all_top_artists = json.load(f)
-            return all_top_artists
 
-    logger.info(
-        f"No top artists cache file found for user ID {spotify_user_id}, fetching 50 top artists"
-    )
+def fetch_top_artists_spotify(spotify_user_id, access_token):
+    logger.info(f"Fetching 50 top artists for user ID {spotify_user_id}")
 
     limit = 1000
-    url = "https://api.spotify.com/v1/me/top/artists"
+    url = f"{SPOTIFY_API_URL}/me/top/artists"
     headers = {"Authorization": f"Bearer {access_token}"}
-    all_top_artists = []
+
+    # Only the lowercased artist name and popularity are kept from each artist object,
+    # which also removes duplicates across time ranges
+    artist_scores = {}
 
     time_ranges = ["long_term", "medium_term", "short_term"]
     for time_range in time_ranges:
         params = {"time_range": time_range, "limit": 50}
-        response = requests.get(url, headers=headers, params=params)
+        with span("spotify.top_artists", category="http", time_range=time_range):
+            response = requests.get(url, headers=headers, params=params)
+        record_provider_call("spotify", response.status_code == 200)
 
         if response.status_code != 200:
             logger.error(
@@ -132,9 +156,16 @@ def get_top_artists_spotify(spotify_user_id, access_token):
             )
             return None
 
+        provider_pages_total.inc(provider="spotify")
         top_artists_data = response.json()
-        top_artists = top_artists_data["items"]
-        all_top_artists.extend(top_artists)
+        for artist in top_artists_data["items"]:
+            artist_scores[artist["name"].lower()] = artist["popularity"]
+
+        publish_progress(
+            "spotify",
+            f"Fetched Spotify {time_range} top artists, {len(artist_scores)} artists so far",
+            artists=len(artist_scores),
+        )
 
     # # Fetch followed artists
     # followed_artists_url = "https://api.spotify.com/v1/me/following?type=artist"
@@ -142,7 +173,7 @@ def get_top_artists_spotify(spotify_user_id, access_token):
 
     # while True:
     #     logger.info(
-    #         f"Inside followed artists while loop, offset: {followed_artists_offset}, len(all_top_artists): {len(all_top_artists)}"
+    #         f"Inside followed artists while loop, offset: {followed_artists_offset}, len(artist_scores): {len(artist_scores)}"
     #     )
     #     followed_artists_params = {"limit": 50, "after": followed_artists_offset}
 
@@ -158,53 +189,50 @@ def get_top_artists_spotify(spotify_user_id, access_token):
 
     #     followed_artists_data = followed_artists_response.json()
     #     followed_artists = followed_artists_data["artists"]["items"]
-    #     all_top_artists.extend(followed_artists)
+    #     for artist in followed_artists:
+    #         artist_scores[artist["name"].lower()] = artist["popularity"]
 
     #     if not followed_artists:
     #         break
 
-    #     if len(all_top_artists) > limit:
+    #     if len(artist_scores) > limit:
     #         logger.info(f"Top artists limit reached, breaking loop: {limit}")
     #         break
 
     #     followed_artists_offset += len(followed_artists)
 
-    # Remove duplicates
-    unique_artists = {artist["id"]: artist for artist in all_top_artists}.values()
-    unique_artists_list = list(unique_artists)
-
-    # Cache fetched data to a file
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(unique_artists_list, f)
+    return artist_scores
 
-    return unique_artists_list
 
+def get_top_tracks_spotify(spotify_user_id, access_token, token_expires_at=None):
+    return load_or_fetch_cache_file(
+        f"top_tracks_spotify_{spotify_user_id}",
+        lambda: fetch_top_tracks_spotify(spotify_user_id, access_token),
+        encode=track_scores_to_records,
+        decode=records_to_track_scores,
+        cache_kind="top_tracks_spotify",
+        token_expires_at=token_expires_at,
+    )
 
-def get_top_tracks_spotify(spotify_user_id, access_token):
-    cache_file = f"{TEMP_OUTPUT_DIR}/top_tracks_spotify_{spotify_user_id}.json"
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found top tracks cache file for user ID {spotify_user_id}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            all_top_tracks = json.load(f)
-            return all_top_tracks
-
-    logger.info(
-        f"No top tracks cache file found for user ID {spotify_user_id}, beginning fetch loop"
-    )
+def fetch_top_tracks_spotify(spotify_user_id, access_token):
+    logger.info(f"Beginning top tracks fetch loop for user ID {spotify_user_id}")
 
     limit = 10000
-    url = "https://api.spotify.com/v1/me/top/tracks"
+    url = f"{SPOTIFY_API_URL}/me/top/tracks"
     headers = {"Authorization": f"Bearer {access_token}"}
-    all_top_tracks = []
+
+    # Each page is reduced to (artist, title) -> popularity as it arrives, rather than holding
+    # every full track object in memory until the end
+    track_scores = {}
+    fetched_tracks = 0
 
     time_ranges = ["long_term", "medium_term", "short_term"]
     for time_range in time_ranges:
         params = {"time_range": time_range, "limit": 50}
-        response = requests.get(url, headers=headers, params=params)
+        with span("spotify.top_tracks", category="http", time_range=time_range):
+            response = requests.get(url, headers=headers, params=params)
+        record_provider_call("spotify", response.status_code == 200)
 
         if response.status_code != 200:
             logger.error(
@@ -212,24 +240,33 @@ def get_top_tracks_spotify(spotify_user_id, access_token):
             )
             return None
 
-        top_tracks_data = response.json()
-        top_tracks = top_tracks_data["items"]
-        all_top_tracks.extend(top_tracks)
+        provider_pages_total.inc(provider="spotify")
+        top_tracks = response.json()["items"]
+        add_spotify_track_scores(track_scores, top_tracks)
+        fetched_tracks += len(top_tracks)
+
+        publish_progress(
+            "spotify",
+            f"Fetched Spotify {time_range} top tracks, {fetched_tracks} tracks so far",
+            tracks=fetched_tracks,
+        )
 
     # Fetch saved tracks
-    saved_tracks_url = "https://api.spotify.com/v1/me/tracks"
+    saved_tracks_url = f"{SPOTIFY_API_URL}/me/tracks"
     saved_tracks_offset = 0
 
     while True:
         logger.info(
-            f"Inside saved tracks while loop, offset: {saved_tracks_offset}, len(all_top_tracks): {len(all_top_tracks)}"
+            f"Inside saved tracks while loop, offset: {saved_tracks_offset}, fetched_tracks: {fetched_tracks}"
         )
 
         saved_tracks_params = {"limit": 50, "offset": saved_tracks_offset}
 
-        saved_tracks_response = requests.get(
-            saved_tracks_url, headers=headers, params=saved_tracks_params
-        )
+        with span("spotify.saved_tracks", category="http", offset=saved_tracks_offset):
+            saved_tracks_response = requests.get(
+                saved_tracks_url, headers=headers, params=saved_tracks_params
+            )
+        record_provider_call("spotify", saved_tracks_response.status_code == 200)
 
         if saved_tracks_response.status_code != 200:
             logger.error(
@@ -237,25 +274,25 @@ def get_top_tracks_spotify(spotify_user_id, access_token):
             )
             return None
 
+        provider_pages_total.inc(provider="spotify")
         saved_tracks_data = saved_tracks_response.json()
         saved_tracks = [item["track"] for item in saved_tracks_data["items"]]
-        all_top_tracks.extend(saved_tracks)
+        add_spotify_track_scores(track_scores, saved_tracks)
+        fetched_tracks += len(saved_tracks)
+
+        publish_progress(
+            "spotify",
+            f"Fetched Spotify saved tracks page, {fetched_tracks} tracks so far",
+            tracks=fetched_tracks,
+        )
 
         if len(saved_tracks) < 50:
             break
 
-        if len(all_top_tracks) > limit:
+        if fetched_tracks > limit:
             logger.info(f"Top tracks limit reached, breaking loop: {limit}")
             break
 
         saved_tracks_offset += len(saved_tracks)
 
-    # Remove duplicates
-    unique_tracks = {track["id"]: track for track in all_top_tracks}.values()
-    unique_tracks_list = list(unique_tracks)
-
-    # Cache fetched data to a file
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(unique_tracks_list, f)
-
-    return unique_tracks_list
+    return track_scores
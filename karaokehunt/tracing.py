@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import logging
+import threading
+import contextvars
+from time import time
+from contextlib import contextmanager
+
+from .cache import atomic_open
+
+logger = logging.getLogger("karaokehunt")
+
+TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
+TRACES_DIR = f"{TEMP_OUTPUT_DIR}/traces"
+
+# off, jobs (default, every background job is traced) or all (every HTTP request is traced too)
+TRACING = os.getenv("TRACING", "jobs")
+TRACE_RETENTION_SECONDS = int(os.getenv("TRACE_RETENTION_HOURS", 24)) * 3600
+
+# Stops a runaway loop (e.g. thousands of YouTube videos) from holding an unbounded trace in memory
+TRACE_MAX_EVENTS = 50000
+
+# Trace ids are request ids or job ids
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{10,32}$")
+
+##########################################################################
+###########                 Pipeline Tracing                   ###########
+##########################################################################
+
+# Spans are recorded as Chrome trace event format "complete" events and written to one JSON file per
+# trace, named by the request or job id, when the trace finishes. Open the file in chrome://tracing or
+# https://ui.perfetto.dev to see the waterfall; nothing else (no collector) is needed.
+# Spans nest by time within each thread, and work handed to other threads shows up on their own rows.
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def start_trace(trace_id, kind, **details):
+    # Returns a token for finish_trace()
+    trace = {
+        "started_at": time(),
+        "id": trace_id,
+        "kind": kind,
+        "details": details,
+        "events": [],
+        "dropped_events": 0,
+        "threads": {},
+        "lock": threading.Lock(),
+    }
+    return current_trace.set(trace)
+
+
+def finish_trace(token, **args):
+    trace = current_trace.get()
+    if trace is None:
+        return
+
+    # The root span covers the whole request or job, everything else nests under it
+    record_span(trace["kind"], trace["started_at"], time(), **args)
+    current_trace.reset(token)
+
+    try:
+        save_trace(trace)
+    except Exception:
+        logger.exception(f"Failed to save trace {trace['id']}")
+
+
+def save_trace(trace):
+    pid = os.getpid()
+    thread_names = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+        for tid, name in trace["threads"].items()
+    ]
+
+    os.makedirs(TRACES_DIR, exist_ok=True)
+    prune_old_traces()
+
+    with atomic_open(get_trace_file_path(trace["id"]), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "traceEvents": thread_names + trace["events"],
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "trace_id": trace["id"],
+                    "kind": trace["kind"],
+                    "dropped_events": trace["dropped_events"],
+                    **trace["details"],
+                },
+            },
+            f,
+            default=str,
+        )
+
+
+def record_span(name, start, end, category="app", **args):
+    # Adds a span which has already finished, with start and end as unix timestamps
+    trace = current_trace.get()
+    if trace is None:
+        return
+
+    tid = threading.get_native_id()
+
+    with trace["lock"]:
+        if len(trace["events"]) >= TRACE_MAX_EVENTS:
+            trace["dropped_events"] += 1
+            return
+
+        trace["threads"].setdefault(tid, threading.current_thread().name)
+        trace["events"].append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int(start * 1000000),
+                "dur": int((end - start) * 1000000),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+
+@contextmanager
+def span(name, category="app", **args):
+    # Does nothing outside a trace, so it's cheap to leave around hot code
+    if current_trace.get() is None:
+        yield
+        return
+
+    start = time()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        record_span(name, start, time(), category, **args)
+
+
+def get_trace_file_path(trace_id):
+    if not TRACE_ID_PATTERN.match(trace_id or ""):
+        raise ValueError(f"Invalid trace id: {trace_id}")
+    return f"{TRACES_DIR}/{trace_id}.json"
+
+
+def prune_old_traces():
+    cutoff = time() - TRACE_RETENTION_SECONDS
+    for filename in os.listdir(TRACES_DIR):
+        file_path = f"{TRACES_DIR}/{filename}"
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def list_traces():
+    # Newest first, as (trace id, modification time, size in bytes)
+    try:
+        filenames = [filename for filename in os.listdir(TRACES_DIR) if filename.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+    traces = []
+    for filename in filenames:
+        try:
+            stat = os.stat(f"{TRACES_DIR}/{filename}")
+        except FileNotFoundError:
+            continue
+        traces.append((filename[: -len(".json")], stat.st_mtime, stat.st_size))
+
+    return sorted(traces, key=lambda trace: trace[1], reverse=True)
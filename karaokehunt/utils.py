@@ -2,10 +2,14 @@ import re
 import os
 import sys
 import json
+import html
 import logging
+from datetime import datetime
+from urllib.parse import quote
 
 from flask import (
     Response,
+    send_file,
     redirect,
     request,
     session,
@@ -15,6 +19,17 @@ from flask import (
     g,
 )
 
+from .logs import get_user_log_lines, get_rotated_log_file_paths, read_last_lines
+from .tracing import list_traces, get_trace_file_path
+from .profiling import (
+    arm_profiling,
+    list_armed_profiling,
+    list_profiles,
+    get_profile_file_path,
+    get_top_functions,
+)
+from .memory import list_memory_profiles, load_memory_profile, diff_memory_snapshots
+
 logger = logging.getLogger("karaokehunt")
 
 ##########################################################################
@@ -25,7 +40,7 @@ logger = logging.getLogger("karaokehunt")
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH")
-DEFAULT_loglimit = os.getenv("DEFAULT_loglimit", 50)
+DEFAULT_loglimit = int(os.getenv("DEFAULT_loglimit", 50))
 
 with app.app_context():
 
@@ -34,78 +49,255 @@ with app.app_context():
         session["error_flash_message"] = error
         logger.error(error)
 
-    def tail(f, lines=1, _buffer=4098):
-        """Tail a file and get X lines from the end"""
-        # place holder for the lines found
-        lines_found = []
-
-        # block counter will be multiplied by buffer
-        # to get the block size from the end
-        block_counter = -1
-
-        # loop until we find X lines
-        while len(lines_found) < lines:
-            try:
-                f.seek(block_counter * _buffer, os.SEEK_END)
-            except IOError:  # either file is too small, or too many lines requested
-                f.seek(0)
-                lines_found = f.readlines()
-                break
-
-            lines_found = f.readlines()
-
-            # decrement the block counter to get the
-            # next X bytes
-            block_counter -= 1
-
-        return lines_found[-lines:]
-
     def get_all_logs(loglimit):
-        with open(LOG_FILE_PATH) as f:
-            tailed_logs = tail(f, loglimit)
-            tailed_logs.reverse()
-            return "".join(tailed_logs)
+        # Newest first, continuing into the rotated backups if the current log file has fewer lines
+        return "".join(read_last_lines(get_rotated_log_file_paths(LOG_FILE_PATH), loglimit))
 
     def get_logs_for_username(username, loglimit):
-        userlines = []
-        with open(LOG_FILE_PATH) as f:
-            for line in f.readlines():
-                if re.search(f" / User: {username}", line):
-                    userlines.append(line)
+        # Read from the user's own log side file (see logs.py), rather than searching the whole log
+        userlines = get_user_log_lines(username, loglimit)
 
         if len(userlines) == 0:
             userlines = [f"No logs found for username: {username}"]
 
-        if len(userlines) > loglimit:
-            userlines = userlines[-loglimit:]
-
-        userlines.reverse()
         return "".join(userlines)
 
+    def is_admin_request():
+        return ADMIN_PASSWORD is not None and request.args.get("password") == ADMIN_PASSWORD
+
+    def get_admin_link(path):
+        return f"{path}?password={quote(request.args.get('password', ''), safe='')}"
+
+    def get_traces_html(limit=20):
+        traces_html = "<h2>Recent traces (open in chrome://tracing or ui.perfetto.dev):</h2><ul>"
+        for trace_id, modified_time, size in list_traces()[:limit]:
+            traces_html += (
+                f'<li><a href="{get_admin_link(f"/admin/traces/{trace_id}")}">{trace_id}</a> '
+                f"{datetime.fromtimestamp(modified_time):%Y-%m-%d %H:%M:%S}, {size // 1024} KB</li>"
+            )
+        return traces_html + "</ul>"
+
+    def get_profiles_html(limit=20):
+        profiles_html = "<h2>CPU and memory profiles:</h2>"
+        profiles_html += (
+            '<form action="/admin/profiling/arm" method="get">'
+            f'<input type="hidden" name="password" value="{html.escape(request.args.get("password", ""))}">'
+            'Profile the next sheet generation of username <input type="text" name="username"> '
+            'for <select name="kind"><option value="cpu">CPU (cProfile)</option>'
+            '<option value="memory">memory (tracemalloc)</option></select> '
+            '<input type="submit" value="Arm profiler"></form>'
+        )
+
+        armed_usernames = list_armed_profiling()
+        if armed_usernames:
+            profiles_html += f"<p>Armed for: {html.escape(', '.join(armed_usernames))}</p>"
+
+        profiles_html += "<h3>CPU:</h3><ul>"
+        for job_id, modified_time, size in list_profiles()[:limit]:
+            profiles_html += (
+                f'<li><a href="{get_admin_link(f"/admin/profiles/{job_id}")}">{job_id}</a> '
+                f"{datetime.fromtimestamp(modified_time):%Y-%m-%d %H:%M:%S}, {size // 1024} KB "
+                f'(<a href="{get_admin_link(f"/admin/profiles/{job_id}/download")}">download</a>)</li>'
+            )
+
+        profiles_html += "</ul><h3>Memory:</h3><ul>"
+        for job_id, modified_time in list_memory_profiles()[:limit]:
+            profiles_html += (
+                f'<li><a href="{get_admin_link(f"/admin/memory/{job_id}")}">{job_id}</a> '
+                f"{datetime.fromtimestamp(modified_time):%Y-%m-%d %H:%M:%S}</li>"
+            )
+        return profiles_html + "</ul>"
+
+    def format_bytes(size):
+        return f"{size / 1048576:,.1f} MB"
+
+    def get_allocation_sites_html(allocation_sites):
+        sites_html = "<table><tr><th>Size</th><th>Change</th><th>Blocks</th><th>Allocation site</th></tr>"
+        for allocation_site in allocation_sites:
+            size_diff = allocation_site.get("size_diff")
+            sites_html += (
+                f"<tr><td>{format_bytes(allocation_site['size'])}</td>"
+                f"<td>{'' if size_diff is None else f'{size_diff / 1048576:+,.1f} MB'}</td>"
+                f"<td>{allocation_site['count']}</td>"
+                f"<td><code>{html.escape(allocation_site['site'])}</code></td></tr>"
+            )
+        return sites_html + "</table>"
+
     @app.route("/admin", methods=["GET"])
     def admin():
         logger.info("Admin page requested")
         admin_html = "unauthorized"
 
-        if (
-            ADMIN_PASSWORD is not None
-            and request.args.get("password") == ADMIN_PASSWORD
-        ):
+        if is_admin_request():
             admin_html = f"<h1>KaraokeHunt Tools Admin Helper</h1>"
             admin_html += "<p>Please use this page with extreme caution, it shows all user logs, potentially including secrets</p>"
 
             loglimit = int(request.args["loglimit"]) if "loglimit" in request.args else DEFAULT_loglimit
 
-            admin_html += f"<h2>Logs for all users since last app restart, last {loglimit} lines (newest at top):</h2>"
+            admin_html += f"<h2>Logs for all users, last {loglimit} lines (newest at top):</h2>"
             admin_html += (
                 '<pre style="white-space: pre-wrap; overflow-wrap: break-word;">'
             )
             admin_html += get_all_logs(loglimit) + "</pre>"
 
+            admin_html += get_traces_html()
+
+            admin_html += get_profiles_html()
+
             admin_html += debug()
 
         return admin_html
 
+    @app.route("/admin/traces/<trace_id>", methods=["GET"])
+    def download_trace(trace_id):
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        try:
+            trace_file_path = get_trace_file_path(trace_id)
+        except ValueError:
+            return "Trace not found", 404
+
+        if not os.path.exists(trace_file_path):
+            return "Trace not found", 404
+
+        return send_file(
+            trace_file_path,
+            mimetype="application/json",
+            as_attachment=True,
+            download_name=f"karaokehunt_trace_{trace_id}.json",
+        )
+
+    @app.route("/admin/profiling/arm", methods=["GET"])
+    def arm_profiler():
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        username = request.args.get("username", "").strip()
+        if not username:
+            return "A username is required", 400
+
+        try:
+            arm_profiling(username, request.args.get("kind", "cpu"))
+        except ValueError as e:
+            return str(e), 400
+
+        return redirect(get_admin_link("/admin"))
+
+    @app.route("/admin/profiles/<job_id>", methods=["GET"])
+    def show_profile(job_id):
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        try:
+            profile_file_path = get_profile_file_path(job_id)
+        except ValueError:
+            return "Profile not found", 404
+
+        if not os.path.exists(profile_file_path):
+            return "Profile not found", 404
+
+        sort = request.args.get("sort", "cumulative")
+        total_time, rows = get_top_functions(job_id, sort)
+
+        def sort_link(column, label):
+            return f'<a href="{get_admin_link(f"/admin/profiles/{job_id}")}&sort={column}">{label}</a>'
+
+        profile_html = f"<h1>CPU profile of job {job_id}</h1>"
+        profile_html += f"<p>{total_time:.3f}s of profiled CPU time, top functions by {html.escape(sort)}. "
+        profile_html += f'<a href="{get_admin_link(f"/admin/profiles/{job_id}/download")}">Download</a> '
+        profile_html += "and open with snakeviz or <code>python -m pstats</code> for the full call graph.</p>"
+        profile_html += (
+            f"<table><tr><th>{sort_link('calls', 'Calls')}</th><th>{sort_link('tottime', 'Own time (s)')}</th>"
+            f"<th>{sort_link('cumulative', 'Cumulative time (s)')}</th><th>Function</th></tr>"
+        )
+        for calls, primitive_calls, own_time, cumulative_time, function in rows:
+            calls_text = f"{calls}/{primitive_calls}" if calls != primitive_calls else str(calls)
+            profile_html += (
+                f"<tr><td>{calls_text}</td><td>{own_time:.4f}</td><td>{cumulative_time:.4f}</td>"
+                f"<td><code>{html.escape(function)}</code></td></tr>"
+            )
+
+        return profile_html + "</table>"
+
+    @app.route("/admin/profiles/<job_id>/download", methods=["GET"])
+    def download_profile(job_id):
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        try:
+            profile_file_path = get_profile_file_path(job_id)
+        except ValueError:
+            return "Profile not found", 404
+
+        if not os.path.exists(profile_file_path):
+            return "Profile not found", 404
+
+        return send_file(
+            profile_file_path,
+            mimetype="application/octet-stream",
+            as_attachment=True,
+            download_name=f"karaokehunt_profile_{job_id}.prof",
+        )
+
+    @app.route("/admin/memory/<job_id>", methods=["GET"])
+    def show_memory_profile(job_id):
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        try:
+            memory_profile = load_memory_profile(job_id)
+        except ValueError:
+            memory_profile = None
+
+        if memory_profile is None:
+            return "Memory profile not found", 404
+
+        memory_html = f"<h1>Memory profile of job {job_id}</h1>"
+        memory_html += "<p>Traced memory is the whole process, including anything else running alongside this job.</p>"
+
+        memory_html += "<h2>Deep sizes:</h2><table><tr><th>Structure</th><th>Size</th></tr>"
+        for name, size in sorted(memory_profile["deep_sizes"].items(), key=lambda item: item[1], reverse=True):
+            memory_html += f"<tr><td>{name}</td><td>{format_bytes(size)}</td></tr>"
+        memory_html += "</table>"
+
+        previous_stage = None
+        for stage in memory_profile["stages"]:
+            memory_html += (
+                f"<h2>After {stage['stage']}: {format_bytes(stage['traced_bytes'])} traced, "
+                f"{format_bytes(stage['stage_peak_traced_bytes'])} peak during the stage, "
+                f"{format_bytes(stage['peak_rss_bytes'])} process peak RSS</h2>"
+            )
+            if previous_stage is not None:
+                diff_link = get_admin_link("/admin/memory/diff")
+                diff_link += f"&before={job_id}:{previous_stage}&after={job_id}:{stage['stage']}"
+                memory_html += f'<p><a href="{diff_link}">Diff against {previous_stage}</a></p>'
+            memory_html += get_allocation_sites_html(stage["top_allocation_sites"])
+            previous_stage = stage["stage"]
+
+        return memory_html
+
+    @app.route("/admin/memory/diff", methods=["GET"])
+    def diff_memory_profiles():
+        # before and after are "<job id>:<stage>", so snapshots of different jobs can be compared too
+        if not is_admin_request():
+            return "unauthorized", 401
+
+        try:
+            before_job_id, before_stage = request.args["before"].split(":")
+            after_job_id, after_stage = request.args["after"].split(":")
+            allocation_sites = diff_memory_snapshots(before_job_id, before_stage, after_job_id, after_stage)
+        except (KeyError, ValueError):
+            return "before and after must each be a job id and stage, like <job id>:scoring", 400
+        except FileNotFoundError:
+            return "Memory snapshot not found", 404
+
+        memory_html = (
+            f"<h1>Memory growth from {html.escape(request.args['before'])} "
+            f"to {html.escape(request.args['after'])}</h1>"
+        )
+        return memory_html + get_allocation_sites_html(allocation_sites)
+
     @app.route("/debug", methods=["GET"])
     def debug():
         logger.info("Debug page requested")
@@ -0,0 +1,61 @@
+import logging
+import threading
+from time import time, perf_counter
+
+from flask import jsonify, current_app as app
+
+from .karaokenerds import load_karaoke_songs_index, get_karaoke_songs_version
+from .googleapi import preload_discovery_documents
+
+logger = logging.getLogger("karaokehunt")
+
+##########################################################################
+###########                 Startup Warm-Up                    ###########
+##########################################################################
+
+# Loads everything every sheet generation needs (catalog, catalog index, Google discovery documents)
+# up front. Under gunicorn with preload_app this runs once in the master before it forks,
+# so every worker starts warm and shares the loaded data copy-on-write.
+
+warmup_state = {"status": "pending", "started_at": None, "finished_at": None, "error": None}
+warmup_lock = threading.Lock()
+
+
+def warm_up():
+    with warmup_lock:
+        if warmup_state["status"] in ("running", "ready"):
+            return
+        warmup_state.update(status="running", started_at=time(), finished_at=None, error=None)
+
+    logger.info("Warming up karaoke song catalog and google discovery documents")
+    warmup_start = perf_counter()
+
+    try:
+        karaoke_songs_index = load_karaoke_songs_index()
+        preload_discovery_documents()
+    except Exception as e:
+        logger.exception("Warm-up failed, workers will load data on first use instead")
+        warmup_state.update(status="failed", finished_at=time(), error=str(e))
+        return
+
+    warmup_state.update(status="ready", finished_at=time())
+    logger.info(
+        f"Warm-up finished in {perf_counter() - warmup_start:.2f}s, {len(karaoke_songs_index)} karaoke songs loaded"
+    )
+
+
+def warm_up_in_background():
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+with app.app_context():
+
+    @app.route("/ready", methods=["GET"])
+    def readiness():
+        # Only reports ready once warm-up has finished, so a load balancer doesn't route to a cold worker
+        body = dict(warmup_state)
+        if warmup_state["status"] != "ready":
+            return jsonify(body), 503
+
+        body["catalog_version"] = get_karaoke_songs_version()
+        return jsonify(body)
@@ -1,18 +1,27 @@
 import yt_dlp as youtube_dl
 import os
-import json
 import logging
+import requests
 
 from flask import redirect, request, session, url_for, current_app as app, g
 
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 
+from .cache import load_or_fetch_cache_file
+from .googleapi import get_google_service
+from .progress import publish_progress
+from .metrics import record_provider_call, provider_pages_total, youtube_identifications_total
+from .tracing import span
+
 logger = logging.getLogger("karaokehunt")
 
 TEMP_OUTPUT_DIR = os.getenv("TEMP_OUTPUT_DIR")
 
+# If set, video metadata is fetched as JSON from {YOUTUBE_VIDEO_INFO_URL}/{video id} instead of through yt-dlp,
+# to run against a stand-in server, e.g. loadtest/mock_providers.py
+YOUTUBE_VIDEO_INFO_URL = os.getenv("YOUTUBE_VIDEO_INFO_URL")
+
 ##########################################################################
 ###############           Youtube Auth Flow                 ##############
 ##########################################################################
@@ -73,7 +82,7 @@ def get_youtube_channel_id(google_token):
 
     # Create an authorized YouTube API client
     credentials = Credentials(token=google_token["access_token"])
-    youtube = build("youtube", "v3", credentials=credentials)
+    youtube = get_google_service("youtube", "v3", credentials)
 
     # Retrieve the user's YouTube channel
     channels_request = youtube.channels().list(part="id", mine=True)
@@ -88,24 +97,20 @@ def get_youtube_channel_id(google_token):
 
 
 def get_liked_videos(userid, google_token):
-    cache_file = f"{TEMP_OUTPUT_DIR}/youtube_liked_videos_{userid}.json"
+    return load_or_fetch_cache_file(
+        f"youtube_liked_videos_{userid}",
+        lambda: fetch_liked_videos(userid, google_token),
+        cache_kind="youtube_liked_videos",
+        token_expires_at=google_token.get("expires_at"),
+    )
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found liked videos cache file for user ID {userid}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            liked_videos = json.load(f)
-            return liked_videos
 
-    logger.info(
-        f"No liked videos cache file found for user ID {userid}, fetching up to 10k liked videos"
-    )
+def fetch_liked_videos(userid, google_token):
+    logger.info(f"Fetching up to 10k liked videos for user ID {userid}")
 
     # Create an authorized YouTube API client
     credentials = Credentials(token=google_token["access_token"])
-    youtube = build("youtube", "v3", credentials=credentials)
+    youtube = get_google_service("youtube", "v3", credentials)
 
     # Retrieve the user's channel
     channels_request = youtube.channels().list(part="contentDetails", mine=True)
@@ -138,7 +143,10 @@ def get_liked_videos(userid, google_token):
             maxResults=min(50, max_results - num_results),
             pageToken=next_page_token,
         )
-        likes_response = likes_request.execute()
+        with span("youtube.liked_videos_page", category="http", fetched=num_results):
+            likes_response = likes_request.execute()
+        record_provider_call("youtube", True)
+        provider_pages_total.inc(provider="youtube")
 
         # Extract the video details
         for item in likes_response["items"]:
@@ -147,35 +155,40 @@ def get_liked_videos(userid, google_token):
             liked_videos.append((video_id, video_title))
             num_results += 1
 
+        publish_progress(
+            "youtube",
+            f"Fetched YouTube liked videos page, {num_results} videos so far",
+            videos=num_results,
+        )
+
         # If there's a nextPageToken, update the token and continue fetching
         if "nextPageToken" in likes_response:
             next_page_token = likes_response["nextPageToken"]
         else:
             break
 
-    # Cache fetched data to a file
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(liked_videos, f)
-
     return liked_videos
 
 
 def identify_songs_from_youtube_videos(userid, liked_videos):
-    cache_file = f"{TEMP_OUTPUT_DIR}/youtube_liked_songs_{userid}.json"
+    return load_or_fetch_cache_file(
+        f"youtube_liked_songs_{userid}",
+        lambda: identify_songs_from_youtube_videos_uncached(userid, liked_videos),
+        cache_kind="youtube_liked_songs",
+        refresh_pool="youtube_identification",
+    )
 
-    # Load data from cache file if it exists
-    if os.path.exists(cache_file):
-        logger.info(
-            f"Found liked songs cache file for user ID {userid}, loading this instead of fetching again"
-        )
-        with open(cache_file, "r", encoding="utf-8") as f:
-            liked_songs = json.load(f)
-            return liked_songs
 
-    logger.info(
-        f"No liked songs cache file found for user ID {userid}, running all liked videos through identification"
-    )
+def extract_youtube_video_info(ydl, video_id):
+    if YOUTUBE_VIDEO_INFO_URL:
+        response = requests.get(f"{YOUTUBE_VIDEO_INFO_URL}/{video_id}")
+        response.raise_for_status()
+        return response.json()
 
+    return ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+
+
+def identify_songs_from_youtube_videos_uncached(userid, liked_videos):
     logger.info(f"Attempting to identify songs from {len(liked_videos)} youtube videos")
     liked_songs = []
 
@@ -197,25 +210,30 @@ def identify_songs_from_youtube_videos(userid, liked_videos):
             logger.info(
                 f"Inside youtube song identification loop, processed: {count} of total: {total}, identified: {identified_count}"
             )
+            publish_progress(
+                "youtube_identification",
+                f"Identified {identified_count} songs from {count} of {total} YouTube videos",
+                processed=count,
+                total=total,
+                identified=identified_count,
+            )
 
         try:
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(
-                    f"https://www.youtube.com/watch?v={video_id}", download=False
-                )
+            with youtube_dl.YoutubeDL(ydl_opts) as ydl, span("yt_dlp.extract_info", video_id=video_id):
+                info = extract_youtube_video_info(ydl, video_id)
 
                 if "artist" in info and "track" in info:
                     liked_songs.append((info["artist"], info["track"]))
+                    youtube_identifications_total.inc(outcome="identified")
+                else:
+                    youtube_identifications_total.inc(outcome="unidentified")
 
         except Exception as e:
             logger.info(f"Error extracting metadata for video ID {video_id}: {e}")
+            youtube_identifications_total.inc(outcome="error")
 
         count += 1
 
     logger.info(f"Successfully identified {len(liked_songs)} songs from youtube videos")
 
-    # Cache fetched data to a file
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(liked_songs, f)
-
     return liked_songs
@@ -0,0 +1,579 @@
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import uuid
+import zlib
+import random
+import base64
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode, unquote
+
+##########################################################################
+###########              Mock Music Data Providers             ###########
+##########################################################################
+
+# A local stand-in for every external service the app calls, so the whole pipeline (and load tests,
+# see loadtest/run_loadtest.py) can run offline:
+#   /lastfm/2.0/               user.getTopArtists, user.getTopTracks
+#   /spotify/v1/               me, me/top/artists, me/top/tracks, me/tracks
+#   /spotify/accounts/         OAuth authorize and token
+#   /applemusic/v1/            me/library/artists, me/library/songs
+#   /appleid/auth/             Sign in with Apple authorize and token
+#   /google/                   YouTube channels and playlistItems, Drive files, Sheets spreadsheets and values,
+#                              plus OAuth authorize and token for the Google and YouTube flows
+#   /youtube/videos/<id>       video metadata, in place of yt-dlp
+#   /karaokenerds/catalog.json.gz
+#   /mock/stats                requests served so far, by endpoint and status
+#
+# Each user's data is generated from their username or access token (see benchmarks/generators.py),
+# so it's stable across requests and processes, and part of it matches the served catalog.
+# Latency, error and 429 rates apply to the provider data endpoints, not to OAuth or the catalog.
+#
+# Usage, from the repository root:
+#   python loadtest/mock_providers.py --port 8900 --latency-ms 80 --rate-limit-rate 0.02 \
+#       --write-google-client-secrets google.json --write-apple-key apple.p8 --print-env > mock.env
+# then start the app with the printed environment (e.g. set -a; . ./mock.env; set +a).
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.generators import generate_catalog, generate_listening_history
+
+SPOTIFY_SCOPES = "user-top-read user-library-read"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve mock Last.fm, Spotify, Apple, YouTube and Google APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--catalog-size", type=int, default=50000, help="Songs in the served karaoke catalog")
+    parser.add_argument("--tracks", type=int, default=2000, help="Tracks in each user's history, per provider")
+    parser.add_argument("--youtube-videos", type=int, default=200, help="Liked videos per YouTube user")
+    parser.add_argument("--youtube-identified-rate", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Mean added latency of data endpoints")
+    parser.add_argument("--latency-jitter-ms", type=float, default=20, help="Standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of data requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of data requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--page-size", type=int, help="Caps items per page below what the client asks for")
+    parser.add_argument("--write-google-client-secrets", help="Write an OAuth client secrets file pointing here")
+    parser.add_argument("--write-apple-key", help="Write a throwaway Apple Music signing key (needs cryptography)")
+    parser.add_argument("--print-env", action="store_true", help="Print the app environment for this server")
+    return parser.parse_args()
+
+
+def get_identity_seed(seed, identity):
+    return seed + zlib.crc32(identity.encode("utf-8"))
+
+
+class MockProviders:
+    def __init__(self, args):
+        self.args = args
+        self.catalog = generate_catalog(args.catalog_size, args.seed)
+        self.catalog_gzip = gzip.compress(json.dumps(self.catalog).encode("utf-8"))
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.stats_lock = threading.Lock()
+
+        # Video ids are "<identity hash>-<index>", so /youtube/videos can find the history a video came from
+        self.youtube_identities = {}
+
+    @lru_cache(maxsize=512)
+    def get_history(self, provider, identity, track_count=None):
+        return generate_listening_history(
+            self.catalog, track_count or self.args.tracks, get_identity_seed(self.args.seed, f"{provider}:{identity}")
+        )
+
+    def get_page_size(self, requested, maximum):
+        page_size = min(requested, maximum)
+        if self.args.page_size:
+            page_size = min(page_size, self.args.page_size)
+        return max(page_size, 1)
+
+    def record(self, endpoint, status):
+        with self.stats_lock:
+            self.stats[endpoint][str(status)] += 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {endpoint: dict(statuses) for endpoint, statuses in self.stats.items()}
+
+    def inject_faults(self):
+        # Returns (status, headers, body) for a simulated failure, or None to answer normally
+        latency = random.gauss(self.args.latency_ms, self.args.latency_jitter_ms) / 1000
+        if latency > 0:
+            time.sleep(latency)
+
+        roll = random.random()
+        if roll < self.args.rate_limit_rate:
+            return 429, {"Retry-After": str(self.args.retry_after)}, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+        if roll < self.args.rate_limit_rate + self.args.error_rate:
+            return 500, {}, {"error": {"status": 500, "message": "Mock server error"}}
+        return None
+
+    ######################################################################
+    #####                          Last.fm                           #####
+    ######################################################################
+
+    def lastfm(self, query):
+        user = query.get("user")
+        if not user:
+            return 400, {"error": 6, "message": "User not found"}
+
+        history = self.get_history("lastfm", user)
+        limit = self.get_page_size(int(query.get("limit", 50)), 1000)
+        page = int(query.get("page", 1))
+        attributes = {"user": user, "page": str(page), "perPage": str(limit), "total": str(len(history))}
+
+        if query.get("method") == "user.getTopArtists":
+            artist_playcounts = {}
+            for artist, _, score in history:
+                artist_playcounts[artist] = artist_playcounts.get(artist, 0) + score
+            artists = sorted(artist_playcounts.items(), key=lambda item: item[1], reverse=True)
+            page_artists = artists[(page - 1) * limit : page * limit]
+            return 200, {
+                "topartists": {
+                    "artist": [{"name": artist, "playcount": str(playcount)} for artist, playcount in page_artists],
+                    "@attr": attributes,
+                }
+            }
+
+        if query.get("method") == "user.getTopTracks":
+            page_tracks = history[(page - 1) * limit : page * limit]
+            return 200, {
+                "toptracks": {
+                    "track": [
+                        {"name": title, "playcount": str(score), "artist": {"name": artist}}
+                        for artist, title, score in page_tracks
+                    ],
+                    "@attr": attributes,
+                }
+            }
+
+        return 400, {"error": 3, "message": "Invalid Method - No method with that name in this package"}
+
+    ######################################################################
+    #####                          Spotify                           #####
+    ######################################################################
+
+    def spotify_track(self, artist, title, score):
+        return {"name": title, "popularity": min(score, 100), "album": {"artists": [{"name": artist}]}}
+
+    def spotify_me(self, token, query):
+        return 200, {"id": f"mock_{zlib.crc32(token.encode('utf-8')):08x}"}
+
+    def spotify_top(self, token, query, item_type):
+        # Each time range sees a different slice of the user's history
+        history = self.get_history("spotify", token)
+        limit = self.get_page_size(int(query.get("limit", 20)), 50)
+        start = {"long_term": 0, "medium_term": limit, "short_term": limit * 2}.get(query.get("time_range"), limit)
+        tracks = history[start : start + limit]
+
+        if item_type == "artists":
+            items = [{"name": artist, "popularity": min(score, 100)} for artist, _, score in tracks]
+        else:
+            items = [self.spotify_track(artist, title, score) for artist, title, score in tracks]
+        return 200, {"items": items, "total": len(history), "limit": limit}
+
+    def spotify_saved_tracks(self, token, query):
+        history = self.get_history("spotify", token)
+        limit = self.get_page_size(int(query.get("limit", 20)), 50)
+        offset = int(query.get("offset", 0))
+        tracks = history[offset : offset + limit]
+        return 200, {
+            "items": [{"track": self.spotify_track(artist, title, score)} for artist, title, score in tracks],
+            "total": len(history),
+            "limit": limit,
+            "offset": offset,
+        }
+
+    ######################################################################
+    #####                        Apple Music                         #####
+    ######################################################################
+
+    def applemusic_library(self, token, query, item_type):
+        # The app reads a single page of each library list, up to Apple's maximum of 100
+        history = self.get_history("applemusic", token)
+        limit = self.get_page_size(int(query.get("limit", 100)), 100)
+
+        if item_type == "artists":
+            artists = list(dict.fromkeys(artist for artist, _, _ in history))
+            data = [
+                {"id": f"r.{index}", "type": "library-artists", "attributes": {"name": artist}}
+                for index, artist in enumerate(artists[:limit])
+            ]
+        else:
+            data = [
+                {
+                    "id": f"i.{index}",
+                    "type": "library-songs",
+                    "attributes": {"name": title, "artistName": artist, "albumName": f"{title} - Single"},
+                }
+                for index, (artist, title, _) in enumerate(history[:limit])
+            ]
+        return 200, {"data": data, "meta": {"total": len(history)}}
+
+    ######################################################################
+    #####                  YouTube, Drive and Sheets                 #####
+    ######################################################################
+
+    def youtube_channels(self, token, query):
+        channel_id = f"UC{hashlib.sha1(token.encode('utf-8')).hexdigest()[:22]}"
+        return 200, {
+            "items": [{"id": channel_id, "contentDetails": {"relatedPlaylists": {"likes": f"LL{channel_id}"}}}]
+        }
+
+    def youtube_playlist_items(self, token, query):
+        history = self.get_history("youtube", token, self.args.youtube_videos)
+        identity_hash = f"{zlib.crc32(token.encode('utf-8')):08x}"
+        self.youtube_identities[identity_hash] = token
+
+        max_results = self.get_page_size(int(query.get("maxResults", 5)), 50)
+        offset = int(query.get("pageToken") or 0)
+        page = history[offset : offset + max_results]
+
+        response = {
+            "items": [
+                {
+                    "snippet": {
+                        "title": f"{artist} - {title} (Official Video)",
+                        "resourceId": {"kind": "youtube#video", "videoId": f"{identity_hash}-{offset + index}"},
+                    }
+                }
+                for index, (artist, title, _) in enumerate(page)
+            ],
+            "pageInfo": {"totalResults": len(history), "resultsPerPage": max_results},
+        }
+        if offset + max_results < len(history):
+            response["nextPageToken"] = str(offset + max_results)
+        return 200, response
+
+    def youtube_video_info(self, video_id):
+        # Like yt-dlp's info dict, with artist and track only for videos YouTube has music metadata for
+        identity_hash, _, index = video_id.partition("-")
+        token = self.youtube_identities.get(identity_hash)
+        if token is None or not index.isdigit():
+            return 404, {"error": "Video unavailable"}
+
+        history = self.get_history("youtube", token, self.args.youtube_videos)
+        if int(index) >= len(history):
+            return 404, {"error": "Video unavailable"}
+
+        artist, title, _ = history[int(index)]
+        info = {"id": video_id, "title": f"{artist} - {title} (Official Video)"}
+        if random.Random(video_id).random() < self.args.youtube_identified_rate:
+            info.update({"artist": artist, "track": title})
+        return 200, info
+
+    def sheets_values_written(self, body):
+        # Row counts of a values update or batchUpdate body
+        if "values" in body:
+            return len(body["values"])
+        return sum(len(data.get("values", [])) for data in body.get("data", []))
+
+    ######################################################################
+    #####                            OAuth                           #####
+    ######################################################################
+
+    def oauth_authorize(self, query):
+        # Approves straight away, redirecting back to the app with a code
+        redirect_params = {"code": f"mockcode-{uuid.uuid4().hex}"}
+        if "state" in query:
+            redirect_params["state"] = query["state"]
+        return 302, {"Location": f"{query.get('redirect_uri', '/')}?{urlencode(redirect_params)}"}
+
+    def oauth_token(self, provider, form):
+        code = form.get("code") or form.get("refresh_token") or uuid.uuid4().hex
+        token = {
+            "access_token": f"mock-{provider}-{hashlib.sha1(code.encode('utf-8')).hexdigest()[:24]}",
+            "token_type": "Bearer",
+            "expires_in": 3600,
+            "refresh_token": f"mock-refresh-{uuid.uuid4().hex}",
+        }
+        if provider == "spotify":
+            token["scope"] = SPOTIFY_SCOPES
+        if provider == "appleid":
+            token["id_token"] = make_unsigned_jwt(
+                {"iss": "https://appleid.apple.com", "aud": form.get("client_id"), "email": f"{code[-12:]}@mock.test"}
+            )
+        return 200, token
+
+    def appleid_authorize(self, query):
+        # Sign in with Apple uses response_mode=form_post, so the browser posts the code and id_token back
+        fields = {
+            "code": f"mockcode-{uuid.uuid4().hex}",
+            "id_token": make_unsigned_jwt({"aud": query.get("client_id"), "email": "mock@mock.test"}),
+            "state": query.get("state", ""),
+        }
+        inputs = "".join(f'<input type="hidden" name="{name}" value="{value}">' for name, value in fields.items())
+        html = (
+            f'<html><body onload="document.forms[0].submit()"><form method="post" action="{query.get("redirect_uri", "/")}">'
+            f"{inputs}</form></body></html>"
+        )
+        return 200, html
+
+
+def make_unsigned_jwt(claims):
+    # The app decodes Apple id tokens without verifying their signature, so any signature will do
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode(claims)}.{encode('mock')}"
+
+
+def get_bearer_token(headers):
+    authorization = headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return None
+    return authorization[len("Bearer ") :]
+
+
+# (method, path pattern, endpoint name, needs a bearer token, subject to injected faults)
+ROUTES = [
+    ("GET", r"^/lastfm/2\.0/?$", "lastfm", False, True),
+    ("GET", r"^/spotify/v1/me$", "spotify.me", True, True),
+    ("GET", r"^/spotify/v1/me/top/(artists|tracks)$", "spotify.top", True, True),
+    ("GET", r"^/spotify/v1/me/tracks$", "spotify.saved_tracks", True, True),
+    ("GET", r"^/spotify/accounts/authorize$", "spotify.authorize", False, False),
+    ("POST", r"^/spotify/accounts/api/token$", "spotify.token", False, False),
+    ("GET", r"^/applemusic/v1/me/library/(artists|songs)$", "applemusic.library", True, True),
+    ("GET", r"^/appleid/auth/authorize$", "appleid.authorize", False, False),
+    ("POST", r"^/appleid/auth/token$", "appleid.token", False, False),
+    ("GET", r"^/google/oauth/authorize$", "google.authorize", False, False),
+    ("POST", r"^/google/oauth/token$", "google.token", False, False),
+    ("GET", r"^/google/(?:.*/)?channels$", "youtube.channels", True, True),
+    ("GET", r"^/google/(?:.*/)?playlistItems$", "youtube.playlist_items", True, True),
+    ("GET", r"^/google/(?:.*/)?files$", "drive.files", True, True),
+    ("POST", r"^/google/(?:.*/)?v4/spreadsheets$", "sheets.create", True, True),
+    ("GET", r"^/google/(?:.*/)?v4/spreadsheets/([^/:]+)$", "sheets.get", True, True),
+    ("POST", r"^/google/(?:.*/)?v4/spreadsheets/([^/:]+):batchUpdate$", "sheets.batch_update", True, True),
+    ("POST", r"^/google/(?:.*/)?v4/spreadsheets/([^/:]+)/values:batchUpdate$", "sheets.values_batch_update", True, True),
+    ("POST", r"^/google/(?:.*/)?v4/spreadsheets/([^/:]+)/values/([^/]+):clear$", "sheets.values_clear", True, True),
+    ("PUT", r"^/google/(?:.*/)?v4/spreadsheets/([^/:]+)/values/([^/]+)$", "sheets.values_update", True, True),
+    ("GET", r"^/youtube/videos/([^/]+)$", "youtube.video_info", False, True),
+    ("GET", r"^/karaokenerds/catalog\.json\.gz$", "karaokenerds.catalog", False, False),
+    ("GET", r"^/mock/stats$", "mock.stats", False, False),
+]
+ROUTES = [(method, re.compile(pattern), endpoint, needs_token, faults) for method, pattern, endpoint, needs_token, faults in ROUTES]
+
+
+class MockProvidersRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    providers = None
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate a load test, /mock/stats has the counts instead
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return {name: values[0] for name, values in parse_qs(body.decode("utf-8")).items()}
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            return {}
+
+    def send(self, status, body, headers=None):
+        headers = dict(headers or {})
+        if isinstance(body, bytes):
+            data = body
+        elif isinstance(body, str):
+            data = body.encode("utf-8")
+            headers.setdefault("Content-Type", "text/html; charset=utf-8")
+        else:
+            data = json.dumps(body).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json; charset=utf-8")
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        parsed_url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(parsed_url.query).items()}
+        body = self.read_body()
+
+        for route_method, pattern, endpoint, needs_token, faults in ROUTES:
+            match = pattern.match(parsed_url.path)
+            if route_method == method and match:
+                break
+        else:
+            self.providers.record("unknown", 404)
+            return self.send(404, {"error": f"No mock for {method} {parsed_url.path}"})
+
+        token = get_bearer_token(self.headers)
+        if needs_token and token is None:
+            self.providers.record(endpoint, 401)
+            return self.send(401, {"error": {"status": 401, "message": "No token provided"}})
+
+        fault = self.providers.inject_faults() if faults else None
+        if fault is not None:
+            status, headers, response_body = fault
+            self.providers.record(endpoint, status)
+            return self.send(status, response_body, headers)
+
+        status, response_body, headers = self.dispatch(endpoint, match, query, body, token)
+        self.providers.record(endpoint, status)
+        self.send(status, response_body, headers)
+
+    def dispatch(self, endpoint, match, query, body, token):
+        # Returns (status, body, headers)
+        providers = self.providers
+
+        if endpoint == "lastfm":
+            return (*providers.lastfm(query), None)
+        if endpoint == "spotify.me":
+            return (*providers.spotify_me(token, query), None)
+        if endpoint == "spotify.top":
+            return (*providers.spotify_top(token, query, match.group(1)), None)
+        if endpoint == "spotify.saved_tracks":
+            return (*providers.spotify_saved_tracks(token, query), None)
+        if endpoint == "applemusic.library":
+            return (*providers.applemusic_library(token, query, match.group(1)), None)
+        if endpoint == "youtube.channels":
+            return (*providers.youtube_channels(token, query), None)
+        if endpoint == "youtube.playlist_items":
+            return (*providers.youtube_playlist_items(token, query), None)
+        if endpoint == "youtube.video_info":
+            return (*providers.youtube_video_info(unquote(match.group(1))), None)
+        if endpoint in ("spotify.authorize", "google.authorize"):
+            status, headers = providers.oauth_authorize(query)
+            return status, b"", headers
+        if endpoint == "appleid.authorize":
+            return (*providers.appleid_authorize(query), None)
+        if endpoint in ("spotify.token", "google.token", "appleid.token"):
+            return (*providers.oauth_token(endpoint.split(".")[0], body), None)
+        if endpoint == "drive.files":
+            return 200, {"files": []}, None
+        if endpoint == "sheets.create":
+            return 200, {"spreadsheetId": f"mock-{uuid.uuid4().hex}"}, None
+        if endpoint == "sheets.get":
+            return 200, {"spreadsheetId": match.group(1), "sheets": [{"properties": {"sheetId": 0, "title": "Sheet1"}}]}, None
+        if endpoint == "sheets.batch_update":
+            return 200, {"spreadsheetId": match.group(1), "replies": [{} for _ in body.get("requests", [])]}, None
+        if endpoint == "sheets.values_update":
+            return 200, {"spreadsheetId": match.group(1), "updatedRange": unquote(match.group(2)), "updatedRows": providers.sheets_values_written(body)}, None
+        if endpoint == "sheets.values_batch_update":
+            return 200, {"spreadsheetId": match.group(1), "totalUpdatedRows": providers.sheets_values_written(body)}, None
+        if endpoint == "sheets.values_clear":
+            return 200, {"spreadsheetId": match.group(1), "clearedRange": unquote(match.group(2))}, None
+        if endpoint == "karaokenerds.catalog":
+            return 200, providers.catalog_gzip, {"Content-Type": "application/gzip"}
+        if endpoint == "mock.stats":
+            return 200, providers.get_stats(), None
+
+        return 404, {"error": f"No mock for {endpoint}"}, None
+
+
+def get_app_environment(base_url, google_client_secrets_path=None, apple_key_path=None):
+    # The app settings which point every provider at this server
+    environment = {
+        "LASTFM_API_URL": f"{base_url}/lastfm/2.0/",
+        "SPOTIFY_API_URL": f"{base_url}/spotify/v1",
+        "SPOTIFY_ACCOUNTS_URL": f"{base_url}/spotify/accounts",
+        "APPLE_MUSIC_API_URL": f"{base_url}/applemusic/v1",
+        "APPLE_ID_URL": f"{base_url}/appleid",
+        "GOOGLE_API_ENDPOINT": f"{base_url}/google/",
+        "YOUTUBE_VIDEO_INFO_URL": f"{base_url}/youtube/videos",
+        "KARAOKE_SONGS_URL": f"{base_url}/karaokenerds/catalog.json.gz",
+        # oauthlib refuses plain http OAuth endpoints and redirects unless this is set
+        "OAUTHLIB_INSECURE_TRANSPORT": "1",
+    }
+    if google_client_secrets_path:
+        environment["GOOGLE_CREDENTIALS_PATH"] = os.path.abspath(google_client_secrets_path)
+    if apple_key_path:
+        # Every page signs an Apple Music developer token, which the mock accepts whatever its signature
+        environment["APPLE_MUSIC_CREDENTIALS_PATH"] = os.path.abspath(apple_key_path)
+        environment["APPLE_MUSIC_TEAM_ID"] = "MOCKTEAMID"
+        environment["APPLE_MUSIC_KEY_ID"] = "MOCKKEYID"
+        environment["APPLE_MUSIC_CLIENT_ID"] = "mock.apple.client"
+    return environment
+
+
+def write_google_client_secrets(file_path, base_url):
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "web": {
+                    "client_id": "mock-client-id.apps.googleusercontent.com",
+                    "client_secret": "mock-client-secret",
+                    "auth_uri": f"{base_url}/google/oauth/authorize",
+                    "token_uri": f"{base_url}/google/oauth/token",
+                }
+            },
+            f,
+            indent=2,
+        )
+
+
+def write_apple_key(file_path):
+    # An ES256 (P-256) private key in PEM, like the .p8 key Apple issues
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    with open(file_path, "wb") as f:
+        f.write(
+            private_key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            )
+        )
+
+
+def create_mock_server(args):
+    handler = type("Handler", (MockProvidersRequestHandler,), {"providers": MockProviders(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    args = parse_args()
+    base_url = f"http://{args.host}:{args.port}"
+
+    if args.write_google_client_secrets:
+        write_google_client_secrets(args.write_google_client_secrets, base_url)
+    if args.write_apple_key:
+        write_apple_key(args.write_apple_key)
+
+    if args.print_env:
+        environment = get_app_environment(base_url, args.write_google_client_secrets, args.write_apple_key)
+        for name, value in environment.items():
+            print(f"{name}={value}")
+        sys.stdout.flush()
+
+    server = create_mock_server(args)
+    print(f"Mock providers listening on {base_url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
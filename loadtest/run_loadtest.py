@@ -0,0 +1,474 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+##########################################################################
+###########                 Concurrent Load Test               ###########
+##########################################################################
+
+# Simulates many users at once against a running app, one scenario at a time, and reports per request type
+# the p50/p95/p99 latency, throughput and error rate, plus the app's peak memory (scraped from /metrics).
+# Scenarios, each looped by every simulated user until the scenario's duration is up:
+#   browse      GET /
+#   logs        GET /logs
+#   generate    GET /generate_sheet, poll /jobs/<id> until done, GET the result and /fetch_csv
+#   mixed       all of the above in turn, like a real visit
+# Users authenticate with each of --providers first, against the mock providers (loadtest/mock_providers.py).
+#
+# One command, starting the mock providers and the app (under gunicorn, as in production) in a temp dir:
+#   python loadtest/run_loadtest.py --start --users 20 --duration 60
+# Or against an already running app configured with the mock providers' environment:
+#   python loadtest/run_loadtest.py --app-url http://127.0.0.1:5000 --users 20 --duration 60
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from loadtest.mock_providers import get_app_environment
+
+SCENARIOS = ["browse", "logs", "generate", "mixed"]
+PROVIDERS = ["lastfm", "spotify", "youtube", "google"]
+
+# The request types each scenario exists to measure, which fail the run if their error rate is too high
+SCENARIO_CORE_REQUESTS = {
+    "browse": ["home"],
+    "logs": ["logs"],
+    "generate": ["generate_sheet", "job_status", "generation_end_to_end", "job_result", "fetch_csv"],
+    "mixed": ["home", "logs", "generate_sheet", "job_status", "generation_end_to_end", "job_result", "fetch_csv"],
+}
+
+# Each process's peak RSS (ru_maxrss), which unlike the current RSS gauge can't miss a spike between samples.
+# Processes publish it with their metrics snapshot every few seconds (METRICS_SNAPSHOT_INTERVAL_SECONDS),
+# so the final sample of a scenario waits that long for every worker's latest value.
+METRICS_PEAK_MEMORY_PATTERN = re.compile(
+    r'^karaokehunt_process_peak_resident_memory_bytes\{pid="(\d+)"\} (\S+)$', re.M
+)
+METRICS_SETTLE_SECONDS = 6
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent simulated users")
+    parser.add_argument("--app-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent simulated users per scenario")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds each scenario runs for")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--providers", default="lastfm,spotify", help=f"Any of {','.join(PROVIDERS)}")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Mean seconds a user pauses between steps")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between job status polls")
+    parser.add_argument("--job-timeout", type=float, default=300)
+    parser.add_argument("--memory-sample-interval", type=float, default=1.0)
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.01,
+        help="Fail (exit code 1) if any of a scenario's core request types errors more often than this",
+    )
+
+    parser.add_argument("--start", action="store_true", help="Start the mock providers and the app first")
+    parser.add_argument("--mock-port", type=int, default=8900)
+    parser.add_argument("--app-port", type=int, default=5000)
+    parser.add_argument("--gunicorn-workers", type=int, default=2)
+    parser.add_argument(
+        "--mock-args",
+        default="",
+        help='Extra mock_providers.py arguments with --start, e.g. "--latency-ms 100 --rate-limit-rate 0.05"',
+    )
+    return parser.parse_args()
+
+
+##########################################################################
+###########                  Results Recording                 ###########
+##########################################################################
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, status, error):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.statuses[name][str(status)] += 1
+            if error:
+                self.errors[name] += 1
+
+    def summarise(self, elapsed_seconds):
+        with self.lock:
+            requests_summary = {}
+            for name, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                requests_summary[name] = {
+                    "count": len(latencies),
+                    "errors": self.errors[name],
+                    "error_rate": self.errors[name] / len(latencies),
+                    "throughput_per_second": len(latencies) / elapsed_seconds,
+                    "p50_ms": get_percentile(latencies, 50) * 1000,
+                    "p95_ms": get_percentile(latencies, 95) * 1000,
+                    "p99_ms": get_percentile(latencies, 99) * 1000,
+                    "max_ms": latencies[-1] * 1000,
+                    "statuses": dict(self.statuses[name]),
+                }
+            return requests_summary
+
+
+def get_percentile(sorted_values, percentile):
+    # Nearest rank
+    return sorted_values[max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+class MemorySampler:
+    # Polls the app's /metrics for the peak resident memory of each of its processes. Peaks are since each
+    # process started, so with --start a scenario's peaks include the scenarios run before it.
+    def __init__(self, app_url, interval):
+        self.app_url = app_url
+        self.interval = interval
+        self.peak_total_bytes = 0
+        self.peak_process_bytes = 0
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="memory-sampler", daemon=True)
+
+    def sample(self):
+        try:
+            response = requests.get(f"{self.app_url}/metrics", timeout=10)
+        except requests.RequestException:
+            return
+
+        process_bytes = [float(value) for _, value in METRICS_PEAK_MEMORY_PATTERN.findall(response.text)]
+        if process_bytes:
+            self.samples += 1
+            self.peak_total_bytes = max(self.peak_total_bytes, sum(process_bytes))
+            self.peak_process_bytes = max(self.peak_process_bytes, max(process_bytes))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        time.sleep(METRICS_SETTLE_SECONDS)
+        self.sample()
+        return {
+            # An upper bound, as processes may have peaked at different times
+            "peak_total_resident_bytes": self.peak_total_bytes,
+            "peak_process_resident_bytes": self.peak_process_bytes,
+            "samples": self.samples,
+        }
+
+
+##########################################################################
+###########                   Simulated Users                  ###########
+##########################################################################
+
+
+class SimulatedUser:
+    def __init__(self, app_url, recorder, user_id, args):
+        self.app_url = app_url
+        self.recorder = recorder
+        self.user_id = user_id
+        self.args = args
+        self.http = requests.Session()
+        self.authenticated = False
+
+    def request(self, name, path, ok_statuses=(200,), **kwargs):
+        # Times one request (following redirects, as a browser would), returning the response or None
+        start = time.perf_counter()
+        try:
+            response = self.http.get(f"{self.app_url}{path}", timeout=60, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(name, time.perf_counter() - start, "exception", True)
+            return None
+
+        self.recorder.record(name, time.perf_counter() - start, response.status_code, response.status_code not in ok_statuses)
+        return response
+
+    def think(self):
+        time.sleep(random.expovariate(1 / self.args.think_time) if self.args.think_time > 0 else 0)
+
+    def authenticate(self):
+        # Each provider's OAuth dance runs through the mock providers and back to the app's callback
+        for provider in self.args.providers:
+            if provider == "lastfm":
+                self.request("auth.lastfm", f"/authenticate/lastfm?username={self.user_id}")
+            elif provider == "spotify":
+                self.request("auth.spotify", "/authenticate/spotify")
+            elif provider == "youtube":
+                self.request("auth.youtube", "/authorize_youtube")
+            elif provider == "google":
+                self.request("auth.google", "/authorize_google")
+        self.authenticated = True
+
+    def browse(self):
+        self.request("home", "/")
+
+    def logs(self):
+        self.request("logs", "/logs")
+
+    def generate(self):
+        generation_start = time.perf_counter()
+        response = self.request("generate_sheet", "/generate_sheet", ok_statuses=(202,))
+        if response is None or response.status_code != 202:
+            return
+
+        job_id = response.json()["job_id"]
+        deadline = time.monotonic() + self.args.job_timeout
+        status = None
+
+        while time.monotonic() < deadline:
+            time.sleep(self.args.poll_interval)
+            response = self.request("job_status", f"/jobs/{job_id}")
+            if response is None or response.status_code != 200:
+                continue
+            status = response.json()["status"]
+            if status not in ("queued", "running"):
+                break
+
+        # The whole generation, as the user waiting for their sheet sees it
+        self.recorder.record(
+            "generation_end_to_end", time.perf_counter() - generation_start, status or "timeout", status != "finished"
+        )
+        if status != "finished":
+            return
+
+        response = self.request("job_result", f"/jobs/{job_id}/result")
+        if response is None or response.status_code != 200:
+            return
+
+        # Sheets written to (mock) Google have nothing to download
+        open_sheet_url = response.json().get("open_sheet_url", "")
+        if open_sheet_url.startswith("/fetch_csv"):
+            self.request("fetch_csv", open_sheet_url, headers={"Accept-Encoding": "gzip"})
+
+    def mixed(self):
+        self.browse()
+        self.think()
+        self.generate()
+        self.think()
+        self.logs()
+
+    def run(self, scenario, deadline):
+        if scenario != "browse" and not self.authenticated:
+            self.authenticate()
+
+        run_scenario = getattr(self, scenario)
+        while time.monotonic() < deadline:
+            run_scenario()
+            self.think()
+
+
+def run_scenario(args, scenario, users):
+    recorder = Recorder()
+    memory_sampler = MemorySampler(args.app_url, args.memory_sample_interval)
+    memory_sampler.start()
+
+    for user in users:
+        user.recorder = recorder
+
+    print(f"Running {scenario} with {len(users)} users for {args.duration:.0f}s", file=sys.stderr)
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+
+    with ThreadPoolExecutor(max_workers=len(users), thread_name_prefix=f"user-{scenario}") as executor:
+        for future in [executor.submit(user.run, scenario, deadline) for user in users]:
+            future.result()
+
+    # Users finish their current step after the deadline, so throughput is over the actual elapsed time
+    elapsed_seconds = time.perf_counter() - start
+    return {
+        "users": len(users),
+        "elapsed_seconds": elapsed_seconds,
+        "requests": recorder.summarise(elapsed_seconds),
+        "memory": memory_sampler.stop(),
+    }
+
+
+def print_scenario_report(scenario, result):
+    print(
+        f"\n{scenario}: {result['users']} users, {result['elapsed_seconds']:.1f}s, "
+        f"peak RSS {result['memory']['peak_total_resident_bytes'] / 1048576:.0f} MB summed over processes, "
+        f"{result['memory']['peak_process_resident_bytes'] / 1048576:.0f} MB largest process"
+    )
+    print(f"{'request':<24}{'count':>8}{'errors':>9}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, summary in result["requests"].items():
+        print(
+            f"{name:<24}{summary['count']:>8}{summary['error_rate']:>8.1%} {summary['throughput_per_second']:>8.2f}"
+            f"{summary['p50_ms']:>10.1f}{summary['p95_ms']:>10.1f}{summary['p99_ms']:>10.1f}"
+        )
+
+
+##########################################################################
+###########                 Local Stack Startup                ###########
+##########################################################################
+
+
+def wait_for_url(url, timeout, process):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} while waiting for {url}")
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def start_local_stack(args, temp_dir):
+    # Starts the mock providers, then the app under gunicorn configured to use them. Returns the processes.
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    google_client_secrets_path = f"{temp_dir}/google_client_secrets.json"
+    apple_key_path = f"{temp_dir}/apple_music_key.p8"
+
+    mock_process = subprocess.Popen(
+        [
+            sys.executable,
+            f"{REPO_DIR}/loadtest/mock_providers.py",
+            "--port",
+            str(args.mock_port),
+            "--write-google-client-secrets",
+            google_client_secrets_path,
+            "--write-apple-key",
+            apple_key_path,
+            *args.mock_args.split(),
+        ],
+        stdout=open(f"{temp_dir}/mock_providers.log", "w"),
+        stderr=subprocess.STDOUT,
+    )
+    wait_for_url(f"{mock_url}/mock/stats", 60, mock_process)
+
+    app_environment = {
+        **os.environ,
+        **get_app_environment(mock_url, google_client_secrets_path, apple_key_path),
+        "PORT": str(args.app_port),
+        "GUNICORN_WORKERS": str(args.gunicorn_workers),
+        "TEMP_OUTPUT_DIR": temp_dir,
+        "LOG_FILE_PATH": f"{temp_dir}/karaokehunt.log",
+        "KARAOKE_SONGS_FILE": "karaokenerds.json.gz",
+        "CSV_OUTPUT_FILENAME_PREFIX": "karaokehunt_loadtest_",
+        "FLASK_SECRET_KEY": uuid.uuid4().hex,
+        "LASTFM_API_KEY": "loadtest",
+        "SPOTIFY_CLIENT_ID": "loadtest",
+        "SPOTIFY_CLIENT_SECRET": "loadtest",
+        "SPOTIFY_REDIRECT_URI": f"{args.app_url}/callback/spotify",
+        "YOUTUBE_REDIRECT_URI": f"{args.app_url}/authenticate/youtube",
+        "GOOGLE_REDIRECT_URI": f"{args.app_url}/authenticate/google",
+    }
+    app_process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "wsgi:app"],
+        cwd=REPO_DIR,
+        env=app_environment,
+        stdout=open(f"{temp_dir}/app.log", "w"),
+        stderr=subprocess.STDOUT,
+    )
+
+    try:
+        wait_for_url(f"{args.app_url}/ready", 180, app_process)
+    except RuntimeError:
+        mock_process.terminate()
+        app_process.terminate()
+        raise
+
+    return [app_process, mock_process]
+
+
+def stop_local_stack(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def get_error_rate_failures(results, max_error_rate, providers):
+    failures = []
+    for scenario, result in results.items():
+        for name in SCENARIO_CORE_REQUESTS[scenario]:
+            summary = result["requests"].get(name)
+            # Sheets are written to (mock) Google rather than downloaded when Google is authorised
+            if summary is None and name == "fetch_csv" and "google" in providers:
+                continue
+            if summary is None:
+                failures.append(f"{scenario}: no {name} requests completed")
+            elif summary["error_rate"] > max_error_rate:
+                failures.append(f"{scenario}: {name} error rate {summary['error_rate']:.1%}, statuses {summary['statuses']}")
+    return failures
+
+
+def main():
+    args = parse_args()
+    args.providers = [provider for provider in args.providers.split(",") if provider]
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit(f"Unknown scenario {scenario}, expected any of {', '.join(SCENARIOS)}")
+    for provider in args.providers:
+        if provider not in PROVIDERS:
+            sys.exit(f"Unknown provider {provider}, expected any of {', '.join(PROVIDERS)}")
+
+    if args.start:
+        args.app_url = f"http://127.0.0.1:{args.app_port}"
+
+    with tempfile.TemporaryDirectory(prefix="karaokehunt_loadtest_") as temp_dir:
+        processes = start_local_stack(args, temp_dir) if args.start else []
+        try:
+            # The same simulated users carry their sessions from one scenario to the next
+            run_id = uuid.uuid4().hex[:6]
+            users = [SimulatedUser(args.app_url, None, f"loadtest-{run_id}-{index}", args) for index in range(args.users)]
+            results = {}
+            for scenario in scenarios:
+                results[scenario] = run_scenario(args, scenario, users)
+                print_scenario_report(scenario, results[scenario])
+        finally:
+            stop_local_stack(processes)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "app_url": args.app_url,
+        "users": args.users,
+        "duration_seconds": args.duration,
+        "providers": args.providers,
+        "python_version": platform.python_version(),
+        "scenarios": results,
+        "failures": get_error_rate_failures(results, args.max_error_rate, args.providers),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {args.output}", file=sys.stderr)
+
+    if report["failures"]:
+        print(f"\nError rates above {args.max_error_rate:.1%}:", file=sys.stderr)
+        for failure in report["failures"]:
+            print(f"  {failure}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
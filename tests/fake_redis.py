@@ -0,0 +1,128 @@
+import socketserver
+import threading
+from time import time
+
+from karaokehunt.cachebackend import REDIS_RENEW_LOCK_SCRIPT, REDIS_RELEASE_LOCK_SCRIPT
+
+##########################################################################
+###########              In-Process Redis Fake                 ###########
+##########################################################################
+
+# Speaks just the RESP commands RedisCacheBackend sends, against a dict, so the backend's
+# protocol handling and lock scripts can be tested without a Redis server
+
+
+class FakeRedisState:
+    def __init__(self):
+        self.values = {}
+        self.expires_at = {}
+        self.lock = threading.Lock()
+
+    def get_value(self, key):
+        if key in self.expires_at and self.expires_at[key] <= time():
+            self.delete(key)
+        return self.values.get(key)
+
+    def delete(self, key):
+        self.expires_at.pop(key, None)
+        return 1 if self.values.pop(key, None) is not None else 0
+
+    def pexpire(self, key, milliseconds):
+        if self.get_value(key) is None:
+            return 0
+        self.expires_at[key] = time() + int(milliseconds) / 1000
+        return 1
+
+    def run(self, command, args):
+        if command == b"HSET":
+            fields = self.values.setdefault(args[0], {})
+            fields.update(zip(args[1::2], args[2::2]))
+            return len(args[1:]) // 2
+        if command == b"HGET":
+            return (self.get_value(args[0]) or {}).get(args[1])
+        if command == b"DEL":
+            return self.delete(args[0])
+        if command == b"PEXPIRE":
+            return self.pexpire(args[0], args[1])
+        if command == b"GET":
+            return self.get_value(args[0])
+        if command == b"SET":
+            key, value, options = args[0], args[1], [option.upper() for option in args[2:]]
+            if b"NX" in options and self.get_value(key) is not None:
+                return None
+            self.values[key] = value
+            self.expires_at.pop(key, None)
+            if b"PX" in options:
+                self.pexpire(key, options[options.index(b"PX") + 1])
+            return "OK"
+        if command == b"EVAL":
+            # Only the backend's own lock scripts are understood
+            script, key, token = args[0].decode("utf-8"), args[2], args[3]
+            if self.get_value(key) != token:
+                return 0
+            if script == REDIS_RENEW_LOCK_SCRIPT:
+                return self.pexpire(key, args[4])
+            if script == REDIS_RELEASE_LOCK_SCRIPT:
+                return self.delete(key)
+
+        raise ValueError(f"ERR unsupported command {command!r}")
+
+
+class FakeRedisRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+
+            with self.server.state.lock:
+                try:
+                    reply = self.server.state.run(args[0].upper(), args[1:])
+                except ValueError as e:
+                    self.wfile.write(b"-%s\r\n" % str(e).encode("utf-8"))
+                    continue
+
+            self.wfile.write(self.encode_reply(reply))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode_reply(self, reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode("utf-8")
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisRequestHandler)
+        self.state = FakeRedisState()
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-redis", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
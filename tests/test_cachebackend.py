@@ -0,0 +1,154 @@
+import os
+import tempfile
+import unittest
+from time import time
+
+from karaokehunt.cachebackend import RedisCacheBackend, SQLiteCacheBackend
+
+from tests.fake_redis import FakeRedisServer
+
+
+class RedisCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.backend = RedisCacheBackend(self.server.url)
+        self.addCleanup(self.close_connection)
+
+    def close_connection(self):
+        if hasattr(self.backend.connections, "connection"):
+            self.backend.connections.connection.close()
+
+    def test_set_and_get_binary_values(self):
+        # Bulk strings are length prefixed, so CRLFs and NULs in values must survive the round trip
+        value = b"line one\r\nline two\r\n\x00\x1f\x8b\r\n"
+        self.backend.set("binary", value)
+        self.assertEqual(self.backend.get("binary"), value)
+
+        self.backend.set("empty", b"")
+        self.assertEqual(self.backend.get("empty"), b"")
+
+    def test_get_modified_time(self):
+        before = time()
+        self.backend.set("timed", b"value")
+        modified_time = self.backend.get_modified_time("timed")
+
+        self.assertIsInstance(modified_time, float)
+        self.assertTrue(before <= modified_time <= time())
+
+    def test_missing_keys(self):
+        self.assertIsNone(self.backend.get("missing"))
+        self.assertIsNone(self.backend.get_modified_time("missing"))
+        self.backend.delete("missing")
+
+    def test_delete(self):
+        self.backend.set("deleted", b"value")
+        self.backend.delete("deleted")
+        self.assertIsNone(self.backend.get("deleted"))
+
+    def test_set_with_ttl_expires(self):
+        self.backend.set("short_lived", b"value", ttl_seconds=0.05)
+        self.assertEqual(self.backend.get("short_lived"), b"value")
+
+        self.server.state.expires_at[self.backend.get_key("short_lived").encode("utf-8")] = time() - 1
+        self.assertIsNone(self.backend.get("short_lived"))
+
+    def test_lock_is_released(self):
+        lock_key = self.backend.get_lock_key("released").encode("utf-8")
+        with self.backend.lock("released"):
+            self.assertIsNotNone(self.server.state.get_value(lock_key))
+        self.assertIsNone(self.server.state.get_value(lock_key))
+
+    def test_lock_release_only_deletes_a_lock_still_owned(self):
+        lock_key = self.backend.get_lock_key("taken_over").encode("utf-8")
+        with self.backend.lock("taken_over"):
+            # Our lease expired and someone else took the lock
+            self.server.state.values[lock_key] = b"someone-else"
+
+        self.assertEqual(self.server.state.get_value(lock_key), b"someone-else")
+
+    def test_renew_lock_only_extends_a_lock_still_owned(self):
+        lock_key = self.backend.get_lock_key("renewed").encode("utf-8")
+        self.server.state.run(b"SET", [lock_key, b"ours", b"NX", b"PX", b"1000"])
+
+        self.assertTrue(self.backend.renew_lock("renewed", "ours"))
+        self.assertFalse(self.backend.renew_lock("renewed", "theirs"))
+
+    def test_reconnects_after_the_connection_drops(self):
+        self.backend.set("reconnect", b"value")
+        self.backend.connections.connection.sock.close()
+        self.assertEqual(self.backend.get("reconnect"), b"value")
+
+
+class SQLiteCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.backend = SQLiteCacheBackend(os.path.join(directory.name, "cache.sqlite3"))
+
+    def get_lock_token(self, name):
+        row = self.backend.get_connection().execute(
+            "SELECT token FROM cache_locks WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def expire_lock(self, name):
+        self.backend.get_connection().execute(
+            "UPDATE cache_locks SET expires_at = ? WHERE name = ?", (time() - 1, name)
+        )
+
+    def test_held_lock_is_not_taken(self):
+        self.assertTrue(self.backend.try_lock("held", "first"))
+        self.assertFalse(self.backend.try_lock("held", "second"))
+        self.assertEqual(self.get_lock_token("held"), "first")
+
+    def test_expired_lock_is_taken_over(self):
+        self.assertTrue(self.backend.try_lock("expired", "first"))
+        self.expire_lock("expired")
+
+        self.assertTrue(self.backend.try_lock("expired", "second"))
+        self.assertEqual(self.get_lock_token("expired"), "second")
+
+        # The previous holder can no longer renew it
+        self.assertFalse(self.backend.renew_lock("expired", "first"))
+        self.assertTrue(self.backend.renew_lock("expired", "second"))
+
+    def test_lock_waits_for_expiry_then_takes_over(self):
+        # A holder that crashed stops renewing, so its lease runs out shortly
+        self.assertTrue(self.backend.try_lock("stuck", "crashed-holder"))
+        self.backend.get_connection().execute(
+            "UPDATE cache_locks SET expires_at = ? WHERE name = ?", (time() + 0.3, "stuck")
+        )
+
+        started = time()
+        with self.backend.lock("stuck"):
+            self.assertGreaterEqual(time() - started, 0.2)
+            self.assertNotEqual(self.get_lock_token("stuck"), "crashed-holder")
+
+        self.assertIsNone(self.get_lock_token("stuck"))
+
+    def test_lock_release_only_deletes_a_lock_still_owned(self):
+        with self.backend.lock("taken_over"):
+            self.backend.get_connection().execute(
+                "UPDATE cache_locks SET token = ? WHERE name = ?", ("someone-else", "taken_over")
+            )
+
+        self.assertEqual(self.get_lock_token("taken_over"), "someone-else")
+
+    def test_delete_expired_only_deletes_old_entries_with_the_prefix(self):
+        self.backend.set("session_old", b"old")
+        self.backend.set("session_new", b"new")
+        self.backend.set("other_old", b"old")
+        self.backend.get_connection().execute(
+            "UPDATE cache_entries SET updated_at = ? WHERE name IN ('session_old', 'other_old')", (time() - 100,)
+        )
+
+        self.backend.delete_expired("session_", 50)
+
+        self.assertIsNone(self.backend.get("session_old"))
+        self.assertEqual(self.backend.get("session_new"), b"new")
+        self.assertEqual(self.backend.get("other_old"), b"old")
+
+
+if __name__ == "__main__":
+    unittest.main()
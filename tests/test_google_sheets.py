@@ -0,0 +1,212 @@
+import os
+import re
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import httplib2
+from flask import Flask
+from googleapiclient.errors import HttpError
+
+# The provider modules register their routes on the current app and keep files in TEMP_OUTPUT_DIR when imported
+os.environ.setdefault("TEMP_OUTPUT_DIR", tempfile.mkdtemp())
+Flask(__name__).app_context().push()
+
+from karaokehunt import google
+from karaokehunt.google import (
+    RateLimiter,
+    split_rows_into_chunks,
+    execute_with_retries,
+    write_rows_to_google_sheet,
+)
+
+
+def make_http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+class FakeRequest:
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.service.execute(self.method, self.kwargs)
+
+
+class FakeSheetsService:
+    # Records the Sheets API calls the writer makes; errors maps a values range to errors to raise in turn
+
+    def __init__(self, errors=None):
+        self.calls = []
+        self.errors = {sheet_range: list(range_errors) for sheet_range, range_errors in (errors or {}).items()}
+        self.lock = threading.Lock()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeRequest(self, "get", kwargs)
+
+    def batchUpdate(self, **kwargs):
+        return FakeRequest(self, "batchUpdate", kwargs)
+
+    def update(self, **kwargs):
+        return FakeRequest(self, "update", kwargs)
+
+    def execute(self, method, kwargs):
+        with self.lock:
+            self.calls.append((method, kwargs))
+            range_errors = self.errors.get(kwargs.get("range"))
+            error = range_errors.pop(0) if range_errors else None
+
+        if error is not None:
+            raise error
+        if method == "get":
+            return {"sheets": [{"properties": {"sheetId": 7}}]}
+        return {}
+
+    def get_calls(self, method):
+        return [kwargs for call_method, kwargs in self.calls if call_method == method]
+
+
+def get_written_rows(service):
+    # Maps each sheet row number written by a values update to its values, failing on any row written twice
+    written_rows = {}
+    for kwargs in service.get_calls("update"):
+        first_row, last_row = map(int, re.fullmatch(r"A(\d+):[A-Z]+(\d+)", kwargs["range"]).groups())
+        rows = kwargs["body"]["values"]
+        assert last_row - first_row + 1 == len(rows), kwargs["range"]
+
+        for row_number, row in zip(range(first_row, last_row + 1), rows):
+            assert row_number not in written_rows, f"Row {row_number} written twice"
+            written_rows[row_number] = row
+    return written_rows
+
+
+class GoogleSheetsWriterTest(unittest.TestCase):
+    def setUp(self):
+        # No waiting between requests or before retries
+        for name, value in (("sleep", lambda seconds: None), ("GOOGLE_SHEETS_REQUESTS_PER_SECOND", 1000000)):
+            patcher = mock.patch.object(google, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.header_values = ["Artist", "Title", "Score"]
+        self.data_values = [[f"Artist {index}", f"Title {index}", index] for index in range(23)]
+
+    def write_rows(self, service, **limits):
+        with mock.patch.multiple(google, **limits):
+            return write_rows_to_google_sheet(
+                "spreadsheet", None, self.header_values, self.data_values, get_service=lambda: service
+            )
+
+    def assert_every_row_written_once(self, service):
+        written_rows = get_written_rows(service)
+        # Data starts on row 2, below the header
+        self.assertEqual(sorted(written_rows), list(range(2, len(self.data_values) + 2)))
+        for row_number, row in written_rows.items():
+            self.assertEqual(row, self.data_values[row_number - 2])
+
+    def test_split_rows_into_chunks_at_row_limit(self):
+        chunks = list(split_rows_into_chunks(self.data_values, 5, 1000000))
+
+        self.assertEqual([len(rows) for _, rows in chunks], [5, 5, 5, 5, 3])
+        self.assertEqual([start for start, _ in chunks], [0, 5, 10, 15, 20])
+        self.assertEqual([row for _, rows in chunks for row in rows], self.data_values)
+
+    def test_split_rows_into_chunks_at_byte_limit(self):
+        rows = [["x" * 96]] * 10  # 100 bytes each, with the per-value overhead
+        chunks = list(split_rows_into_chunks(rows, 1000, 250))
+
+        self.assertEqual([len(chunk_rows) for _, chunk_rows in chunks], [2, 2, 2, 2, 2])
+        self.assertEqual([start for start, _ in chunks], [0, 2, 4, 6, 8])
+
+    def test_split_rows_into_chunks_gives_oversized_rows_their_own_chunk(self):
+        rows = [["small"], ["x" * 500], ["small"]]
+        chunks = list(split_rows_into_chunks(rows, 1000, 100))
+
+        self.assertEqual(chunks, [(0, [["small"]]), (1, [["x" * 500]]), (2, [["small"]])])
+
+    def test_chunk_ranges_cover_every_row_once_at_row_limit(self):
+        service = FakeSheetsService()
+        self.write_rows(service, GOOGLE_SHEETS_CHUNK_ROWS=5)
+
+        self.assertEqual(len(service.get_calls("update")), 5)
+        self.assert_every_row_written_once(service)
+
+    def test_chunk_ranges_cover_every_row_once_at_byte_limit(self):
+        service = FakeSheetsService()
+        self.write_rows(service, GOOGLE_SHEETS_CHUNK_ROWS=1000, GOOGLE_SHEETS_CHUNK_BYTES=100)
+
+        self.assertGreater(len(service.get_calls("update")), 1)
+        self.assert_every_row_written_once(service)
+
+    def test_header_and_format_in_one_batch_update(self):
+        service = FakeSheetsService()
+        sheet_id = self.write_rows(service, GOOGLE_SHEETS_CHUNK_ROWS=5)
+
+        self.assertEqual(sheet_id, 7)
+        batch_updates = service.get_calls("batchUpdate")
+        self.assertEqual(len(batch_updates), 1)
+
+        grid_request, header_request = batch_updates[0]["body"]["requests"]
+        self.assertEqual(
+            grid_request["updateSheetProperties"]["properties"]["gridProperties"]["rowCount"],
+            len(self.data_values) + 1,
+        )
+        header_cells = header_request["updateCells"]["rows"][0]["values"]
+        self.assertEqual([cell["userEnteredValue"]["stringValue"] for cell in header_cells], self.header_values)
+        self.assertTrue(all(cell["userEnteredFormat"]["textFormat"]["bold"] for cell in header_cells))
+
+        # The header goes out before any rows
+        self.assertEqual([method for method, _ in service.calls][:2], ["get", "batchUpdate"])
+
+    def test_failing_chunk_is_retried_on_its_own(self):
+        service = FakeSheetsService(errors={"A7:C11": [make_http_error(503), make_http_error(429)]})
+        with self.assertLogs("karaokehunt", "WARNING") as logs:
+            self.write_rows(service, GOOGLE_SHEETS_CHUNK_ROWS=5)
+        self.assertEqual(len(logs.records), 2)
+
+        attempts = {}
+        for kwargs in service.get_calls("update"):
+            attempts[kwargs["range"]] = attempts.get(kwargs["range"], 0) + 1
+        self.assertEqual(attempts, {"A2:C6": 1, "A7:C11": 3, "A12:C16": 1, "A17:C21": 1, "A22:C24": 1})
+
+    def test_non_retryable_chunk_error_fails_the_write(self):
+        service = FakeSheetsService(errors={"A12:C16": [make_http_error(400)]})
+
+        with self.assertRaisesRegex(RuntimeError, "A12:C16"), self.assertLogs("karaokehunt", "ERROR"):
+            self.write_rows(service, GOOGLE_SHEETS_CHUNK_ROWS=5)
+
+        ranges = [kwargs["range"] for kwargs in service.get_calls("update")]
+        self.assertEqual(ranges.count("A12:C16"), 1)
+
+    def test_execute_with_retries_raises_non_retryable_errors(self):
+        service = FakeSheetsService(errors={"A2:C2": [make_http_error(403)]})
+        make_request = lambda: service.update(range="A2:C2", body={"values": [[1, 2, 3]]})
+
+        with self.assertRaises(HttpError) as raised:
+            execute_with_retries(RateLimiter(1000000), "Writing rows", make_request)
+
+        self.assertEqual(raised.exception.resp.status, 403)
+        self.assertEqual(len(service.calls), 1)
+
+    def test_execute_with_retries_gives_up_after_the_last_retry(self):
+        errors = [make_http_error(503)] * (google.GOOGLE_SHEETS_CHUNK_RETRIES + 1)
+        service = FakeSheetsService(errors={"A2:C2": errors})
+        make_request = lambda: service.update(range="A2:C2", body={"values": [[1, 2, 3]]})
+
+        with self.assertRaises(HttpError), self.assertLogs("karaokehunt", "WARNING"):
+            execute_with_retries(RateLimiter(1000000), "Writing rows", make_request)
+
+        self.assertEqual(len(service.calls), google.GOOGLE_SHEETS_CHUNK_RETRIES + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,13 @@
+from app import app
+from karaokehunt.warmup import warm_up
+
+##########################################################################
+###########               Production Entry Point               ###########
+##########################################################################
+
+# Run with: gunicorn --config gunicorn.conf.py wsgi:app
+# With preload_app (see gunicorn.conf.py) this module is imported once in the gunicorn master,
+# so the warm-up below happens before workers are forked and they all start with the data loaded.
+# Nothing here may start threads or executors, as they would not survive the fork.
+
+warm_up()